@@ -4,7 +4,7 @@ from datetime import datetime, timedelta, timezone
 from typing import Optional, List, Dict
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -12,12 +12,17 @@ from aiogram.exceptions import TelegramBadRequest
 import random
 import string
 import os
+import html
 
 from app_config import app_conf # Главный импорт
 import db_helpers
-from x_ui_manager import xui_manager_instance
+import message_templates
 from loguru import logger
 from subscription_manager import get_subscription_link, grant_subscription
+from traffic_collector import get_user_usage_summary, format_bytes
+import server_metrics
+import bulk_grant
+import rebalancer
 
 class AdminStates(StatesGroup):
     waiting_for_user_id_add_sub = State()
@@ -215,24 +220,29 @@ async def get_overall_stats_text() -> str:
     servers_summary = []
     active_servers_count = 0
     total_xui_clients = 0
-    xui_servers = app_conf.get('xui_servers', [])
+    xui_servers = app_conf.get_servers()
 
     if not xui_servers:
         servers_summary.append("Нет сконфигурированных X-UI серверов.")
     else:
+        # Данные берём из последних замеров сэмплера, а не из живых запросов к панелям
+        latest_samples = await db_helpers.get_latest_server_metrics()
         for server_conf in xui_servers:
-            try:
-                api_client = await xui_manager_instance.get_client(server_conf)
-                if api_client:
-                    num_clients = await xui_manager_instance.get_active_clients_count_for_inbound(server_conf)
-                    num_clients_str = str(num_clients) if num_clients is not None else "N/A"
-                    servers_summary.append(f"  - {server_conf['name']}: ✅ Онлайн, клиенты: {num_clients_str}")
-                    active_servers_count += 1
-                    if num_clients is not None: total_xui_clients += num_clients
-                else:
-                    servers_summary.append(f"  - {server_conf['name']}: ❌ Оффлайн")
-            except Exception as e:
-                servers_summary.append(f"  - {server_conf['name']}: ⚠️ Ошибка ({e})")
+            sample = latest_samples.get(server_conf['id'])
+            state = server_metrics.get_sample_state(sample)
+            if state == 'none':
+                servers_summary.append(f"  - {server_conf['name']}: ⏳ Нет данных мониторинга")
+            elif state in ('ok', 'stale'):
+                num_clients = sample['active_clients']
+                num_clients_str = str(num_clients) if num_clients is not None else "N/A"
+                stale_mark = " (⚠️ данные устарели)" if state == 'stale' else ""
+                servers_summary.append(f"  - {server_conf['name']}: ✅ Онлайн, клиенты: {num_clients_str}{stale_mark}")
+                active_servers_count += 1
+                if num_clients is not None: total_xui_clients += num_clients
+            elif state == 'timeout':
+                servers_summary.append(f"  - {server_conf['name']}: ⏱ Таймаут")
+            else:
+                servers_summary.append(f"  - {server_conf['name']}: ❌ Оффлайн")
     
     servers_text = "\n".join(servers_summary)
 
@@ -254,36 +264,58 @@ async def get_overall_stats_text() -> str:
 
 async def get_server_detailed_status_text() -> str:
     status_text = "🖥 <b>Детальный статус серверов X-UI:</b>\n\n"
-    xui_servers = app_conf.get('xui_servers', [])
+    xui_servers = app_conf.get_servers()
     if not xui_servers:
         return status_text + "Нет сконфигурированных X-UI серверов."
 
-    for server_conf in xui_servers:
+    # Переопрашиваем параллельно только серверы с устаревшими замерами: ожидание ограничено дедлайном одного сервера
+    try:
+        await server_metrics.refresh_stale_samples()
+    except Exception as e:
+        logger.error(f"Не удалось обновить устаревшие замеры серверов: {e}")
+
+    for item in await server_metrics.get_servers_overview():
+        server_conf, sample, state = item['config'], item['sample'], item['state']
         try:
             status_text += f"<b>📍 Сервер: {server_conf.get('name', 'N/A')} (ID: {server_conf.get('id', 'N/A')})</b>\n"
+            drain_status = await rebalancer.get_drain_status(server_conf)
+            if drain_status:
+                status_text += f"  🚚 Выводится: {rebalancer.format_drain_status(drain_status)}\n"
             if not all(key in server_conf for key in ['url', 'port']):
                 status_text += "  ⚠️ Ошибка конфигурации: отсутствуют url или port\n\n"
                 continue
 
-            try:
-                stats = await xui_manager_instance.get_server_stats(server_conf)
-                if stats:
-                    xui_url = f"https://{server_conf['url']}:{server_conf['port']}"
-                    if server_conf.get('secret_path'):
-                        xui_url += f"/{server_conf['secret_path'].strip('/')}"
-                    status_text += (
-                        f"  Статус: ✅ Онлайн\n"
-                        f"  CPU: {stats.get('cpu_usage', 'N/A')}%\n" 
-                        f"  RAM: {stats.get('memory_usage', 'N/A')}%\n"
-                        f"  Диск: {stats.get('disk_usage', 'N/A')}%\n"
-                        f"  Активных клиентов: {stats.get('active_users', 'N/A')}\n"
-                        f"  X-UI панель: <a href='{xui_url}'>{xui_url}</a>\n\n"
-                    )
+            if state == 'none':
+                status_text += "  Статус: ⏳ Нет данных мониторинга (сэмплер ещё не опросил сервер)\n\n"
+                continue
+
+            sampled_at = datetime.fromtimestamp(sample['ts']).strftime('%H:%M:%S')
+            if state in ('ok', 'stale'):
+                xui_url = f"https://{server_conf['url']}:{server_conf['port']}"
+                if server_conf.get('secret_path'):
+                    xui_url += f"/{server_conf['secret_path'].strip('/')}"
+                active_clients = sample['active_clients'] if sample['active_clients'] is not None else 'N/A'
+                if state == 'stale':
+                    status_line = f"  Статус: ⚠️ Данные устарели (замер {sampled_at}, {item['age_sec'] // 60} мин назад)\n"
                 else:
-                    status_text += "  Статус: ❌ Оффлайн или ошибка получения данных\n\n"
-            except Exception as e:
-                logger.error(f"Ошибка при получении статистики сервера {server_conf.get('name', 'Unknown')}: {str(e)}")
-                status_text += f"  Статус: ⚠️ Ошибка получения данных: {str(e)}\n\n"
+                    status_line = f"  Статус: ✅ Онлайн (замер {sampled_at})\n"
+                status_text += (
+                    status_line +
+                    f"  CPU: {server_metrics.format_metric(sample['cpu'])}%\n"
+                    f"  CPU история: <code>{item['cpu_sparkline']}</code>\n"
+                    f"  RAM: {server_metrics.format_metric(sample['mem'])}%\n"
+                    f"  Диск: {server_metrics.format_metric(sample['disk'])}%\n"
+                    f"  Активных клиентов: {active_clients}\n"
+                    f"  Задержка API: {sample['latency_ms']} мс\n"
+                    f"  X-UI панель: <a href='{xui_url}'>{xui_url}</a>\n\n"
+                )
+            elif state == 'timeout':
+                status_text += (
+                    f"  Статус: ⏱ Не ответил за {app_conf.get('server_metrics_deadline_sec', 8)} с (замер {sampled_at})\n"
+                    f"  CPU история: <code>{item['cpu_sparkline']}</code>\n\n"
+                )
+            else:
+                status_text += f"  Статус: ❌ Оффлайн или ошибка получения данных (замер {sampled_at})\n\n"
         except Exception as e:
             logger.error(f"Ошибка при обработке сервера {server_conf.get('name', 'Unknown')}: {str(e)}")
             status_text += f"  Статус: ⚠️ Ошибка обработки: {str(e)}\n\n"
@@ -320,7 +352,7 @@ async def get_user_info_text(user_id: int) -> str:
         
         server_conf = await db_helpers.get_server_config(srv_id)
         if server_conf:
-            sub_link = get_subscription_link(server_conf, uuid)
+            sub_link = get_subscription_link(server_conf, uuid, await db_helpers.get_sub_token(tg_id))
             text += f"  Ссылка: <code>{sub_link}</code>\n"
         text += "\n"
     elif active_sub_db:
@@ -331,6 +363,13 @@ async def get_user_info_text(user_id: int) -> str:
         text += f"   Действует до: {active_sub_db['subscription_end_date'].strftime('%d.%m.%Y %H:%M %Z')}\n\n"
     else:
         text += "🤷 Нет данных о подписке X-UI в базе.\n\n"
+
+    usage = await get_user_usage_summary(tg_id)
+    text += (
+        f"📶 <b>Трафик:</b> сутки {format_bytes(usage['day']['total'])}, "
+        f"30 дней {format_bytes(usage['month']['total'])} "
+        f"(↑{format_bytes(usage['month']['up'])} ↓{format_bytes(usage['month']['down'])})\n\n"
+    )
         
     payments = await db_helpers.get_user_payments(tg_id)
     if payments:
@@ -353,6 +392,56 @@ def register_admin_handlers(dp: Dispatcher):
         await app_conf.load_settings()
         await message.answer("✅ Настройки и тексты успешно перезагружены из базы данных!")
 
+    # --- Массовое начисление дней: /bulk_grant <дни> <фильтр> ---
+    @dp.message(Command("bulk_grant"))
+    async def cmd_bulk_grant(message: Message, command: CommandObject):
+        if not is_admin(message.from_user.id): return
+        parts = (command.args or '').split(maxsplit=1)
+        if len(parts) != 2 or not parts[0].isdigit():
+            filters_list = ', '.join(bulk_grant.BULK_GRANT_FILTERS)
+            await message.answer(
+                "Использование: <code>/bulk_grant &lt;дни&gt; &lt;фильтр&gt;</code>\n\n"
+                f"Фильтр — один из готовых ({filters_list}), <code>failed:&lt;номер задания&gt;</code> "
+                "или SQL-условие по таблице users, например <code>current_server_id = 2</code>.",
+                parse_mode="HTML"
+            )
+            return
+        try:
+            job_id, total = await bulk_grant.create_job(int(parts[0]), parts[1])
+        except ValueError as e:
+            await message.answer(f"❌ {html.escape(str(e))}")
+            return
+        await message.answer(f"✅ Задание #{job_id} создано: +{parts[0]} дн. для {total} пользователей.\nПрогресс: /bulk_grant_status {job_id}")
+
+    @dp.message(Command("bulk_grant_status"))
+    async def cmd_bulk_grant_status(message: Message, command: CommandObject):
+        if not is_admin(message.from_user.id): return
+        if command.args and command.args.strip().isdigit():
+            job = await db_helpers.get_bulk_grant_job(int(command.args.strip()))
+            jobs = [job] if job else []
+        else:
+            jobs = await db_helpers.get_bulk_grant_jobs(limit=5)
+        if not jobs:
+            await message.answer("Заданий массового начисления нет.")
+            return
+        lines = [
+            f"#{job['id']} [{job['status']}] +{job['days']} дн., «{html.escape(job['user_filter'])}»: "
+            f"продлено {job['processed']}, ошибок {job['failed']} из {job['total']}"
+            for job in jobs
+        ]
+        await message.answer("\n".join(lines))
+
+    @dp.message(Command("bulk_grant_cancel"))
+    async def cmd_bulk_grant_cancel(message: Message, command: CommandObject):
+        if not is_admin(message.from_user.id): return
+        if not command.args or not command.args.strip().isdigit():
+            await message.answer("Использование: /bulk_grant_cancel &lt;номер задания&gt;")
+            return
+        if await bulk_grant.cancel_job(int(command.args.strip())):
+            await message.answer("✅ Задание отменено. Уже продлённые пользователи остаются продлёнными.")
+        else:
+            await message.answer("❌ Задание не найдено или уже завершено.")
+
     @dp.callback_query(F.data == "admin_reload_settings")
     async def cq_reload_settings(query: CallbackQuery):
         if not is_admin(query.from_user.id): return await query.answer("⛔️ Нет доступа", show_alert=True)
@@ -438,7 +527,7 @@ def register_admin_handlers(dp: Dispatcher):
                 break
         await db_helpers.add_promo_code(new_code)
         await query.message.edit_text(
-            app_conf.get('admin_text_promo_code_created', '').format(code=new_code),
+            message_templates.render('admin_text_promo_code_created', code=new_code),
             reply_markup=get_admin_promo_codes_menu_keyboard()
         )
         await query.answer("Промокод создан!")
@@ -0,0 +1,229 @@
+# admission.py
+"""
+Очередь выдачи пробных периодов при наплыве регистраций.
+
+Когда бота репостит большой канал, за минуту приходят сотни /start, и все они одновременно
+вызывали grant_subscription: панели захлёбывались, выдачи падали с text_error_creating_user,
+и чем больше был наплыв, тем меньше пробных периодов выдавалось на самом деле.
+
+Теперь выдачи проходят через admission_queue: одновременно выполняется не больше
+admission_max_concurrent выдач и не больше admission_rate_per_min в минуту, остальные ждут
+по порядку. Ожидающему сразу показывается его место в очереди, и сообщение обновляется
+по мере продвижения (не чаще admission_position_update_sec и не больше POSITION_UPDATES_PER_TICK
+сообщений за раз, чтобы не упереться в лимиты Telegram). Дополнительно grant_subscription
+создаёт на одном сервере не больше admission_server_rate_per_min новых подписок в минуту
+(server_rate_limiter) — это касается всех новых подписок, а не только пробных.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+from loguru import logger
+
+from app_config import app_conf
+
+# Сколько сообщений с местом в очереди обновлять за один проход
+POSITION_UPDATES_PER_TICK = 20
+
+
+class TokenBucket:
+    """Не больше rate_per_min событий в минуту; запас — не больше секундной нормы (но минимум одно событие)."""
+
+    def __init__(self):
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, rate_per_min: float):
+        now = time.monotonic()
+        capacity = max(1.0, rate_per_min / 60)
+        self._tokens = min(capacity, self._tokens + (now - self._updated) * rate_per_min / 60)
+        self._updated = now
+
+    def try_acquire(self, rate_per_min: float) -> bool:
+        """Берёт разрешение без ожидания; False — если его нет или его уже кто-то ждёт."""
+        if rate_per_min <= 0:
+            return True
+        if self._lock.locked():
+            return False
+        self._refill(rate_per_min)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, rate_per_min: float):
+        """Ждёт разрешения; ожидающие обслуживаются по порядку. rate_per_min <= 0 — без ограничения."""
+        if rate_per_min <= 0:
+            return
+        async with self._lock:
+            while True:
+                self._refill(rate_per_min)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * 60 / rate_per_min)
+
+
+class ServerRateLimiter:
+    """Ограничение скорости создания новых подписок на каждом сервере."""
+
+    def __init__(self):
+        # (server_id, event loop) -> ограничитель: веб-админка выполняет выдачи в своих event loop
+        self._buckets: Dict[tuple, TokenBucket] = {}
+
+    async def acquire(self, server_id: int, rate_per_min: float):
+        if rate_per_min <= 0:
+            return
+        key = (server_id, asyncio.get_running_loop())
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket()
+        await bucket.acquire(rate_per_min)
+
+
+class _Ticket:
+    __slots__ = ('key', 'job', 'future', 'on_position', 'shown_position')
+
+    def __init__(self, key: Hashable, job: Callable[[], Awaitable[Any]], future: asyncio.Future,
+                 on_position: Optional[Callable[[int], Awaitable[None]]]):
+        self.key = key
+        self.job = job
+        self.future = future
+        self.on_position = on_position
+        self.shown_position: Optional[int] = None
+
+
+class AdmissionQueue:
+    """Очередь выдач с ограничением общей скорости и числа одновременно выполняемых выдач."""
+
+    def __init__(self):
+        self._waiting: Deque[_Ticket] = deque()
+        self._by_key: Dict[Hashable, _Ticket] = {}
+        self._bucket = TokenBucket()
+        self._running = 0
+        self._finished: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._updater: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _max_concurrent() -> int:
+        return max(1, app_conf.get('admission_max_concurrent', 10))
+
+    @staticmethod
+    def _rate() -> float:
+        return app_conf.get('admission_rate_per_min', 120)
+
+    def queue_length(self) -> int:
+        return len(self._waiting)
+
+    async def run(self, key: Hashable, job: Callable[[], Awaitable[Any]],
+                  on_position: Optional[Callable[[int], Awaitable[None]]] = None) -> Any:
+        """
+        Выполняет job() через очередь и возвращает её результат. Если мощности есть, выдача
+        начинается сразу; иначе on_position(N) вызывается сразу и затем по мере продвижения.
+        Повторный вызов с тем же key, пока первый ждёт в очереди, получает его результат.
+        """
+        if not self._waiting and self._running < self._max_concurrent() and self._bucket.try_acquire(self._rate()):
+            self._running += 1
+            return await self._execute(job)
+        if key in self._by_key:
+            return await asyncio.shield(self._by_key[key].future)
+
+        ticket = _Ticket(key, job, asyncio.get_running_loop().create_future(), on_position)
+        self._waiting.append(ticket)
+        self._by_key[key] = ticket
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._work())
+        if self._updater is None:
+            self._updater = asyncio.create_task(self._update_positions())
+        logger.info(f"Выдача для {key} поставлена в очередь, место #{len(self._waiting)}.")
+        await self._show_position(ticket, len(self._waiting))
+        return await ticket.future
+
+    async def _execute(self, job: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполняет выдачу; место (self._running) занимает вызывающий."""
+        try:
+            return await job()
+        finally:
+            self._running -= 1
+            if self._finished is not None:
+                self._finished.set()
+
+    async def _run_ticket(self, ticket: _Ticket):
+        try:
+            result = await self._execute(ticket.job)
+        except Exception as e:
+            if not ticket.future.done():
+                ticket.future.set_exception(e)
+        else:
+            if not ticket.future.done():
+                ticket.future.set_result(result)
+
+    async def _work(self):
+        self._finished = asyncio.Event()
+        try:
+            while self._waiting:
+                if self._running >= self._max_concurrent():
+                    self._finished.clear()
+                    await self._finished.wait()
+                    continue
+                # Ушедших из очереди (обработчик отменён) снимаем до взятия токена, чтобы они не тратили темп выдачи
+                if self._pop_done_head():
+                    continue
+                await self._bucket.acquire(self._rate())
+                # Пока ждали токен, начало очереди могло уйти — токен достаётся следующей живой заявке
+                self._pop_done_head()
+                if not self._waiting:
+                    break
+                ticket = self._waiting.popleft()
+                if self._by_key.get(ticket.key) is ticket:
+                    del self._by_key[ticket.key]
+                self._running += 1
+                asyncio.create_task(self._run_ticket(ticket))
+        finally:
+            self._worker = None
+
+    def _pop_done_head(self) -> bool:
+        """Снимает с начала очереди завершённые (отменённые) заявки. Возвращает True, если что-то снято."""
+        popped = False
+        while self._waiting and self._waiting[0].future.done():
+            ticket = self._waiting.popleft()
+            if self._by_key.get(ticket.key) is ticket:
+                del self._by_key[ticket.key]
+            popped = True
+        return popped
+
+    async def _show_position(self, ticket: _Ticket, position: int) -> bool:
+        if ticket.on_position is None:
+            return True
+        try:
+            await ticket.on_position(position)
+        except Exception as e:
+            logger.debug(f"Не удалось показать место в очереди для {ticket.key}: {e}")
+            return False
+        ticket.shown_position = position
+        return True
+
+    async def _update_positions(self):
+        """Обновляет сообщения с местом в очереди, начиная с ближайших к выдаче."""
+        try:
+            while self._waiting:
+                await asyncio.sleep(max(1, app_conf.get('admission_position_update_sec', 5)))
+                updated = 0
+                for position, ticket in enumerate(list(self._waiting), start=1):
+                    if updated >= POSITION_UPDATES_PER_TICK:
+                        break
+                    if ticket.shown_position == position or ticket.future.done():
+                        continue
+                    # Ошибка (в том числе лимит Telegram) — продолжим в следующий проход
+                    if not await self._show_position(ticket, position):
+                        break
+                    updated += 1
+        finally:
+            self._updater = None
+
+
+admission_queue = AdmissionQueue()
+server_rate_limiter = ServerRateLimiter()
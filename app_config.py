@@ -1,73 +1,271 @@
+import asyncio
 import json
-from typing import Any, Type, TypeVar
+from types import MappingProxyType
+from typing import Any, Callable, Dict, FrozenSet, List, Mapping, Optional, Tuple, Type, TypeVar
 from loguru import logger
 import db_helpers
 
 T = TypeVar('T')
 
+# Объявленные типы настроек; остальные настройки — строки.
+# Значения разбираются один раз при загрузке, списки и словари отдаются неизменяемыми.
+_SETTINGS_TYPES: Dict[str, type] = {
+    'admin_ids': list,
+    'subscription_days': int,
+    'subscription_price': float,
+    'trial_days': int,
+    'promo_code_subscription_days': int,
+    'bulk_grant_chunk_size': int,
+    'bulk_grant_poll_sec': int,
+    'xui_add_batch_max_size': int,
+    'xui_add_batch_window_ms': int,
+    'xui_gc_grace_days': int,
+    'xui_gc_interval_hours': int,
+    'traffic_collect_interval_sec': int,
+    'traffic_raw_retention_hours': int,
+    'traffic_hourly_retention_days': int,
+    'traffic_daily_retention_days': int,
+    'server_load_refresh_sec': int,
+    'server_metrics_interval_sec': int,
+    'server_metrics_deadline_sec': int,
+    'server_metrics_history_size': int,
+    'placement_live_load_factor': float,
+    'placement_max_load_percent': float,
+    'rebalance_interval_min': int,
+    'rebalance_moves_per_hour': int,
+    'rebalance_notify_batch_size': int,
+    'rebalance_tolerance_percent': float,
+    'drain_moves_per_hour': int,
+    'sub_server_port': int,
+    'sub_update_interval_hours': int,
+    'secondary_servers_count': int,
+    'secondary_sync_interval_sec': int,
+    'client_pool_size': int,
+    'client_pool_refill_sec': int,
+    'client_pool_refill_batch': int,
+    'admission_rate_per_min': int,
+    'admission_server_rate_per_min': int,
+    'admission_max_concurrent': int,
+    'admission_position_update_sec': int,
+    'settings_watch_interval_sec': int,
+    'warm_state_save_interval_sec': int,
+}
+
+# Маркеры снимка: настройки нет / значение не приводится к запрошенному типу
+_MISSING = object()
+_INVALID = object()
+
+
+def _parse(value_str: str, target_type: type) -> Any:
+    if target_type == bool:
+        return value_str.lower() in ('true', '1', 't', 'y', 'yes')
+    if target_type == int:
+        return int(value_str)
+    if target_type == float:
+        return float(value_str)
+    if target_type in (list, dict):
+        # Для сложных типов, таких как списки серверов, ожидаем JSON-строку
+        return _freeze(json.loads(value_str))
+    return value_str  # Для str и других типов
+
+
+class _SettingsSnapshot:
+    """
+    Неизменяемый снимок настроек одной загрузки: строки из БД (с дополнением из _DEFAULT_SETTINGS),
+    значения, разобранные по объявленным типам, реестр серверов и версия настроек в БД.
+    """
+    __slots__ = ('raw', 'values', 'servers_raw', 'servers', 'servers_by_id', 'version', 'loaded', '_derived')
+
+    def __init__(self, raw: Mapping[str, str], values: Mapping[Tuple[str, type], Any], servers_raw: Optional[str],
+                 servers: Tuple[Mapping[str, Any], ...], servers_by_id: Mapping[Any, Mapping[str, Any]],
+                 version: Optional[int], loaded: bool):
+        self.raw = raw
+        self.values = values
+        self.servers_raw = servers_raw
+        self.servers = servers
+        self.servers_by_id = servers_by_id
+        self.version = version
+        self.loaded = loaded
+        # Запросы с необъявленным типом и отсутствующие ключи: разбираются (и предупреждают) один раз на снимок
+        self._derived: Dict[Tuple[str, type], Any] = {}
+
+    def derive(self, key: str, target_type: type) -> Any:
+        cache_key = (key, target_type)
+        if cache_key in self._derived:
+            return self._derived[cache_key]
+        value_str = self.raw.get(key)
+        if value_str is None:
+            # Предупреждаем только если настройки уже загружены
+            if self.loaded:
+                logger.warning(f"Настройка '{key}' не найдена. Используется значение по умолчанию из кода.")
+            value = _MISSING
+        else:
+            try:
+                value = _parse(value_str, target_type)
+            except (ValueError, TypeError, json.JSONDecodeError) as e:
+                logger.error(f"Ошибка приведения типа для ключа '{key}' (значение: '{value_str}') к типу {target_type}. "
+                             f"Ошибка: {e}. Используется значение по умолчанию из кода.")
+                value = _INVALID
+        self._derived[cache_key] = value
+        return value
+
+
 class SettingsManager:
     """
     Менеджер настроек, который загружает конфигурацию из базы данных в кэш.
     """
     def __init__(self):
-        self._settings_cache = {}
+        self._snapshot = _SettingsSnapshot(MappingProxyType({}), MappingProxyType({}), None, (), MappingProxyType({}),
+                                           version=None, loaded=False)
+        # Обработчики изменения настроек: получают множество изменившихся ключей
+        self._reload_listeners: List[Callable[[FrozenSet[str]], None]] = []
         logger.info("Менеджер настроек инициализирован.")
 
     async def load_settings(self):
-        """Загружает или перезагружает все настройки из базы данных."""
+        """
+        Загружает или перезагружает все настройки из базы данных. Новый снимок собирается целиком
+        и подменяет старый одним присваиванием: читатели видят либо старые настройки, либо новые.
+        """
         logger.info("Загрузка/перезагрузка настроек из базы данных...")
         try:
+            # Версию читаем до самих настроек: запись между запросами лишь повторно применится при следующей проверке
+            version, _ = await db_helpers.get_settings_version()
             settings_from_db = await db_helpers.load_all_settings()
-            self._settings_cache = settings_from_db
-            logger.success(f"Успешно загружено {len(self._settings_cache)} настроек.")
         except Exception as e:
             logger.error(f"Не удалось загрузить настройки из БД: {e}")
-            # В случае ошибки не очищаем старый кэш, чтобы бот мог продолжить работу
+            # В случае ошибки не трогаем старый снимок, чтобы бот мог продолжить работу
             # на старых настройках, если они были загружены ранее.
+            return
+        raw = {key: str(value) for key, (value, _) in db_helpers._DEFAULT_SETTINGS.items()}
+        raw.update(settings_from_db)
+        self._apply(self._build_snapshot(raw, version))
+        logger.success(f"Успешно загружено {len(settings_from_db)} настроек.")
 
-    def get(self, key: str, default: T = None) -> T:
+    async def reload_if_changed(self) -> bool:
         """
-        Получает значение настройки из кэша.
-        Выполняет приведение типов на основе типа значения по умолчанию.
+        Применяет настройки, изменённые в БД после загрузки снимка (ботом, веб-админкой, скриптами):
+        перечитываются и разбираются только изменившиеся ключи. Полная перезагрузка — только
+        после удаления настройки. Возвращает True, если версия настроек сменилась.
         """
-        value_str = self._settings_cache.get(key)
+        snapshot = self._snapshot
+        version, full_reload_version = await db_helpers.get_settings_version()
+        if version == snapshot.version:
+            return False
+        if snapshot.version is None or version < snapshot.version or full_reload_version > snapshot.version:
+            await self.load_settings()
+            return True
+        changed = await db_helpers.load_settings_changed_since(snapshot.version)
+        raw = dict(snapshot.raw)
+        raw.update(changed)
+        self._apply(self._build_snapshot(raw, version))
+        return True
 
-        # Если значение — кортеж (например, (текст, описание)), берем только текст
-        if isinstance(value_str, tuple):
-            value_str = value_str[0]
+    @property
+    def version(self) -> Optional[int]:
+        """Версия настроек в БД, с которой загружен текущий снимок (None — ещё не загружен)."""
+        return self._snapshot.version
 
-        if value_str is None:
-            # Предупреждаем только если кэш не пустой (настройки уже загружены)
-            if self._settings_cache:
-                logger.warning(f"Настройка '{key}' не найдена в кэше. Используется значение по умолчанию: {default}")
-            return default
+    def add_reload_listener(self, listener: Callable[[FrozenSet[str]], None]):
+        """Регистрирует обработчик, который пересобирает производные от настроек кэши при их изменении."""
+        self._reload_listeners.append(listener)
 
-        if default is None:
-            return value_str
+    def _apply(self, snapshot: _SettingsSnapshot):
+        """Подменяет снимок и сообщает обработчикам, какие ключи изменились."""
+        previous = self._snapshot
+        self._snapshot = snapshot
+        changed = frozenset(key for key in previous.raw.keys() | snapshot.raw.keys()
+                            if previous.raw.get(key) != snapshot.raw.get(key))
+        if not changed:
+            return
+        if previous.loaded:
+            logger.info(f"Изменились настройки: {', '.join(sorted(changed))}")
+        for listener in self._reload_listeners:
+            try:
+                listener(changed)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика изменения настроек {listener}: {e}")
 
-        target_type = type(default)
+    def _build_snapshot(self, raw: Dict[str, str], version: int) -> _SettingsSnapshot:
+        previous = self._snapshot
+        values = {}
+        for key, value_str in raw.items():
+            target_type = _SETTINGS_TYPES.get(key, str)
+            if previous.raw.get(key) == value_str and (key, target_type) in previous.values:
+                # Значение не менялось — повторно не разбираем
+                values[(key, target_type)] = previous.values[(key, target_type)]
+                continue
+            try:
+                values[(key, target_type)] = _parse(value_str, target_type)
+            except (ValueError, TypeError, json.JSONDecodeError) as e:
+                default = db_helpers._DEFAULT_SETTINGS.get(key)
+                logger.error(f"Ошибка приведения типа для ключа '{key}' (значение: '{value_str}') к типу {target_type}. "
+                             f"Ошибка: {e}. Используется значение по умолчанию.")
+                try:
+                    values[(key, target_type)] = _parse(str(default[0]), target_type) if default else _INVALID
+                except (ValueError, TypeError, json.JSONDecodeError):
+                    values[(key, target_type)] = _INVALID
 
-        try:
-            if target_type == bool:
-                return value_str.lower() in ('true', '1', 't', 'y', 'yes')
-            if target_type == int:
-                return int(value_str)
-            if target_type == float:
-                return float(value_str)
-            if target_type in (list, dict):
-                # Для сложных типов, таких как списки серверов, ожидаем JSON-строку
-                return json.loads(value_str)
-            return value_str # Для str и других типов
-        except (ValueError, TypeError, json.JSONDecodeError) as e:
-            logger.error(f"Ошибка приведения типа для ключа '{key}' (значение: '{value_str}') к типу {target_type}. "
-                         f"Ошибка: {e}. Используется значение по умолчанию: {default}")
+        servers_raw = raw.get('xui_servers')
+        if servers_raw == previous.servers_raw:
+            # Список серверов не менялся — реестр (и его неизменяемые записи) остаётся прежним
+            servers, servers_by_id = previous.servers, previous.servers_by_id
+        else:
+            try:
+                servers = tuple(_freeze(server) for server in (json.loads(servers_raw) if servers_raw else []))
+            except (TypeError, json.JSONDecodeError) as e:
+                logger.error(f"Не удалось разобрать настройку 'xui_servers': {e}. Список серверов пуст.")
+                servers = ()
+            servers_by_id = MappingProxyType({server['id']: server for server in servers if 'id' in server})
+        return _SettingsSnapshot(MappingProxyType(raw), MappingProxyType(values), servers_raw,
+                                 servers, servers_by_id, version=version, loaded=True)
+
+    def get(self, key: str, default: T = None) -> T:
+        """
+        Получает значение настройки из снимка.
+        Тип определяется типом значения по умолчанию; настройки объявленных типов
+        разобраны при загрузке, поэтому чтение — один поиск в словаре.
+        """
+        snapshot = self._snapshot
+        target_type = str if default is None else type(default)
+        value = snapshot.values.get((key, target_type), _MISSING)
+        if value is _MISSING:
+            value = snapshot.derive(key, target_type)
+        if value is _MISSING or value is _INVALID:
             return default
+        return value
+
+    def get_servers(self) -> Tuple[Mapping[str, Any], ...]:
+        """
+        Серверы X-UI из настройки xui_servers. Список разбирается один раз на значение настройки
+        и неизменяем: параметры конкретного вызова передаются аргументами, а не дописываются в конфиг.
+        """
+        return self._snapshot.servers
+
+    def get_server(self, server_id: Any) -> Optional[Mapping[str, Any]]:
+        """Конфигурация сервера по id без перебора списка."""
+        return self._snapshot.servers_by_id.get(server_id)
+
+
+def _freeze(value: Any) -> Any:
+    """Неизменяемая копия JSON-значения: словари — MappingProxyType, списки — кортежи."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
 
 # Создаем единый экземпляр менеджера настроек для всего приложения
 app_conf = SettingsManager()
 
-# Добавляем новые настройки по умолчанию
-app_conf._settings_cache['text_subscription_expiring'] = (
-    '⏰ Ваша подписка заканчивается завтра! Не забудьте продлить, чтобы не потерять доступ.',
-    'Напоминание о скором завершении подписки'
-) 
\ No newline at end of file
+
+async def run_settings_watcher():
+    """
+    Бесконечный цикл проверки версии настроек в БД; запускается из main.py как фоновая задача.
+    Проверка — чтение одной строки, настройки перечитываются только при смене версии.
+    """
+    while True:
+        await asyncio.sleep(max(1, app_conf.get('settings_watch_interval_sec', 5)))
+        try:
+            await app_conf.reload_if_changed()
+        except Exception as e:
+            logger.error(f"Ошибка при проверке изменений настроек: {e}")
@@ -0,0 +1,216 @@
+# bulk_grant.py
+"""
+Массовое начисление дней подписки: кампании, компенсации за простой.
+
+Задание создаётся на набор пользователей, заданный SQL-условием по таблице users
+(или готовым фильтром из BULK_GRANT_FILTERS); состав фиксируется в bulk_grant_items
+в момент создания. Фоновый обработчик группирует пользователей по (сервер, inbound) и на
+каждую пачку из bulk_grant_chunk_size клиентов делает одно чтение inbound, а продлевает клиентов
+отдельными запросами clients/update (несколько одновременно): панель меняет только продлеваемого
+клиента, и записи других обработчиков в тот же inbound не откатываются. Пачка обрабатывается в очереди
+операций её пользователей (run_users_operation): их выдачи, продления и переносы ждут её окончания.
+
+Новые даты окончания пачки пишутся в БД одной транзакцией вместе с отметками в bulk_grant_items
+и счётчиками задания, поэтому прерванное задание продолжается с необработанных пользователей.
+Новая дата считается от даты окончания в БД, так что повтор пачки, уже применённой в панели,
+но не записанной в БД, не продлевает подписку дважды. Дата пишется, только если в БД всё ещё
+та дата окончания, от которой она посчитана.
+
+Клиентов, которых нет в inbound (удалены сборщиком мусора и т.п.), и пользователей, чья подписка
+изменилась после выборки (продление, в том числе из веб-админки), продлевает обычная выдача
+grant_subscription — она считает срок от текущей даты и пересоздаёт пропавшего клиента с тем же UUID.
+"""
+import asyncio
+import sqlite3
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from app_config import app_conf
+import db_helpers
+from server_load import server_load_table
+from subscription_manager import grant_subscription, run_users_operation
+from x_ui_manager import xui_manager_instance, get_inbound_ids
+
+# Готовые фильтры пользователей; всё остальное считается SQL-условием по таблице users
+BULK_GRANT_FILTERS = {
+    'active': "strftime('%s', subscription_end_date) > strftime('%s', 'now')",
+    'expired': "strftime('%s', subscription_end_date) <= strftime('%s', 'now')",
+    'all': "1 = 1",
+}
+
+# Будит обработчик, когда задание создано в этом же процессе (веб-админка полагается на опрос)
+_wakeup: Optional[asyncio.Event] = None
+
+
+def resolve_user_filter(user_filter: str) -> str:
+    """
+    SQL-условие для фильтра: готовый фильтр, 'failed:<id>' (неудачные пользователи задания <id>)
+    или условие по таблице users как есть, например "current_server_id = 2".
+    """
+    user_filter = (user_filter or '').strip()
+    if user_filter in BULK_GRANT_FILTERS:
+        return BULK_GRANT_FILTERS[user_filter]
+    if user_filter.startswith('failed:'):
+        try:
+            job_id = int(user_filter.split(':', 1)[1])
+        except ValueError:
+            raise ValueError(f"Неверный номер задания в фильтре '{user_filter}'")
+        return f"telegram_id IN (SELECT telegram_id FROM bulk_grant_items WHERE job_id = {job_id} AND status = 'failed')"
+    if not user_filter or ';' in user_filter:
+        raise ValueError("Фильтр пользователей должен быть одним SQL-условием по таблице users")
+    return user_filter
+
+
+async def create_job(days: int, user_filter: str, comment: Optional[str] = None) -> tuple:
+    """Создаёт задание и возвращает (id, число пользователей). Неверный фильтр — ValueError."""
+    if days <= 0:
+        raise ValueError("Количество дней должно быть больше нуля")
+    where_sql = resolve_user_filter(user_filter)
+    try:
+        job_id, total = await db_helpers.create_bulk_grant_job(days, user_filter, where_sql, comment)
+    except sqlite3.Error as e:
+        raise ValueError(f"Ошибка в фильтре пользователей: {e}")
+    logger.info(f"Создано задание массового начисления #{job_id}: +{days} дн., фильтр '{user_filter}', пользователей {total}.")
+    if _wakeup is not None:
+        _wakeup.set()
+    return job_id, total
+
+
+async def cancel_job(job_id: int) -> bool:
+    """Отменяет задание; уже продлённые пользователи остаются продлёнными."""
+    return await db_helpers.set_bulk_grant_job_status(job_id, 'canceled')
+
+
+def _new_end_date(current_end: Optional[str], days: int, now: datetime) -> datetime:
+    """Дата окончания после начисления: от текущей даты окончания, а если она прошла — от сейчас."""
+    base = now
+    if current_end:
+        try:
+            end = datetime.fromisoformat(current_end)
+            if end.tzinfo is None:
+                end = end.astimezone()
+            base = max(end, now)
+        except ValueError:
+            pass
+    return base + timedelta(days=days)
+
+
+async def _apply_chunk(job_id: int, server_conf: Dict, inbound_id: int, chunk: Dict[str, int],
+                       by_uuid: Dict[str, Dict], targets: Dict[str, datetime]) -> Optional[List[Dict]]:
+    """
+    Продлевает одну пачку в панели и в БД. Возвращает пользователей, которых нужно продлить
+    через grant_subscription (клиента нет в inbound или подписка изменилась), или None, если inbound недоступен.
+    Клиенты, продление которых панель не приняла, отмечаются неудачными.
+    """
+    regrant, handled = [], set()
+
+    async def on_chunk(applied_chunk: Dict[str, int], missing: set):
+        done = [(by_uuid[client_uuid]['telegram_id'], targets[client_uuid], by_uuid[client_uuid]['subscription_end_date'])
+                for client_uuid in applied_chunk if client_uuid not in missing]
+        conflicted = set(await db_helpers.apply_bulk_grant_chunk(job_id, done, []))
+        handled.update(applied_chunk)
+        for client_uuid in applied_chunk:
+            item = by_uuid[client_uuid]
+            if client_uuid in missing or item['telegram_id'] in conflicted:
+                regrant.append(item)
+            else:
+                server_load_table.record_grant(server_conf['id'], targets[client_uuid], old_server_id=server_conf['id'],
+                                               old_expiry=item['subscription_end_date'])
+
+    if not await xui_manager_instance.set_clients_expiry_bulk(server_conf, inbound_id, [chunk], on_chunk) and not handled:
+        return None
+    not_applied = [(by_uuid[client_uuid]['telegram_id'], 'панель не приняла продление') for client_uuid in chunk if client_uuid not in handled]
+    if not_applied:
+        await db_helpers.apply_bulk_grant_chunk(job_id, [], not_applied)
+    return regrant
+
+
+async def _process_group(job: Dict, server_conf: Dict, inbound_id: int, items: List[Dict], chunk_size: int) -> bool:
+    """Продлевает одну группу (сервер, inbound). Возвращает False, если задание отменили."""
+    job_id, days = job['id'], job['days']
+    now = datetime.now(timezone.utc)
+    by_uuid = {item['xui_client_uuid']: item for item in items}
+    targets = {client_uuid: _new_end_date(item['subscription_end_date'], days, now) for client_uuid, item in by_uuid.items()}
+    client_uuids = list(targets)
+    regrant_items = []
+
+    for start in range(0, len(client_uuids), chunk_size):
+        chunk = {client_uuid: int(targets[client_uuid].timestamp() * 1000) for client_uuid in client_uuids[start:start + chunk_size]}
+        regrant = await run_users_operation(
+            [by_uuid[client_uuid]['telegram_id'] for client_uuid in chunk],
+            _apply_chunk, job_id, server_conf, inbound_id, chunk, by_uuid, targets
+        )
+        if regrant is None:
+            logger.warning(f"Задание #{job_id}: inbound {inbound_id} сервера {server_conf['name']} недоступен, "
+                           f"{len(client_uuids) - start} пользователей отмечены как неудачные.")
+            await db_helpers.apply_bulk_grant_chunk(
+                job_id, [], [(by_uuid[client_uuid]['telegram_id'], 'панель недоступна') for client_uuid in client_uuids[start:]]
+            )
+            break
+        regrant_items.extend(regrant)
+        current = await db_helpers.get_bulk_grant_job(job_id)
+        if not current or current['status'] == 'canceled':
+            return False
+
+    for item in regrant_items:
+        result = await grant_subscription(item['telegram_id'], days, limit_ip=item['limit_ip'] or 0, request_key=f"bulk:{job_id}")
+        if result:
+            await db_helpers.apply_bulk_grant_chunk(job_id, [], [], granted=[(item['telegram_id'], result['expiry_date'])])
+        else:
+            await db_helpers.apply_bulk_grant_chunk(job_id, [], [(item['telegram_id'], 'продлить обычной выдачей не удалось')])
+    return True
+
+
+async def run_job(job_id: int):
+    """Обрабатывает (или продолжает после перезапуска) задание до конца или до отмены."""
+    job = await db_helpers.get_bulk_grant_job(job_id)
+    if not job or job['status'] not in ('pending', 'running'):
+        return
+    await db_helpers.set_bulk_grant_job_status(job_id, 'running')
+    chunk_size = max(1, app_conf.get('bulk_grant_chunk_size', 200))
+
+    groups: Dict[tuple, List[Dict]] = defaultdict(list)
+    no_subscription = []
+    for item in await db_helpers.get_pending_bulk_grant_items(job_id):
+        if not item['xui_client_uuid'] or not item['current_server_id']:
+            no_subscription.append((item['telegram_id'], 'нет подписки'))
+        else:
+            groups[(item['current_server_id'], item['current_inbound_id'])].append(item)
+    if no_subscription:
+        await db_helpers.apply_bulk_grant_chunk(job_id, [], no_subscription)
+
+    for (server_id, inbound_id), items in groups.items():
+        server_conf = await db_helpers.get_server_config(server_id)
+        if not server_conf:
+            await db_helpers.apply_bulk_grant_chunk(job_id, [], [(item['telegram_id'], 'сервер не найден') for item in items])
+            continue
+        # Записи без inbound созданы до появления нескольких inbounds и лежат в основном
+        if not await _process_group(job, server_conf, inbound_id or get_inbound_ids(server_conf)[0], items, chunk_size):
+            logger.info(f"Задание массового начисления #{job_id} отменено.")
+            return
+
+    await db_helpers.set_bulk_grant_job_status(job_id, 'done', from_statuses=('running',))
+    job = await db_helpers.get_bulk_grant_job(job_id)
+    logger.info(f"Задание массового начисления #{job_id} завершено: продлено {job['processed']}, ошибок {job['failed']} из {job['total']}.")
+
+
+async def run_bulk_grant_worker():
+    """Фоновый обработчик заданий (в том числе прерванных перезапуском); запускается из main.py."""
+    global _wakeup
+    _wakeup = asyncio.Event()
+    while True:
+        try:
+            job = await db_helpers.get_next_bulk_grant_job()
+            if job:
+                await run_job(job['id'])
+                continue
+        except Exception as e:
+            logger.error(f"Ошибка в обработчике массовых начислений: {e}")
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=max(1, app_conf.get('bulk_grant_poll_sec', 10)))
+        except asyncio.TimeoutError:
+            pass
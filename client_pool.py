@@ -0,0 +1,163 @@
+# client_pool.py
+"""
+Пул заранее созданных клиентов X-UI для мгновенной выдачи новых подписок.
+
+Новая подписка (в первую очередь пробная из /start) раньше ждала создания клиента в панели
+(поиск inbound, addClient), а при наплыве регистраций — очереди таких запросов. Теперь на каждом
+сервере, принимающем новые подписки, держится client_pool_size выключенных клиентов без срока.
+Выдача забирает одного из них одним запросом к БД (db_helpers.claim_pool_client) и включает
+его одним обновлением клиента с нужным сроком и tgId пользователя (email клиента пула остаётся
+прежним: панель ищет обновляемого клиента по email); если пул сервера пуст
+или панель не приняла обновление, подписка создаётся как раньше.
+
+Пул пополняется фоновой задачей раз в client_pool_refill_sec: не больше client_pool_refill_batch
+клиентов на сервер за проход, одним запросом addClient, — нагрузка на панели ровная, а не всплесками.
+Клиенты сначала записываются в БД со статусом 'creating' и становятся 'ready' после ответа панели;
+незавершённые записи (перезапуск, ошибка сети) сверяются с inbound на следующем проходе.
+С серверов, которые перестали принимать новые подписки (exclude_from_auto, drain, удалены из
+настроек), и сверх client_pool_size клиенты пула удаляются: запись сначала переводится
+из 'ready' в 'removing' (клиента, которого выдача уже забрала, это не затрагивает), а удаляется
+после того, как клиента нет в панели. Туда же, в 'removing', попадает клиент, которого
+не удалось включить при выдаче, — иначе он остался бы в панели без учёта.
+"""
+import asyncio
+import random
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Mapping, Optional
+
+from loguru import logger
+
+from app_config import app_conf
+import db_helpers
+from x_ui_manager import xui_manager_instance
+
+_SUFFIX_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+
+def _random_suffix() -> str:
+    return ''.join(random.choices(_SUFFIX_CHARS, k=6))
+
+
+def _accepts_new_subscriptions(server_conf: Mapping) -> bool:
+    return not server_conf.get('exclude_from_auto') and not server_conf.get('drain')
+
+
+async def claim_client(server_conf: Mapping, telegram_id: int, days_valid: int, limit_ip: int = 0) -> Optional[Dict]:
+    """
+    Выдаёт пользователю клиента из пула сервера. Возвращает данные клиента в том же виде,
+    что и XUIManager.create_xui_user, или None, если пул пуст или панель не включила клиента.
+    """
+    entry = await db_helpers.claim_pool_client(server_conf['id'])
+    if not entry:
+        return None
+    expiry_timestamp_ms = int((datetime.now(timezone.utc) + timedelta(days=days_valid)).timestamp() * 1000)
+    if not await xui_manager_instance.activate_pool_client(
+        server_conf, entry['inbound_id'], entry['client_uuid'], entry['email'], telegram_id, expiry_timestamp_ms, limit_ip
+    ):
+        # В пул не возвращаем — неизвестно, применилось ли обновление; клиента удалит следующий проход пополнения
+        logger.warning(f"Пул клиентов: не удалось выдать клиента {entry['client_uuid']} сервера {server_conf['name']} пользователю {telegram_id}.")
+        await db_helpers.add_client_pool_entries(
+            server_conf['id'], entry['inbound_id'], [{'uuid': entry['client_uuid'], 'email': entry['email']}], status='removing'
+        )
+        return None
+    logger.info(f"Пользователю {telegram_id} выдан клиент из пула сервера {server_conf['name']} (UUID: {entry['client_uuid']}).")
+    return {
+        "uuid": entry['client_uuid'],
+        "email": entry['email'],
+        "expiry_timestamp_ms": expiry_timestamp_ms,
+        "server_id": server_conf['id'],
+        "inbound_id": entry['inbound_id'],
+    }
+
+
+async def _remove_entries(entries: List[Dict]) -> int:
+    """Удаляет из панелей и из БД клиентов пула, отмеченных 'removing'."""
+    by_inbound: Dict[tuple, List[Dict]] = defaultdict(list)
+    for entry in entries:
+        by_inbound[(entry['server_id'], entry['inbound_id'])].append(entry)
+    removed = []
+    for (server_id, inbound_id), group in by_inbound.items():
+        server_conf = app_conf.get_server(server_id)
+        if server_conf is None:
+            removed.extend(e['client_uuid'] for e in group)
+            continue
+        # Клиентов, которых в inbound уже нет, remove_clients_one_by_one тоже возвращает; не снятые остаются 'removing'
+        gone = await xui_manager_instance.remove_clients_one_by_one(server_conf, inbound_id, [e['client_uuid'] for e in group])
+        if gone:
+            removed.extend(e['client_uuid'] for e in group if e['client_uuid'] in gone)
+    if removed:
+        await db_helpers.delete_client_pool_entries(removed)
+    return len(removed)
+
+
+async def _recover_creating():
+    """Сверяет с inbound клиентов, для которых не дождались ответа панели: есть — готовы, нет — удаляются."""
+    by_inbound: Dict[tuple, List[Dict]] = defaultdict(list)
+    for entry in await db_helpers.get_client_pool_entries(status='creating'):
+        by_inbound[(entry['server_id'], entry['inbound_id'])].append(entry)
+    for (server_id, inbound_id), group in by_inbound.items():
+        server_conf = app_conf.get_server(server_id)
+        present = await xui_manager_instance.get_inbound_client_ids(server_conf, inbound_id) if server_conf else set()
+        if present is None:
+            continue
+        await db_helpers.set_client_pool_ready([e['client_uuid'] for e in group if e['client_uuid'] in present])
+        await db_helpers.delete_client_pool_entries([e['client_uuid'] for e in group if e['client_uuid'] not in present])
+
+
+async def _refill_server(server_conf: Mapping, count: int) -> int:
+    inbound_id = await xui_manager_instance.choose_inbound(server_conf)
+    domain = app_conf.get('email_domain', 'vpn.bot')
+    clients = [{'uuid': str(uuid.uuid4()), 'email': f"pool_{_random_suffix()}{_random_suffix()}@{domain}"} for _ in range(count)]
+    await db_helpers.add_client_pool_entries(server_conf['id'], inbound_id, clients)
+    if not await xui_manager_instance.create_pool_clients(server_conf, inbound_id, clients):
+        # Записи остаются 'creating': следующий проход сверит их с inbound
+        return 0
+    await db_helpers.set_client_pool_ready([client['uuid'] for client in clients])
+    return count
+
+
+async def refill_once() -> Dict[str, int]:
+    """Один проход пополнения пула."""
+    stats = {'created': 0, 'removed': 0}
+    await _recover_creating()
+    pool_size = max(0, app_conf.get('client_pool_size', 0))
+    batch = max(1, app_conf.get('client_pool_refill_batch', 50))
+    servers = {server_conf['id']: server_conf for server_conf in app_conf.get_servers() if _accepts_new_subscriptions(server_conf)}
+    counts = await db_helpers.get_client_pool_counts()
+
+    # Лишние: на серверах, не принимающих новые подписки, и сверх размера пула
+    excess = []
+    for server_id, server_counts in counts.items():
+        limit = pool_size if server_id in servers else 0
+        if server_counts.get('ready', 0) > limit:
+            excess.extend(await db_helpers.get_client_pool_entries(
+                status='ready', server_id=server_id, limit=server_counts['ready'] - limit
+            ))
+    if excess:
+        await db_helpers.mark_client_pool_removing([e['client_uuid'] for e in excess])
+    # Вместе с ними — не снятые в прошлые проходы и не включившиеся при выдаче
+    to_remove = await db_helpers.get_client_pool_entries(status='removing')
+    if to_remove:
+        stats['removed'] = await _remove_entries(to_remove)
+
+    for server_id, server_conf in servers.items():
+        server_counts = counts.get(server_id, {})
+        missing = pool_size - server_counts.get('ready', 0) - server_counts.get('creating', 0)
+        if missing > 0:
+            stats['created'] += await _refill_server(server_conf, min(missing, batch))
+
+    if any(stats.values()):
+        logger.info(f"Пул клиентов: создано {stats['created']}, удалено {stats['removed']}.")
+    return stats
+
+
+async def run_client_pool_refill():
+    """Бесконечный цикл пополнения пула; запускается из main.py как фоновая задача."""
+    while True:
+        try:
+            await refill_once()
+        except Exception as e:
+            logger.error(f"Глобальная ошибка в задаче пополнения пула клиентов: {e}")
+        await asyncio.sleep(max(5, app_conf.get('client_pool_refill_sec', 30)))
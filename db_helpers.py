@@ -1,8 +1,11 @@
 # db_helpers.py
+import asyncio
 import aiosqlite
+import hashlib
 from datetime import datetime, timedelta, timezone
 import json
-from typing import Optional, List, Dict
+import secrets
+from typing import Optional, List, Dict, Mapping, Tuple
 from loguru import logger
 
 from config import DATABASE_NAME
@@ -80,6 +83,11 @@ _DEFAULT_SETTINGS = {
         "Выберите в инструкции ваше устройство 📱Android или 🍎iOS",
         'Сообщение об успешном создании триала. Переменные: {days}, {sub_link}, {expiry_date}'
     ),
+    'text_trial_queue_position': (
+        "⏳ Сейчас много желающих получить пробный период. Вы <b>#{position}</b> в очереди — "
+        "ссылка придёт в это сообщение, как только подойдёт ваша очередь.",
+        'Сообщение о месте в очереди на пробный период (обновляется по мере продвижения). Переменные: {position}'
+    ),
     'text_android_guide': (
         "📱 Инструкция по подключению для Android:\n\n"
         "1. Скачайте приложение V2rayTun из Google Play.\n"
@@ -141,6 +149,11 @@ _DEFAULT_SETTINGS = {
     # --- Тексты: Уведомления ---
     'text_subscription_expiring': ('⏰ Ваша подписка заканчивается завтра! Не забудьте продлить, чтобы не потерять доступ.', 'Напоминание за день до окончания подписки'),
     'text_subscription_expired': ('😔 Ваша подписка истекла. Чтобы возобновить доступ, пожалуйста, продлите ее.', 'Уведомление после истечения срока подписки'),
+    'text_server_moved': (
+        "🔄 Ваша подписка перенесена на другой сервер. Срок действия не изменился.\n\n"
+        "Обновите подписку в приложении по новой ссылке:\n<code>{sub_link}</code>",
+        'Уведомление о переносе подписки на другой сервер (балансировка, вывод сервера). {sub_link} — новая ссылка'
+    ),
     'text_subscription_expired_main': ('😔 Ваша подписка закончилась. Продлите её, чтобы восстановить доступ к VPN.', 'Текст на главном экране, когда подписка истекла'),
 
     # --- Ссылки на приложения ---
@@ -181,8 +194,77 @@ _DEFAULT_SETTINGS = {
     'step_guide_btn_ios': ('Скачать для 🍎iOS', 'Кнопка для скачивания iOS-приложения в пошаговой инструкции'),
     'step_guide_btn_next': ('➡️ Далее', 'Кнопка "Далее" в пошаговой инструкции'),
     'step_guide_btn_back': ('⬅️ На главную', 'Кнопка "На главную" в пошаговой инструкции'),
+
+    # --- Статистика трафика ---
+    'traffic_collect_interval_sec': ('300', 'Интервал опроса трафика клиентов в X-UI (секунды). Один запрос на inbound.'),
+    'traffic_raw_retention_hours': ('48', 'Сколько часов хранить сырые отсчёты трафика до свёртки в почасовые'),
+    'traffic_hourly_retention_days': ('30', 'Сколько дней хранить почасовую статистику трафика до свёртки в посуточную'),
+    'traffic_daily_retention_days': ('365', 'Сколько дней хранить посуточную статистику трафика (0 = бессрочно)'),
+
+    # --- Мониторинг серверов ---
+    'server_metrics_interval_sec': ('60', 'Интервал опроса состояния X-UI серверов (секунды). Админка читает последние замеры из БД.'),
+    'server_metrics_history_size': ('1440', 'Сколько последних замеров хранить на каждый сервер (кольцевой буфер)'),
+    'server_metrics_deadline_sec': ('8', 'Сколько секунд ждать ответа одного сервера при опросе. Серверы опрашиваются параллельно, медленный помечается как таймаут.'),
+    'server_load_refresh_sec': ('300', 'Как часто сверять таблицу загрузки серверов (для выбора сервера) с БД (секунды). Между сверками она обновляется на лету.'),
+    'placement_strategy': ('priority', 'Стратегия выбора сервера для новой подписки: priority, weighted, p2c, live_load (веса — поле weight в конфиге сервера)'),
+    'placement_live_load_factor': ('2', 'Для live_load: насколько сильно загрузка CPU/RAM сервера снижает его привлекательность'),
+    'placement_max_load_percent': ('90', 'Для live_load: серверы с CPU или RAM выше этого процента не получают новых клиентов, пока есть менее загруженные'),
+
+    # --- Выдача клиентов X-UI ---
+    'xui_add_batch_window_ms': ('200', 'Окно накопления одновременных добавлений клиентов в один inbound (мс). 0 — добавлять сразу по одному.'),
+    'xui_add_batch_max_size': ('50', 'Максимум клиентов в одном пакетном добавлении в X-UI'),
+    'xui_gc_grace_days': ('14', 'Через сколько дней после окончания подписки удалять клиента из inbound X-UI (0 — не удалять). При продлении клиент пересоздаётся.'),
+    'xui_gc_interval_hours': ('6', 'Как часто запускать удаление давно истёкших клиентов из X-UI (часы)'),
+
+    # --- Массовые начисления ---
+    'bulk_grant_chunk_size': ('200', 'Сколько клиентов продлевать за одну пачку (одно чтение inbound) при массовом начислении дней'),
+    'bulk_grant_poll_sec': ('10', 'Как часто проверять новые задания массового начисления, созданные из веб-админки (секунды)'),
+
+    # --- Балансировка серверов ---
+    'rebalance_moves_per_hour': ('0', 'Сколько пользователей в час переносить с перегруженных серверов на недогруженные (0 — балансировка выключена)'),
+    'rebalance_interval_min': ('10', 'Как часто пересчитывать целевую загрузку серверов и переносить очередную порцию пользователей (минуты)'),
+    'rebalance_tolerance_percent': ('10', 'На сколько процентов сервер может превышать целевую загрузку, прежде чем с него начнут переносить пользователей'),
+    'rebalance_notify_batch_size': ('30', 'Сколько уведомлений о новой ссылке отправлять за один проход балансировки'),
+    'drain_moves_per_hour': ('300', 'Сколько пользователей в час переносить с выводимых серверов (флаг drain в конфиге сервера)'),
+
+    # --- Собственная раздача подписок ---
+    'sub_public_url': ('', 'Внешний адрес раздачи подписок ботом, например https://sub.example.com (пусто — ссылки ведут прямо на панели)'),
+    'sub_server_host': ('0.0.0.0', 'Адрес, на котором бот слушает запросы подписок'),
+    'sub_server_port': ('0', 'Порт раздачи подписок ботом (0 — раздача выключена)'),
+    'sub_update_interval_hours': ('12', 'Как часто клиенту обновлять подписку (заголовок profile-update-interval, часы)'),
+
+    # --- Резервные серверы ---
+    'secondary_servers_count': ('0', 'Сколько резервных серверов выдавать каждой подписке в дополнение к основному (0 — выключено; нужны ссылки через бота, sub_public_url)'),
+    'secondary_sync_interval_sec': ('60', 'Как часто создавать и продлевать клиентов на резервных серверах пачками (секунды)'),
+
+    # --- Пул заранее созданных клиентов ---
+    'client_pool_size': ('0', 'Сколько заранее созданных выключенных клиентов держать на каждом сервере для мгновенной выдачи новых подписок (0 — пул выключен)'),
+    'client_pool_refill_sec': ('30', 'Как часто пополнять пул клиентов (секунды)'),
+    'client_pool_refill_batch': ('50', 'Сколько клиентов пула создавать на сервере за один проход (одним запросом к панели)'),
+
+    # --- Очередь выдачи пробных периодов ---
+    'admission_rate_per_min': ('120', 'Сколько пробных периодов в минуту выдавать всего; остальные ждут в очереди (0 — без ограничения)'),
+    'admission_server_rate_per_min': ('0', 'Сколько новых подписок в минуту создавать на одном сервере (0 — без ограничения)'),
+    'admission_max_concurrent': ('10', 'Сколько выдач из очереди выполнять одновременно'),
+    'admission_position_update_sec': ('5', 'Как часто обновлять у ожидающих сообщение с местом в очереди (секунды)'),
+
+    # --- Применение изменённых настроек ---
+    'settings_watch_interval_sec': ('5', 'Как часто бот проверяет, не изменились ли настройки в БД (веб-админкой), и применяет изменения (секунды)'),
+    'warm_state_save_interval_sec': ('300', 'Как часто записывать снимок кэшей (сессии панелей, параметры inbounds, загрузка серверов) для быстрого перезапуска (секунды, 0 — не записывать и не использовать)'),
 }
 
+def new_sub_token() -> str:
+    """Случайный токен постоянной ссылки на подписку."""
+    return secrets.token_urlsafe(16)
+
+async def _ensure_column(db, table: str, column: str, definition: str):
+    """Добавляет колонку в существующую таблицу, если её ещё нет (для баз, созданных старыми версиями)."""
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if column not in columns:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        logger.info(f"В таблицу {table} добавлена колонка {column}.")
+
 async def init_db():
     async with aiosqlite.connect(DATABASE_NAME) as db:
         # Основные таблицы
@@ -198,21 +280,38 @@ async def init_db():
                 notified_expiring INTEGER DEFAULT 0,
                 notified_expired INTEGER DEFAULT 0,
                 is_active INTEGER DEFAULT 1,
-                limit_ip INTEGER DEFAULT 0
+                limit_ip INTEGER DEFAULT 0,
+                xui_removed_at TEXT, -- когда клиент удалён из inbound сборщиком истёкших (данные в БД сохраняются)
+                current_inbound_id INTEGER, -- inbound на current_server_id; NULL — основной inbound сервера
+                sub_token TEXT -- постоянный токен ссылки на подписку, раздаваемую ботом
             )
         ''')
+        await _ensure_column(db, 'users', 'xui_removed_at', 'TEXT')
+        await _ensure_column(db, 'users', 'current_inbound_id', 'INTEGER')
+        await _ensure_column(db, 'users', 'sub_token', 'TEXT')
+        await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_sub_token ON users (sub_token)")
+        async with db.execute("SELECT telegram_id FROM users WHERE xui_client_uuid IS NOT NULL AND sub_token IS NULL") as cursor:
+            without_token = [row[0] for row in await cursor.fetchall()]
+        if without_token:
+            await db.executemany("UPDATE users SET sub_token = ? WHERE telegram_id = ?",
+                                 [(new_sub_token(), telegram_id) for telegram_id in without_token])
+            logger.info(f"Выданы токены ссылок на подписку {len(without_token)} пользователям.")
         await db.execute('''
             CREATE TABLE IF NOT EXISTS payments (
                 payment_id TEXT PRIMARY KEY,
                 telegram_id INTEGER,
                 amount REAL,
                 currency TEXT,
-                status TEXT DEFAULT 'pending', -- pending, succeeded, canceled
+                status TEXT DEFAULT 'pending', -- pending, processing, succeeded, failed, canceled
                 created_at TEXT,
                 metadata_json TEXT,
+                status_updated_at TEXT,
+                applied_at TEXT, -- когда подписка по платежу записана (в одной транзакции с датой окончания)
                 FOREIGN KEY (telegram_id) REFERENCES users (telegram_id)
             )
         ''')
+        await _ensure_column(db, 'payments', 'status_updated_at', 'TEXT')
+        await _ensure_column(db, 'payments', 'applied_at', 'TEXT')
         await db.execute('''
             CREATE TABLE IF NOT EXISTS promo_codes (
                 code TEXT PRIMARY KEY,
@@ -245,20 +344,182 @@ async def init_db():
                 created_at TEXT DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        # Последние абсолютные счётчики трафика клиентов X-UI (для вычисления дельт)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS traffic_counters (
+                server_id INTEGER NOT NULL,
+                email TEXT NOT NULL,
+                up INTEGER DEFAULT 0,
+                down INTEGER DEFAULT 0,
+                updated_at INTEGER,
+                PRIMARY KEY (server_id, email)
+            )
+        ''')
+        # Временной ряд потребления трафика: raw -> hour -> day
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS traffic_usage (
+                telegram_id INTEGER,
+                server_id INTEGER NOT NULL,
+                email TEXT NOT NULL,
+                resolution TEXT NOT NULL, -- raw, hour, day
+                bucket_ts INTEGER NOT NULL,
+                up INTEGER DEFAULT 0,
+                down INTEGER DEFAULT 0,
+                PRIMARY KEY (email, server_id, resolution, bucket_ts)
+            ) WITHOUT ROWID
+        ''')
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_traffic_usage_user ON traffic_usage (telegram_id, bucket_ts)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_traffic_usage_resolution ON traffic_usage (resolution, bucket_ts)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_xui_email ON users (xui_client_email)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_xui_uuid ON users (xui_client_uuid)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_server_end ON users (current_server_id, subscription_end_date)")
+        # История состояния серверов (кольцевой буфер на сервер)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS server_metrics (
+                server_id INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                ok INTEGER NOT NULL,
+                cpu REAL,
+                mem REAL,
+                disk REAL,
+                active_clients INTEGER,
+                latency_ms INTEGER,
+                error TEXT, -- NULL, 'timeout', 'unavailable'
+                PRIMARY KEY (server_id, ts)
+            ) WITHOUT ROWID
+        ''')
+        await _ensure_column(db, 'server_metrics', 'error', 'TEXT')
+        # Массовые начисления дней (кампании, компенсации) и их пользователи
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS bulk_grant_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                days INTEGER NOT NULL,
+                user_filter TEXT NOT NULL,
+                comment TEXT,
+                status TEXT NOT NULL DEFAULT 'pending', -- pending, running, done, canceled
+                total INTEGER NOT NULL DEFAULT 0,
+                processed INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL,
+                updated_at TEXT
+            )
+        ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS bulk_grant_items (
+                job_id INTEGER NOT NULL,
+                telegram_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending', -- pending, done, failed
+                new_end_date TEXT,
+                error TEXT,
+                PRIMARY KEY (job_id, telegram_id)
+            ) WITHOUT ROWID
+        ''')
+        # Переносы пользователей балансировщиком: бюджет в час и очередь уведомлений о новой ссылке
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS rebalance_moves (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id INTEGER NOT NULL,
+                from_server_id INTEGER NOT NULL,
+                to_server_id INTEGER NOT NULL,
+                moved_at INTEGER NOT NULL,
+                notified INTEGER NOT NULL DEFAULT 0,
+                reason TEXT NOT NULL DEFAULT 'rebalance' -- rebalance, drain
+            )
+        ''')
+        await _ensure_column(db, 'rebalance_moves', 'reason', "TEXT NOT NULL DEFAULT 'rebalance'")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_rebalance_moves_notified ON rebalance_moves (notified)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_rebalance_moves_moved_at ON rebalance_moves (moved_at)")
+        # Резервные серверы подписок: тот же клиент (UUID, email, срок) на других серверах
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS user_servers (
+                telegram_id INTEGER NOT NULL,
+                server_id INTEGER NOT NULL,
+                inbound_id INTEGER, -- NULL — inbound ещё не выбран (клиент не создан)
+                client_uuid TEXT, -- UUID, с которым клиент создан на сервере
+                synced_end_date TEXT, -- дата окончания, записанная в панель; NULL — клиент ещё не создан
+                PRIMARY KEY (telegram_id, server_id)
+            ) WITHOUT ROWID
+        ''')
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_user_servers_server ON user_servers (server_id)")
+        # Пул заранее созданных выключенных клиентов для мгновенной выдачи новых подписок
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS client_pool (
+                client_uuid TEXT PRIMARY KEY,
+                email TEXT NOT NULL,
+                server_id INTEGER NOT NULL,
+                inbound_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'creating', -- creating (запрос в панель отправлен), ready, removing (удаляется из панели)
+                created_at INTEGER NOT NULL
+            )
+        ''')
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_client_pool_server ON client_pool (server_id, status)")
+        # Версия настроек: триггеры увеличивают её при любой записи в settings (бот, веб-админка, скрипты),
+        # а изменённой строке проставляют новую версию — процессы перечитывают только изменившиеся ключи
+        await _ensure_column(db, 'settings', 'version', 'INTEGER NOT NULL DEFAULT 0')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS settings_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL DEFAULT 0,
+                full_reload_version INTEGER NOT NULL DEFAULT 0 -- версия последнего удаления настройки
+            )
+        ''')
+        # Отпечаток _DEFAULT_SETTINGS последнего заполнения настроек по умолчанию и версия удалений на тот момент
+        await _ensure_column(db, 'settings_version', 'defaults_hash', 'TEXT')
+        await _ensure_column(db, 'settings_version', 'defaults_full_reload_version', 'INTEGER')
+        await db.execute("INSERT OR IGNORE INTO settings_version (id, version, full_reload_version) VALUES (1, 0, 0)")
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_settings_version_insert AFTER INSERT ON settings
+            BEGIN
+                UPDATE settings_version SET version = version + 1 WHERE id = 1;
+                UPDATE settings SET version = (SELECT version FROM settings_version WHERE id = 1) WHERE key = NEW.key;
+            END
+        ''')
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_settings_version_update AFTER UPDATE OF value ON settings
+            WHEN OLD.value IS NOT NEW.value
+            BEGIN
+                UPDATE settings_version SET version = version + 1 WHERE id = 1;
+                UPDATE settings SET version = (SELECT version FROM settings_version WHERE id = 1) WHERE key = NEW.key;
+            END
+        ''')
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_settings_version_delete AFTER DELETE ON settings
+            BEGIN
+                UPDATE settings_version SET version = version + 1, full_reload_version = version + 1 WHERE id = 1;
+            END
+        ''')
         await db.commit()
     
     await populate_default_settings()
     await populate_default_tariffs()
     logger.info("База данных инициализирована.")
 
+def _default_settings_hash() -> str:
+    return hashlib.sha256(json.dumps(_DEFAULT_SETTINGS, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
 async def populate_default_settings():
-    """Заполняет таблицу настроек значениями по умолчанию, если их там еще нет."""
+    """
+    Заполняет таблицу настроек значениями по умолчанию, если их там еще нет.
+    Пропускается, если _DEFAULT_SETTINGS не менялся с прошлого заполнения и с тех пор
+    ни одна настройка не удалялась (версия удалений в settings_version та же).
+    """
+    defaults_hash = _default_settings_hash()
     async with aiosqlite.connect(DATABASE_NAME) as db:
-        for key, (value, description) in _DEFAULT_SETTINGS.items():
-            await db.execute(
-                "INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)",
-                (key, str(value), description)
-            )
+        async with db.execute(
+            "SELECT defaults_hash, defaults_full_reload_version, full_reload_version FROM settings_version WHERE id = 1"
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row and row[0] == defaults_hash and row[1] == row[2]:
+            logger.info("Настройки по умолчанию не менялись с прошлого запуска, заполнение пропущено.")
+            return
+        await db.executemany(
+            "INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)",
+            [(key, str(value), description) for key, (value, description) in _DEFAULT_SETTINGS.items()]
+        )
+        await db.execute(
+            "UPDATE settings_version SET defaults_hash = ?, defaults_full_reload_version = full_reload_version WHERE id = 1",
+            (defaults_hash,)
+        )
         await db.commit()
     logger.info("Проверено и дополнено {} настроек по умолчанию в БД.".format(len(_DEFAULT_SETTINGS)))
 
@@ -296,6 +557,19 @@ async def load_all_settings() -> Dict[str, str]:
         async with db.execute("SELECT key, value FROM settings") as cursor:
             return {row[0]: row[1] for row in await cursor.fetchall()}
 
+async def get_settings_version() -> Tuple[int, int]:
+    """Текущая версия настроек и версия последнего удаления настройки (после него нужна полная перезагрузка)."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute("SELECT version, full_reload_version FROM settings_version WHERE id = 1") as cursor:
+            row = await cursor.fetchone()
+    return (row[0], row[1]) if row else (0, 0)
+
+async def load_settings_changed_since(version: int) -> Dict[str, str]:
+    """Настройки, изменённые после указанной версии."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute("SELECT key, value FROM settings WHERE version > ?", (version,)) as cursor:
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
 # ... (остальные функции get_user, add_user, etc. остаются без изменений) ...
 
 async def get_user(telegram_id: int):
@@ -312,7 +586,16 @@ async def add_user(telegram_id: int, username: str = None):
         await db.commit()
 
 async def update_user_subscription(telegram_id: int, xui_client_uuid: str, xui_client_email: str,
-                                   subscription_end_date: datetime, server_id: int, is_trial: bool = False, limit_ip: int = 0):
+                                   subscription_end_date: datetime, server_id: int, is_trial: bool = False, limit_ip: int = 0,
+                                   inbound_id: Optional[int] = None, expected_server_id: Optional[int] = None,
+                                   payment_id: Optional[str] = None):
+    """
+    Записывает выданную или продлённую подписку. Возвращает токен ссылки подписки.
+    С expected_server_id запись выполняется, только если пользователь всё ещё на этом сервере
+    (его не перенесли балансировкой или выводом сервера, в том числе из другого процесса).
+    С payment_id в той же транзакции платёж отмечается применённым и успешным; если он уже
+    был применён, подписка повторно не продлевается. В обоих случаях отказа возвращается None.
+    """
     # --- ЗАЩИТА ОТ НАИВНЫХ ДАТ ---
     if subscription_end_date.tzinfo is None:
         logger.warning(f"В update_user_subscription передана НАИВНАЯ дата для пользователя {telegram_id}. "
@@ -322,15 +605,28 @@ async def update_user_subscription(telegram_id: int, xui_client_uuid: str, xui_c
 
     end_date_str = subscription_end_date.isoformat()
     async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute(
+        cursor = await db.execute(
             """UPDATE users 
                SET xui_client_uuid = ?, xui_client_email = ?, subscription_end_date = ?, 
                    is_trial_used = CASE WHEN ? THEN 1 ELSE is_trial_used END,
                    current_server_id = ?,
                    limit_ip = ?
-               WHERE telegram_id = ?""",
-            (xui_client_uuid, xui_client_email, end_date_str, 1 if is_trial else 0, server_id, limit_ip, telegram_id)
+               WHERE telegram_id = ? AND (? IS NULL OR current_server_id = ?)""",
+            (xui_client_uuid, xui_client_email, end_date_str, 1 if is_trial else 0, server_id, limit_ip, telegram_id,
+             expected_server_id, expected_server_id)
         )
+        if expected_server_id is not None and cursor.rowcount == 0:
+            logger.warning(f"Подписка {telegram_id} не обновлена: пользователь уже не на сервере {expected_server_id}.")
+            return None
+        if payment_id is not None:
+            now_str = datetime.now(timezone.utc).isoformat()
+            cursor = await db.execute(
+                "UPDATE payments SET applied_at = ?, status = 'succeeded', status_updated_at = ? WHERE payment_id = ? AND applied_at IS NULL",
+                (now_str, now_str, payment_id)
+            )
+            if cursor.rowcount == 0:
+                logger.warning(f"Подписка {telegram_id} не обновлена: платёж {payment_id} уже применён.")
+                return None
         await db.execute(
             """UPDATE users
                SET xui_client_uuid = ?, xui_client_email = ?, subscription_end_date = ?, current_server_id = ?, limit_ip = ?
@@ -347,8 +643,25 @@ async def update_user_subscription(telegram_id: int, xui_client_uuid: str, xui_c
             "UPDATE users SET notified_expired = 0 WHERE telegram_id = ?",
             (telegram_id,)
         )
+        # Клиент снова есть в X-UI (продлён или пересоздан), снимаем отметку сборщика
+        await db.execute(
+            "UPDATE users SET xui_removed_at = NULL WHERE telegram_id = ?",
+            (telegram_id,)
+        )
+        await db.execute(
+            "UPDATE users SET current_inbound_id = ? WHERE telegram_id = ?",
+            (inbound_id, telegram_id)
+        )
+        # Токен ссылки выдаётся один раз и дальше не меняется (переносы между серверами его не трогают)
+        await db.execute(
+            "UPDATE users SET sub_token = COALESCE(sub_token, ?) WHERE telegram_id = ?",
+            (new_sub_token(), telegram_id)
+        )
+        async with db.execute("SELECT sub_token FROM users WHERE telegram_id = ?", (telegram_id,)) as cursor:
+            row = await cursor.fetchone()
         await db.commit()
     logger.info(f"Подписка для {telegram_id} обновлена. UUID: {xui_client_uuid}, до: {end_date_str}, limit_ip: {limit_ip}")
+    return row[0] if row else None
 
 async def deactivate_user(telegram_id: int):
     """Деактивирует пользователя, чтобы он не получал рассылки."""
@@ -371,12 +684,33 @@ async def get_active_subscription(telegram_id: int):
                     "subscription_end_date": sub_end_date,
                     "is_trial_used": bool(user[5]),
                     "current_server_id": user[6],
-                    "limit_ip": user[10] if len(user) > 10 else 0
+                    "limit_ip": user[10] if len(user) > 10 else 0,
+                    "sub_token": await get_sub_token(telegram_id)
                 }
         except ValueError:
             logger.error(f"Некорректный формат даты подписки для пользователя {telegram_id}: {user[4]}")
     return None
 
+async def get_sub_token(telegram_id: int) -> Optional[str]:
+    """Токен постоянной ссылки на подписку пользователя (None — подписки ещё не было)."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute("SELECT sub_token FROM users WHERE telegram_id = ?", (telegram_id,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+async def get_subscription_by_token(sub_token: str) -> Optional[Dict]:
+    """Подписка по токену ссылки — для раздачи подписок ботом (sub_server.py)."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(
+            """SELECT telegram_id, xui_client_uuid, xui_client_email, subscription_end_date,
+                      current_server_id, current_inbound_id, xui_removed_at
+               FROM users WHERE sub_token = ?""",
+            (sub_token,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            return dict(row) if row else None
+
 async def add_payment(payment_id: str, telegram_id: int, amount: float, currency: str, metadata_json: Optional[str] = None):
     created_at_str = datetime.now(timezone.utc).isoformat() # Используем UTC для created_at
     async with aiosqlite.connect(DATABASE_NAME) as db:
@@ -394,15 +728,76 @@ async def get_payment(payment_id: str):
 
 async def update_payment_status(payment_id: str, status: str):
     async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute("UPDATE payments SET status = ? WHERE payment_id = ?", (status, payment_id))
+        await db.execute(
+            "UPDATE payments SET status = ?, status_updated_at = ? WHERE payment_id = ?",
+            (status, datetime.now(timezone.utc).isoformat(), payment_id)
+        )
         await db.commit()
     logger.info(f"Статус платежа {payment_id} обновлен на {status}.")
 
+async def transition_payment_status(payment_id: str, from_statuses: tuple, to_status: str) -> bool:
+    """
+    Переход платежа по машине состояний pending → processing → succeeded/failed (или pending → canceled)
+    через compare-and-set: UPDATE срабатывает, только если текущий статус — один из from_statuses.
+    Возвращает True, если переход сделал именно этот вызов; из двух одновременных вызовов выигрывает один.
+    """
+    placeholders = ', '.join('?' for _ in from_statuses)
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        cursor = await db.execute(
+            f"UPDATE payments SET status = ?, status_updated_at = ? WHERE payment_id = ? AND status IN ({placeholders})",
+            (to_status, datetime.now(timezone.utc).isoformat(), payment_id, *from_statuses)
+        )
+        await db.commit()
+        changed = cursor.rowcount == 1
+    if changed:
+        logger.info(f"Платеж {payment_id}: {'/'.join(from_statuses)} -> {to_status}.")
+    return changed
+
+async def is_payment_applied(payment_id: str) -> bool:
+    """Записана ли уже подписка по платежу (см. update_user_subscription)."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute("SELECT applied_at FROM payments WHERE payment_id = ?", (payment_id,)) as cursor:
+            row = await cursor.fetchone()
+    return bool(row and row[0])
+
+async def wait_for_payment_outcome(payment_id: str, timeout_sec: float = 60, poll_sec: float = 0.5) -> Optional[str]:
+    """
+    Ждёт, пока другой обработчик завершит платёж в статусе 'processing', и возвращает итоговый статус
+    (или 'processing', если не дождались; None — платежа нет).
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_sec
+    while True:
+        payment = await get_payment(payment_id)
+        status = payment[4] if payment else None
+        if status != 'processing' or loop.time() >= deadline:
+            return status
+        await asyncio.sleep(poll_sec)
+
+async def reset_interrupted_payments() -> int:
+    """
+    При запуске: платежи, оставшиеся в 'processing' после аварийной остановки, возвращаются в 'pending',
+    чтобы их снова подхватила проверка; уже применённые (applied_at) становятся 'succeeded'.
+    Повторная проверка подписку второй раз не продлит. Возвращает число возвращённых в 'pending'.
+    """
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute("SELECT payment_id, telegram_id FROM payments WHERE status = 'processing' AND applied_at IS NULL") as cursor:
+            interrupted = await cursor.fetchall()
+        await db.execute(
+            """UPDATE payments SET status = CASE WHEN applied_at IS NULL THEN 'pending' ELSE 'succeeded' END, status_updated_at = ?
+               WHERE status = 'processing'""",
+            (datetime.now(timezone.utc).isoformat(),)
+        )
+        await db.commit()
+    for payment_id, telegram_id in interrupted:
+        logger.warning(f"Платеж {payment_id} пользователя {telegram_id} был прерван в статусе 'processing', возвращён в 'pending'.")
+    return len(interrupted)
+
 async def delete_xui_user_db_record(telegram_id: int):
     async with aiosqlite.connect(DATABASE_NAME) as db:
         await db.execute(
             """UPDATE users 
-               SET xui_client_uuid = NULL, xui_client_email = NULL, subscription_end_date = NULL, current_server_id = NULL
+               SET xui_client_uuid = NULL, xui_client_email = NULL, subscription_end_date = NULL, current_server_id = NULL, current_inbound_id = NULL
                WHERE telegram_id = ?""",
             (telegram_id,)
         )
@@ -478,34 +873,40 @@ async def get_user_payments(user_id: int) -> List[tuple]:
             return await cursor.fetchall()
 
 async def delete_user_subscription(user_id: int) -> bool:
-    """Удалить подписку пользователя"""
+    """Удалить подписку пользователя (в очереди операций с подпиской этого пользователя)"""
     # Импортируем здесь, чтобы избежать циклической зависимости
+    from subscription_manager import run_user_operation
+    return await run_user_operation(user_id, _delete_user_subscription, user_id, request_key="delete")
+
+async def _delete_user_subscription(user_id: int) -> bool:
     from x_ui_manager import xui_manager_instance
     from app_config import app_conf
+    from server_load import server_load_table
 
     try:
         async with aiosqlite.connect(DATABASE_NAME) as db:
             async with db.execute(
-                "SELECT xui_client_uuid, current_server_id FROM users WHERE telegram_id = ? AND subscription_end_date > datetime('now')",
+                "SELECT xui_client_uuid, current_server_id, current_inbound_id, subscription_end_date FROM users WHERE telegram_id = ? AND subscription_end_date > datetime('now')",
                 (user_id,)
             ) as cursor:
                 sub = await cursor.fetchone()
                 if not sub: return False
                 
-                uuid, server_id = sub
+                uuid, server_id, inbound_id, sub_end_str = sub
                 
-                server_config = next((s for s in app_conf.get('xui_servers', []) if s['id'] == server_id), None)
+                server_config = app_conf.get_server(server_id)
                 if server_config:
-                    await xui_manager_instance.delete_xui_user(server_config, uuid)
+                    await xui_manager_instance.delete_xui_user(server_config, uuid, inbound_id=inbound_id)
                 
                 await db.execute(
                     """UPDATE users 
                        SET xui_client_uuid = NULL, xui_client_email = NULL, 
-                           subscription_end_date = NULL, current_server_id = NULL
+                           subscription_end_date = NULL, current_server_id = NULL, current_inbound_id = NULL
                        WHERE telegram_id = ?""",
                     (user_id,)
                 )
                 await db.commit()
+                server_load_table.record_removal(server_id, sub_end_str)
                 return True
     except Exception as e:
         logger.error(f"Ошибка при удалении подписки пользователя {user_id}: {e}")
@@ -530,16 +931,26 @@ async def get_users_count() -> int:
             result = await cursor.fetchone()
             return result[0] if result else 0
 
-async def get_server_config(server_id: int) -> Optional[dict]:
+async def get_server_config(server_id: int) -> Optional[Mapping]:
     from app_config import app_conf
-    return next((s for s in app_conf.get('xui_servers', []) if s['id'] == server_id), None)
+    return app_conf.get_server(server_id)
+
+async def get_xui_email_by_uuid(client_uuid: str) -> Optional[str]:
+    """Email клиента X-UI по его UUID — для точечных запросов к панели по email."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            "SELECT xui_client_email FROM users WHERE xui_client_uuid = ? AND xui_client_email IS NOT NULL LIMIT 1",
+            (client_uuid,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
 
 async def get_last_subscription(telegram_id: int):
     """Получить последнюю подписку пользователя, даже если она истекла"""
     async with aiosqlite.connect(DATABASE_NAME) as db:
         async with db.execute(
             """SELECT telegram_id, username, xui_client_uuid, xui_client_email, 
-                      subscription_end_date, is_trial_used, current_server_id, limit_ip 
+                      subscription_end_date, is_trial_used, current_server_id, limit_ip, current_inbound_id, sub_token 
                FROM users 
                WHERE telegram_id = ? AND xui_client_uuid IS NOT NULL 
                ORDER BY subscription_end_date DESC 
@@ -558,7 +969,9 @@ async def get_last_subscription(telegram_id: int):
                         "subscription_end_date": sub_end_date,
                         "is_trial_used": bool(user[5]),
                         "current_server_id": user[6],
-                        "limit_ip": user[7] if len(user) > 7 else 0
+                        "limit_ip": user[7] if len(user) > 7 else 0,
+                        "current_inbound_id": user[8],
+                        "sub_token": user[9]
                     }
                 except ValueError:
                     logger.error(f"Некорректный формат даты подписки для пользователя {telegram_id}: {user[4]}")
@@ -583,7 +996,8 @@ async def get_all_xui_users_for_restore() -> List[Dict]:
                 xui_client_uuid,
                 xui_client_email,
                 subscription_end_date,
-                current_server_id
+                current_server_id,
+                current_inbound_id
             FROM
                 users
             WHERE
@@ -719,6 +1133,75 @@ async def get_users_with_expired_subscriptions():
             
             return expired_users
 
+async def get_users_for_xui_gc(grace_days: int) -> List[Dict]:
+    """
+    Пользователи, чья подписка закончилась больше grace_days дней назад и чей клиент
+    ещё не удалён из X-UI. Даты сравниваются в Python, как и в get_users_with_expired_subscriptions;
+    subscription_end_date возвращается строкой из БД — по ней отметка об удалении делается compare-and-set'ом.
+    """
+    threshold = datetime.now(timezone.utc) - timedelta(days=grace_days)
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT telegram_id, xui_client_uuid, xui_client_email, subscription_end_date, current_server_id, current_inbound_id
+               FROM users
+               WHERE xui_client_uuid IS NOT NULL AND xui_client_uuid != ''
+                 AND current_server_id IS NOT NULL
+                 AND subscription_end_date IS NOT NULL
+                 AND xui_removed_at IS NULL"""
+        ) as cursor:
+            result = []
+            async for telegram_id, client_uuid, email, sub_end_str, server_id, inbound_id in cursor:
+                try:
+                    sub_end_date = datetime.fromisoformat(sub_end_str)
+                    if sub_end_date.tzinfo is None:
+                        sub_end_date = sub_end_date.astimezone()
+                except ValueError:
+                    continue
+                if sub_end_date < threshold:
+                    result.append({
+                        'telegram_id': telegram_id,
+                        'xui_client_uuid': client_uuid,
+                        'xui_client_email': email,
+                        'subscription_end_date': sub_end_str,
+                        'current_server_id': server_id,
+                        'current_inbound_id': inbound_id,
+                    })
+            return result
+
+async def get_unchanged_gc_candidates(candidates: List[Dict]) -> List[Dict]:
+    """
+    Кандидаты сборщика мусора, чья подписка с момента выборки не менялась: тот же клиент,
+    сервер и дата окончания, отметки об удалении нет. Остальных продлили или перенесли — их не трогаем.
+    """
+    if not candidates:
+        return []
+    placeholders = ', '.join('?' for _ in candidates)
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            f"""SELECT telegram_id, xui_client_uuid, subscription_end_date, current_server_id
+                FROM users WHERE telegram_id IN ({placeholders}) AND xui_removed_at IS NULL""",
+            [user['telegram_id'] for user in candidates]
+        ) as cursor:
+            current = {row[0]: row[1:] for row in await cursor.fetchall()}
+    return [
+        user for user in candidates
+        if current.get(user['telegram_id']) == (user['xui_client_uuid'], user['subscription_end_date'], user['current_server_id'])
+    ]
+
+async def mark_xui_clients_removed(users: List[Dict]):
+    """
+    Отмечает, что клиенты удалены из X-UI; UUID, email и дата окончания остаются для пересоздания.
+    users — кандидаты из get_users_for_xui_gc: отметка ставится, только если клиент и дата окончания
+    с момента выборки не изменились (подписку не продлили, в том числе из другого процесса).
+    """
+    removed_at = datetime.now(timezone.utc).isoformat()
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        await db.executemany(
+            "UPDATE users SET xui_removed_at = ? WHERE telegram_id = ? AND xui_client_uuid = ? AND subscription_end_date = ?",
+            [(removed_at, user['telegram_id'], user['xui_client_uuid'], user['subscription_end_date']) for user in users]
+        )
+        await db.commit()
+
 def update_xui_servers_distribution_settings(new_servers_list):
     """
     Массово обновляет настройки распределения серверов (exclude_from_auto, max_clients, priority и др.)
@@ -752,6 +1235,43 @@ async def get_active_clients_count_for_server(server_id: int) -> Optional[int]:
         logger.error(f"Ошибка при подсчёте активных клиентов для сервера {server_id}: {e}")
         return None
 
+async def get_active_subscriptions_by_server(bucket_sec: int = 3600) -> List[tuple]:
+    """
+    Действующие подписки одним агрегатом по индексу (current_server_id, subscription_end_date):
+    строки (server_id, конец корзины в unix-секундах, число подписок), истекающих в этой корзине.
+    По ним таблица загрузки знает и текущее число клиентов на сервере, и когда оно уменьшится.
+    """
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT current_server_id,
+                      (CAST(strftime('%s', subscription_end_date) AS INTEGER) / ? + 1) * ? AS bucket_end,
+                      COUNT(*)
+               FROM users
+               WHERE current_server_id IS NOT NULL
+                 AND subscription_end_date IS NOT NULL
+                 AND CAST(strftime('%s', subscription_end_date) AS INTEGER) > CAST(strftime('%s', 'now') AS INTEGER)
+               GROUP BY current_server_id, bucket_end""",
+            (bucket_sec, bucket_sec)
+        ) as cursor:
+            return await cursor.fetchall()
+
+async def get_inbound_clients_counts(server_id: int, default_inbound_id: int) -> Dict[int, int]:
+    """
+    Сколько клиентов бота лежит в каждом inbound сервера: {inbound_id: count}.
+    Считаются все клиенты, ещё не удалённые из X-UI (истёкшие тоже занимают место в inbound).
+    Записи без current_inbound_id (созданные до появления нескольких inbound) относятся к default_inbound_id.
+    """
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT COALESCE(current_inbound_id, ?), COUNT(*) FROM users
+               WHERE current_server_id = ?
+                 AND xui_client_uuid IS NOT NULL AND xui_client_uuid != ''
+                 AND xui_removed_at IS NULL
+               GROUP BY 1""",
+            (default_inbound_id, server_id)
+        ) as cursor:
+            return {inbound_id: count for inbound_id, count in await cursor.fetchall()}
+
 async def get_active_tariffs() -> List[Dict]:
     """Получает все активные тарифы, отсортированные по sort_order."""
     async with aiosqlite.connect(DATABASE_NAME) as db:
@@ -829,4 +1349,545 @@ async def toggle_tariff_active(tariff_id: int) -> bool:
             return True
     except Exception as e:
         logger.error(f"Ошибка переключения активности тарифа: {e}")
-        return False
\ No newline at end of file
+        return False
+
+# --- Статистика трафика клиентов ---
+
+_TRAFFIC_BUCKETS = {'hour': 3600, 'day': 86400}
+
+async def record_traffic_counters(server_id: int, counters: Dict[str, tuple], ts: int) -> int:
+    """
+    Сохраняет свежие абсолютные счётчики трафика клиентов сервера и пишет дельты в traffic_usage.
+    counters — {email: (up, down)}. Первое наблюдение клиента только задаёт базу отсчёта.
+    Возвращает количество записанных строк с ненулевой дельтой.
+    """
+    if not counters:
+        return 0
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            "SELECT email, up, down FROM traffic_counters WHERE server_id = ?", (server_id,)
+        ) as cursor:
+            previous = {row[0]: (row[1], row[2]) for row in await cursor.fetchall()}
+
+        usage_rows = []
+        for email, (up, down) in counters.items():
+            prev = previous.get(email)
+            if prev is None:
+                continue
+            # Счётчик в панели могли сбросить — тогда весь текущий объём считаем новой дельтой
+            delta_up = up - prev[0] if up >= prev[0] else up
+            delta_down = down - prev[1] if down >= prev[1] else down
+            if delta_up or delta_down:
+                usage_rows.append((email, server_id, ts, delta_up, delta_down))
+
+        await db.executemany(
+            """INSERT INTO traffic_counters (server_id, email, up, down, updated_at) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(server_id, email) DO UPDATE SET up = excluded.up, down = excluded.down, updated_at = excluded.updated_at""",
+            [(server_id, email, up, down, ts) for email, (up, down) in counters.items()]
+        )
+        await db.executemany(
+            """INSERT INTO traffic_usage (telegram_id, email, server_id, resolution, bucket_ts, up, down)
+               VALUES ((SELECT telegram_id FROM users WHERE xui_client_email = ?1), ?1, ?2, 'raw', ?3, ?4, ?5)
+               ON CONFLICT(email, server_id, resolution, bucket_ts) DO UPDATE SET up = up + excluded.up, down = down + excluded.down""",
+            usage_rows
+        )
+        await db.commit()
+    return len(usage_rows)
+
+async def downsample_traffic_usage(raw_keep_sec: int, hourly_keep_sec: int, daily_keep_sec: int, now_ts: int):
+    """
+    Сворачивает старые отсчёты трафика: raw -> hour после raw_keep_sec, hour -> day после hourly_keep_sec.
+    Посуточные строки старше daily_keep_sec удаляются (0 — хранить бессрочно).
+    """
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        for source, target, keep_sec in (('raw', 'hour', raw_keep_sec), ('hour', 'day', hourly_keep_sec)):
+            bucket = _TRAFFIC_BUCKETS[target]
+            cutoff = now_ts - keep_sec
+            await db.execute(
+                f"""INSERT INTO traffic_usage (telegram_id, server_id, email, resolution, bucket_ts, up, down)
+                    SELECT MAX(telegram_id), server_id, email, '{target}', (bucket_ts / {bucket}) * {bucket}, SUM(up), SUM(down)
+                    FROM traffic_usage
+                    WHERE resolution = ? AND bucket_ts < ?
+                    GROUP BY server_id, email, (bucket_ts / {bucket}) * {bucket}
+                    ON CONFLICT(email, server_id, resolution, bucket_ts) DO UPDATE SET up = up + excluded.up, down = down + excluded.down""",
+                (source, cutoff)
+            )
+            await db.execute("DELETE FROM traffic_usage WHERE resolution = ? AND bucket_ts < ?", (source, cutoff))
+        if daily_keep_sec > 0:
+            cutoff = now_ts - daily_keep_sec
+            await db.execute("DELETE FROM traffic_usage WHERE resolution = 'day' AND bucket_ts < ?", (cutoff,))
+            # Счётчики клиентов, которых давно нет в панели, больше не нужны
+            await db.execute("DELETE FROM traffic_counters WHERE updated_at < ?", (cutoff,))
+        await db.commit()
+
+async def get_user_traffic_usage(telegram_id: int, since_ts: int) -> Dict[str, int]:
+    """Суммарный трафик пользователя (байты) начиная с since_ts по всем разрешениям ряда."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            "SELECT COALESCE(SUM(up), 0), COALESCE(SUM(down), 0) FROM traffic_usage WHERE telegram_id = ? AND bucket_ts >= ?",
+            (telegram_id, since_ts)
+        ) as cursor:
+            up, down = await cursor.fetchone()
+            return {'up': up, 'down': down, 'total': up + down}
+
+
+# --- История состояния серверов ---
+
+_SERVER_METRICS_FIELDS = ('server_id', 'ts', 'ok', 'cpu', 'mem', 'disk', 'active_clients', 'latency_ms', 'error')
+
+async def add_server_metrics_sample(server_id: int, ts: int, sample: Optional[Dict], history_size: int,
+                                    error: Optional[str] = None):
+    """
+    Записывает замер состояния сервера (sample=None — сервер недоступен, причина в error)
+    и обрезает историю сервера до history_size последних замеров.
+    """
+    if not sample and error is None:
+        error = 'unavailable'
+    sample = sample or {}
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        await db.execute(
+            """INSERT OR REPLACE INTO server_metrics (server_id, ts, ok, cpu, mem, disk, active_clients, latency_ms, error)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (server_id, ts, 1 if sample else 0, sample.get('cpu'), sample.get('mem'), sample.get('disk'),
+             sample.get('active_clients'), sample.get('latency_ms'), None if sample else error)
+        )
+        await db.execute(
+            """DELETE FROM server_metrics WHERE server_id = ? AND ts <= (
+                   SELECT ts FROM server_metrics WHERE server_id = ? ORDER BY ts DESC LIMIT 1 OFFSET ?
+               )""",
+            (server_id, server_id, history_size)
+        )
+        await db.commit()
+
+async def get_latest_server_metrics() -> Dict[int, Dict]:
+    """Последний замер по каждому серверу: {server_id: {...}}."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT m.server_id, m.ts, m.ok, m.cpu, m.mem, m.disk, m.active_clients, m.latency_ms, m.error
+               FROM server_metrics m
+               JOIN (SELECT server_id, MAX(ts) AS ts FROM server_metrics GROUP BY server_id) latest
+                 ON latest.server_id = m.server_id AND latest.ts = m.ts"""
+        ) as cursor:
+            return {row[0]: dict(zip(_SERVER_METRICS_FIELDS, row)) for row in await cursor.fetchall()}
+
+async def get_server_metrics_history(server_id: int, limit: int = 30) -> List[Dict]:
+    """Последние limit замеров сервера в хронологическом порядке."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT server_id, ts, ok, cpu, mem, disk, active_clients, latency_ms, error FROM server_metrics
+               WHERE server_id = ? ORDER BY ts DESC LIMIT ?""",
+            (server_id, limit)
+        ) as cursor:
+            rows = await cursor.fetchall()
+    return [dict(zip(_SERVER_METRICS_FIELDS, row)) for row in reversed(rows)]
+
+_BULK_GRANT_JOB_FIELDS = ('id', 'days', 'user_filter', 'comment', 'status', 'total', 'processed', 'failed', 'created_at', 'updated_at')
+
+async def create_bulk_grant_job(days: int, user_filter: str, where_sql: str, comment: Optional[str] = None) -> tuple:
+    """
+    Создаёт задание массового начисления и фиксирует его состав: пользователи с клиентом X-UI,
+    подходящие под where_sql (условие по таблице users). Возвращает (id задания, число пользователей).
+    Ошибка в условии пробрасывается как sqlite3.Error, задание при этом не создаётся.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        cursor = await db.execute(
+            "INSERT INTO bulk_grant_jobs (days, user_filter, comment, status, created_at, updated_at) VALUES (?, ?, ?, 'pending', ?, ?)",
+            (days, user_filter, comment, now, now)
+        )
+        job_id = cursor.lastrowid
+        cursor = await db.execute(
+            f"""INSERT INTO bulk_grant_items (job_id, telegram_id)
+                SELECT ?, telegram_id FROM users
+                WHERE xui_client_uuid IS NOT NULL AND xui_client_uuid != '' AND ({where_sql})""",
+            (job_id,)
+        )
+        total = cursor.rowcount
+        await db.execute("UPDATE bulk_grant_jobs SET total = ? WHERE id = ?", (total, job_id))
+        await db.commit()
+    return job_id, total
+
+async def get_bulk_grant_job(job_id: int) -> Optional[Dict]:
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(f"SELECT {', '.join(_BULK_GRANT_JOB_FIELDS)} FROM bulk_grant_jobs WHERE id = ?", (job_id,)) as cursor:
+            row = await cursor.fetchone()
+    return dict(zip(_BULK_GRANT_JOB_FIELDS, row)) if row else None
+
+async def get_bulk_grant_jobs(limit: int = 10) -> List[Dict]:
+    """Последние задания массового начисления, новые первыми."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            f"SELECT {', '.join(_BULK_GRANT_JOB_FIELDS)} FROM bulk_grant_jobs ORDER BY id DESC LIMIT ?", (limit,)
+        ) as cursor:
+            return [dict(zip(_BULK_GRANT_JOB_FIELDS, row)) for row in await cursor.fetchall()]
+
+async def get_next_bulk_grant_job() -> Optional[Dict]:
+    """Задание для обработчика: сначала прерванные (running), затем ожидающие, по порядку создания."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            f"""SELECT {', '.join(_BULK_GRANT_JOB_FIELDS)} FROM bulk_grant_jobs
+                WHERE status IN ('running', 'pending') ORDER BY status = 'running' DESC, id LIMIT 1"""
+        ) as cursor:
+            row = await cursor.fetchone()
+    return dict(zip(_BULK_GRANT_JOB_FIELDS, row)) if row else None
+
+async def set_bulk_grant_job_status(job_id: int, status: str, from_statuses: tuple = ('pending', 'running')) -> bool:
+    """Переводит задание в status, если оно сейчас в одном из from_statuses."""
+    placeholders = ', '.join('?' for _ in from_statuses)
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        cursor = await db.execute(
+            f"UPDATE bulk_grant_jobs SET status = ?, updated_at = ? WHERE id = ? AND status IN ({placeholders})",
+            (status, datetime.now(timezone.utc).isoformat(), job_id, *from_statuses)
+        )
+        await db.commit()
+        return cursor.rowcount == 1
+
+async def get_pending_bulk_grant_items(job_id: int) -> List[Dict]:
+    """Необработанные пользователи задания с их текущими клиентом, сервером и датой окончания."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT u.telegram_id, u.xui_client_uuid, u.subscription_end_date, u.current_server_id, u.current_inbound_id, u.limit_ip
+               FROM bulk_grant_items i JOIN users u ON u.telegram_id = i.telegram_id
+               WHERE i.job_id = ? AND i.status = 'pending'
+               ORDER BY u.current_server_id, u.current_inbound_id""",
+            (job_id,)
+        ) as cursor:
+            fields = ('telegram_id', 'xui_client_uuid', 'subscription_end_date', 'current_server_id', 'current_inbound_id', 'limit_ip')
+            items = [dict(zip(fields, row)) for row in await cursor.fetchall()]
+        # Пользователи, удалённые из users после создания задания, обработать уже нельзя
+        cursor = await db.execute(
+            """UPDATE bulk_grant_items SET status = 'failed', error = 'пользователь удалён'
+               WHERE job_id = ? AND status = 'pending' AND telegram_id NOT IN (SELECT telegram_id FROM users)""",
+            (job_id,)
+        )
+        if cursor.rowcount:
+            await db.execute("UPDATE bulk_grant_jobs SET failed = failed + ? WHERE id = ?", (cursor.rowcount, job_id))
+        await db.commit()
+    return items
+
+async def apply_bulk_grant_chunk(job_id: int, done: List[tuple], failed: List[tuple], granted: List[tuple] = ()) -> List[int]:
+    """
+    Фиксирует пачку задания одной транзакцией: done — [(telegram_id, новая дата окончания, прежняя дата)],
+    failed — [(telegram_id, ошибка)], granted — [(telegram_id, новая дата окончания)] для продлённых
+    через grant_subscription (она сама записала подписку, отмечается только задание).
+    Новая дата из done пишется в users (со сбросом уведомлений об окончании), только если дата
+    окончания всё ещё равна прежней (строка из БД на момент выборки). Возвращает telegram_id,
+    чья подписка с момента выборки изменилась: они не отмечаются и остаются 'pending'.
+    """
+    applied, conflicted = list(granted), []
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        for telegram_id, end_date, old_end_date in done:
+            cursor = await db.execute(
+                """UPDATE users SET subscription_end_date = ?, notified_expiring = 0, notified_expired = 0, xui_removed_at = NULL
+                   WHERE telegram_id = ? AND subscription_end_date IS ?""",
+                (end_date.isoformat(), telegram_id, old_end_date)
+            )
+            if cursor.rowcount == 0:
+                conflicted.append(telegram_id)
+                continue
+            applied.append((telegram_id, end_date))
+        await db.executemany(
+            "UPDATE bulk_grant_items SET status = 'done', new_end_date = ?, error = NULL WHERE job_id = ? AND telegram_id = ?",
+            [(end_date.isoformat(), job_id, telegram_id) for telegram_id, end_date in applied]
+        )
+        await db.executemany(
+            "UPDATE bulk_grant_items SET status = 'failed', error = ? WHERE job_id = ? AND telegram_id = ?",
+            [(error, job_id, telegram_id) for telegram_id, error in failed]
+        )
+        await db.execute(
+            "UPDATE bulk_grant_jobs SET processed = processed + ?, failed = failed + ?, updated_at = ? WHERE id = ?",
+            (len(applied), len(failed), datetime.now(timezone.utc).isoformat(), job_id)
+        )
+        await db.commit()
+    return conflicted
+
+async def get_rebalance_candidates(server_id: int, limit: int, to_server_id: Optional[int] = None) -> List[Dict]:
+    """
+    Действующие подписки сервера для переноса, начиная с ближайших к окончанию:
+    этим пользователям скоро продлевать, и новая ссылка придёт им вместе с продлением.
+    secondary_inbound_id — inbound, в котором на to_server_id уже создана копия клиента
+    (резервный сервер, user_servers); None, если копии там нет.
+    """
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT u.telegram_id, u.xui_client_uuid, u.xui_client_email, u.subscription_end_date, u.current_inbound_id, u.limit_ip,
+                      us.inbound_id
+               FROM users u
+               LEFT JOIN user_servers us ON us.telegram_id = u.telegram_id AND us.server_id = ?
+                 AND us.synced_end_date IS NOT NULL AND us.client_uuid = u.xui_client_uuid
+               WHERE u.current_server_id = ? AND u.xui_client_uuid IS NOT NULL AND u.xui_client_uuid != ''
+                 AND strftime('%s', u.subscription_end_date) > strftime('%s', 'now')
+               ORDER BY strftime('%s', u.subscription_end_date)
+               LIMIT ?""",
+            (to_server_id, server_id, limit)
+        ) as cursor:
+            fields = ('telegram_id', 'xui_client_uuid', 'xui_client_email', 'subscription_end_date', 'current_inbound_id', 'limit_ip',
+                      'secondary_inbound_id')
+            return [dict(zip(fields, row)) for row in await cursor.fetchall()]
+
+async def count_rebalance_moves_since(ts: int, reason: str = 'rebalance') -> int:
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute("SELECT COUNT(*) FROM rebalance_moves WHERE moved_at >= ? AND reason = ?", (ts, reason)) as cursor:
+            return (await cursor.fetchone())[0]
+
+async def apply_rebalance_moves(moves: List[Dict], reason: str = 'rebalance') -> List[int]:
+    """
+    Переключает пользователей на новый сервер одной транзакцией и записывает переносы.
+    Пользователь переключается, только если с момента выборки его подписка не менялась
+    (тот же сервер, клиент и дата окончания). Возвращает telegram_id переключённых.
+    """
+    applied = []
+    moved_at = int(datetime.now(timezone.utc).timestamp())
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        for move in moves:
+            cursor = await db.execute(
+                """UPDATE users SET current_server_id = ?, current_inbound_id = ?
+                   WHERE telegram_id = ? AND current_server_id = ? AND xui_client_uuid = ? AND subscription_end_date = ?""",
+                (move['to_server_id'], move['to_inbound_id'], move['telegram_id'], move['from_server_id'],
+                 move['xui_client_uuid'], move['subscription_end_date'])
+            )
+            if cursor.rowcount == 1:
+                await db.execute(
+                    "INSERT INTO rebalance_moves (telegram_id, from_server_id, to_server_id, moved_at, reason) VALUES (?, ?, ?, ?, ?)",
+                    (move['telegram_id'], move['from_server_id'], move['to_server_id'], moved_at, reason)
+                )
+                applied.append(move['telegram_id'])
+        await db.commit()
+    return applied
+
+async def get_pending_rebalance_notifications(limit: int) -> List[Dict]:
+    """Пользователи с неотправленным уведомлением о переносе и их текущие сервер и клиент."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT u.telegram_id, u.current_server_id, u.xui_client_uuid, u.sub_token
+               FROM users u
+               WHERE u.telegram_id IN (SELECT telegram_id FROM rebalance_moves WHERE notified = 0 ORDER BY id LIMIT ?)""",
+            (limit,)
+        ) as cursor:
+            fields = ('telegram_id', 'current_server_id', 'xui_client_uuid', 'sub_token')
+            return [dict(zip(fields, row)) for row in await cursor.fetchall()]
+
+async def mark_rebalance_notified(telegram_ids: List[int]):
+    """Отмечает уведомлёнными все переносы пользователей (при нескольких переносах уходит одно сообщение)."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        await db.executemany(
+            "UPDATE rebalance_moves SET notified = 1 WHERE telegram_id = ? AND notified = 0",
+            [(telegram_id,) for telegram_id in telegram_ids]
+        )
+        await db.commit()
+
+async def get_drain_progress(server_id: int, started_at: Optional[int] = None) -> Dict:
+    """
+    Ход вывода сервера: сколько действующих подписок ещё на нём, сколько перенесено
+    с начала вывода (started_at, unix-время) и за последний час.
+    """
+    hour_ago = int(datetime.now(timezone.utc).timestamp()) - 3600
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT COUNT(*) FROM users
+               WHERE current_server_id = ? AND strftime('%s', subscription_end_date) > strftime('%s', 'now')""",
+            (server_id,)
+        ) as cursor:
+            remaining = (await cursor.fetchone())[0]
+        async with db.execute(
+            """SELECT COUNT(*), COALESCE(SUM(moved_at >= ?), 0) FROM rebalance_moves
+               WHERE from_server_id = ? AND reason = 'drain' AND moved_at >= ?""",
+            (hour_ago, server_id, started_at or 0)
+        ) as cursor:
+            moved, moved_last_hour = await cursor.fetchone()
+    return {'remaining': remaining, 'moved': moved, 'moved_last_hour': moved_last_hour}
+
+
+# --- Резервные серверы пользователей ---
+
+async def get_users_missing_secondaries(count: int, limit: int = 1000) -> List[Dict]:
+    """Действующие подписки, у которых резервных серверов меньше count, и уже назначенные им серверы."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT u.telegram_id, u.current_server_id, GROUP_CONCAT(us.server_id)
+               FROM users u
+               LEFT JOIN user_servers us ON us.telegram_id = u.telegram_id AND us.server_id != u.current_server_id
+               WHERE u.xui_client_uuid IS NOT NULL AND u.current_server_id IS NOT NULL
+                 AND strftime('%s', u.subscription_end_date) > strftime('%s', 'now')
+               GROUP BY u.telegram_id
+               HAVING COUNT(us.server_id) < ?
+               LIMIT ?""",
+            (count, limit)
+        ) as cursor:
+            return [
+                {'telegram_id': telegram_id, 'current_server_id': server_id,
+                 'server_ids': [int(i) for i in assigned.split(',')] if assigned else []}
+                for telegram_id, server_id, assigned in await cursor.fetchall()
+            ]
+
+async def get_secondary_counts_by_server() -> Dict[int, int]:
+    """Сколько действующих подписок держит каждый сервер как резервный."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT us.server_id, COUNT(*) FROM user_servers us JOIN users u ON u.telegram_id = us.telegram_id
+               WHERE strftime('%s', u.subscription_end_date) > strftime('%s', 'now')
+               GROUP BY us.server_id"""
+        ) as cursor:
+            return {server_id: count for server_id, count in await cursor.fetchall()}
+
+async def add_user_servers(pairs: List[tuple]):
+    """Назначает резервные серверы [(telegram_id, server_id)]; клиентов создаст синхронизация."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        await db.executemany("INSERT OR IGNORE INTO user_servers (telegram_id, server_id) VALUES (?, ?)", pairs)
+        await db.commit()
+
+async def get_secondary_sync_work() -> List[Dict]:
+    """
+    Резервные серверы действующих подписок, где клиента ещё нет или в панель записана
+    не та дата окончания, что в БД.
+    """
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(
+            """SELECT us.telegram_id, us.server_id, us.inbound_id, us.synced_end_date,
+                      u.xui_client_uuid, u.xui_client_email, u.subscription_end_date, u.limit_ip
+               FROM user_servers us JOIN users u ON u.telegram_id = us.telegram_id
+               WHERE us.server_id != u.current_server_id
+                 AND (us.client_uuid IS NULL OR us.client_uuid = u.xui_client_uuid)
+                 AND strftime('%s', u.subscription_end_date) > strftime('%s', 'now')
+                 AND (us.synced_end_date IS NULL OR us.synced_end_date != u.subscription_end_date)"""
+        ) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+async def mark_user_servers_synced(rows: List[tuple]):
+    """Фиксирует клиентов в панелях: [(inbound_id, client_uuid, synced_end_date, telegram_id, server_id)]."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        await db.executemany(
+            "UPDATE user_servers SET inbound_id = ?, client_uuid = ?, synced_end_date = ? WHERE telegram_id = ? AND server_id = ?",
+            rows
+        )
+        await db.commit()
+
+async def get_stale_user_servers(grace_days: int) -> List[Dict]:
+    """
+    Резервные серверы, которые больше не нужны: пользователь удалён или сменил клиента,
+    сервер стал основным (перенос) или подписка закончилась больше grace_days дней назад.
+    remove_client — нужно ли удалять клиента из панели (на основном сервере он остаётся).
+    """
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT us.telegram_id, us.server_id, us.inbound_id, us.client_uuid,
+                      us.server_id = u.current_server_id AS is_primary
+               FROM user_servers us LEFT JOIN users u ON u.telegram_id = us.telegram_id
+               WHERE u.telegram_id IS NULL
+                  OR us.server_id = u.current_server_id
+                  OR (us.client_uuid IS NOT NULL AND us.client_uuid IS NOT u.xui_client_uuid)
+                  OR u.subscription_end_date IS NULL
+                  OR strftime('%s', u.subscription_end_date) < strftime('%s', 'now', ?)""",
+            (f"-{int(grace_days)} days",)
+        ) as cursor:
+            return [
+                {'telegram_id': telegram_id, 'server_id': server_id, 'inbound_id': inbound_id, 'client_uuid': client_uuid,
+                 'remove_client': bool(client_uuid) and not is_primary}
+                for telegram_id, server_id, inbound_id, client_uuid, is_primary in await cursor.fetchall()
+            ]
+
+async def delete_user_servers(pairs: List[tuple]):
+    """Снимает резервные серверы [(telegram_id, server_id)]."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        await db.executemany("DELETE FROM user_servers WHERE telegram_id = ? AND server_id = ?", pairs)
+        await db.commit()
+
+async def get_user_secondary_servers(telegram_id: int) -> List[tuple]:
+    """Резервные серверы, на которых клиент пользователя уже создан: [(server_id, inbound_id)]."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """SELECT us.server_id, us.inbound_id FROM user_servers us JOIN users u ON u.telegram_id = us.telegram_id
+               WHERE us.telegram_id = ? AND us.server_id != u.current_server_id
+                 AND us.synced_end_date IS NOT NULL AND us.client_uuid = u.xui_client_uuid""",
+            (telegram_id,)
+        ) as cursor:
+            return list(await cursor.fetchall())
+
+
+# --- Пул заранее созданных клиентов ---
+
+async def get_client_pool_counts() -> Dict[int, Dict[str, int]]:
+    """Клиенты пула по серверам: {server_id: {'ready': n, 'creating': m}}."""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute("SELECT server_id, status, COUNT(*) FROM client_pool GROUP BY server_id, status") as cursor:
+            counts: Dict[int, Dict[str, int]] = {}
+            for server_id, status, count in await cursor.fetchall():
+                counts.setdefault(server_id, {})[status] = count
+            return counts
+
+async def add_client_pool_entries(server_id: int, inbound_id: int, clients: List[Dict], status: str = 'creating'):
+    """
+    Записывает клиентов пула до запроса в панель (status='creating') или клиентов,
+    которых нужно убрать из панели (status='removing', например не включившихся при выдаче).
+    """
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO client_pool (client_uuid, email, server_id, inbound_id, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [(client['uuid'], client['email'], server_id, inbound_id, status, now_ts) for client in clients]
+        )
+        await db.commit()
+
+async def get_client_pool_entries(status: Optional[str] = None, server_id: Optional[int] = None, limit: int = -1) -> List[Dict]:
+    """Клиенты пула с фильтром по статусу и серверу, новые первыми."""
+    conditions, params = [], []
+    if status is not None:
+        conditions.append("status = ?")
+        params.append(status)
+    if server_id is not None:
+        conditions.append("server_id = ?")
+        params.append(server_id)
+    where_sql = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(
+            f"SELECT client_uuid, email, server_id, inbound_id, status FROM client_pool {where_sql} ORDER BY created_at DESC LIMIT ?",
+            (*params, limit)
+        ) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+async def set_client_pool_ready(client_uuids: List[str]):
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        await db.executemany("UPDATE client_pool SET status = 'ready' WHERE client_uuid = ?", [(u,) for u in client_uuids])
+        await db.commit()
+
+async def mark_client_pool_removing(client_uuids: List[str]) -> List[str]:
+    """
+    Переводит готовых клиентов пула в 'removing' перед удалением из панели. Клиент, которого
+    выдача уже забрала (строки нет или она не 'ready'), не отмечается. Возвращает отмеченные UUID.
+    """
+    marked = []
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        for client_uuid in client_uuids:
+            async with db.execute(
+                "UPDATE client_pool SET status = 'removing' WHERE client_uuid = ? AND status = 'ready' RETURNING client_uuid",
+                (client_uuid,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                marked.append(row[0])
+        await db.commit()
+    return marked
+
+async def delete_client_pool_entries(client_uuids: List[str]):
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        await db.executemany("DELETE FROM client_pool WHERE client_uuid = ?", [(u,) for u in client_uuids])
+        await db.commit()
+
+async def claim_pool_client(server_id: int) -> Optional[Dict]:
+    """
+    Забирает из пула самого старого готового клиента сервера одним запросом: выборка и удаление
+    выполняются под блокировкой записи SQLite, поэтому один клиент не достанется двоим.
+    """
+    async with aiosqlite.connect(DATABASE_NAME) as db:
+        async with db.execute(
+            """DELETE FROM client_pool
+               WHERE client_uuid = (SELECT client_uuid FROM client_pool WHERE server_id = ? AND status = 'ready'
+                                    ORDER BY created_at LIMIT 1)
+               RETURNING client_uuid, email, inbound_id""",
+            (server_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        await db.commit()
+    return {'client_uuid': row[0], 'email': row[1], 'inbound_id': row[2]} if row else None
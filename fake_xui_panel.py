@@ -0,0 +1,486 @@
+# fake_xui_panel.py
+"""
+Локальная заглушка HTTP API панели 3x-ui для нагрузочных тестов и бенчмарков.
+
+Держит inbounds и клиентов в памяти и отвечает в том же формате, что и настоящая панель:
+логин (csrf-token + login), список/получение inbound, добавление/обновление/удаление
+клиентов (классические маршруты inbounds/*Client и новые panel/api/clients/*),
+трафик клиента и статус сервера. Задержка, доля ошибок и размер inbound настраиваются,
+поэтому XUIManager, grant_subscription и миграцию можно гонять на ноутбуке,
+в том числе на inbound с 10k клиентов.
+
+Запуск отдельным процессом:
+    python fake_xui_panel.py --port 2053 --inbounds 1 --clients 10000 --latency-ms 40 --error-rate 0.01
+
+Из кода (py3xui синхронный, поэтому панель крутится в своём потоке со своим event loop):
+    panel_thread = FakePanelThread(FakeXUIPanel(clients_per_inbound=10000), port=0)
+    panel_thread.start()
+    server_conf = panel_thread.server_config(server_id=1)
+"""
+import argparse
+import asyncio
+import json
+import random
+import secrets
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from aiohttp import web
+from loguru import logger
+
+SESSION_COOKIE = '3x-ui'
+
+
+class FakeXUIPanel:
+    """In-memory состояние панели: inbounds, клиенты, счётчики трафика и сессии."""
+
+    def __init__(self, username: str = 'admin', password: str = 'admin', inbound_count: int = 1,
+                 clients_per_inbound: int = 0, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 error_rate: float = 0.0, traffic_bytes_per_sec: int = 0, seed: Optional[int] = None):
+        self.username = username
+        self.password = password
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.traffic_bytes_per_sec = traffic_bytes_per_sec
+        self.random = random.Random(seed)
+        self.sessions = set()
+        self.csrf_tokens = set()
+        self.inbounds: Dict[int, Dict] = {}
+        self.started_at = time.time()
+        # Счётчики обращений по маршрутам — для отчётов бенчмарка
+        self.request_counts: Dict[str, int] = {}
+
+        for inbound_id in range(1, inbound_count + 1):
+            self.add_inbound(inbound_id, port=40000 + inbound_id)
+            for _ in range(clients_per_inbound):
+                client_uuid = str(uuid.uuid4())
+                self.add_client(inbound_id, {
+                    'id': client_uuid,
+                    'email': f"seed_{inbound_id}_{client_uuid[:12]}@fake.panel",
+                    'enable': self.random.random() > 0.1,
+                    'flow': 'xtls-rprx-vision',
+                    'subId': client_uuid,
+                    'expiryTime': int((time.time() + self.random.randint(-30, 60) * 86400) * 1000),
+                })
+
+    # --- Состояние ---
+
+    def add_inbound(self, inbound_id: int, port: int, remark: str = ''):
+        self.inbounds[inbound_id] = {
+            'id': inbound_id,
+            'remark': remark or f"fake-inbound-{inbound_id}",
+            'port': port,
+            'protocol': 'vless',
+            'enable': True,
+            'stream': {
+                'network': 'tcp',
+                'security': 'reality',
+                'realitySettings': {
+                    'show': False,
+                    'dest': 'www.example.com:443',
+                    'serverNames': ['www.example.com'],
+                    'shortIds': [secrets.token_hex(4)],
+                    'settings': {'publicKey': secrets.token_urlsafe(32), 'fingerprint': 'chrome'},
+                },
+                'tcpSettings': {'header': {'type': 'none'}},
+            },
+            # email -> dict клиента в формате панели (camelCase, как в settings.clients)
+            'clients': {},
+            # email -> [up, down, created_at]
+            'traffic': {},
+        }
+
+    def add_client(self, inbound_id: int, client: Dict) -> Optional[str]:
+        """Добавляет клиента. Возвращает текст ошибки, как это делает панель, или None."""
+        inbound = self.inbounds.get(inbound_id)
+        if inbound is None:
+            return f"Inbound {inbound_id} not found"
+        email = client.get('email')
+        if not email:
+            return "Empty email"
+        if self.email_exists(email):
+            return f"Duplicate email: {email}"
+        stored = {
+            'id': client.get('id') or str(uuid.uuid4()),
+            'email': email,
+            'enable': client.get('enable', True),
+            'flow': client.get('flow', ''),
+            'limitIp': client.get('limitIp', 0),
+            'totalGB': client.get('totalGB', 0),
+            'expiryTime': client.get('expiryTime', 0),
+            'tgId': client.get('tgId', ''),
+            'subId': client.get('subId', ''),
+            'reset': client.get('reset', 0),
+        }
+        inbound['clients'][email] = stored
+        inbound['traffic'][email] = [0, 0, time.time()]
+        return None
+
+    def email_exists(self, email: str) -> bool:
+        return any(email in inbound['clients'] for inbound in self.inbounds.values())
+
+    def find_client(self, identifier: str):
+        """Ищет клиента по email или UUID во всех inbounds. Возвращает (inbound, client) или None."""
+        for inbound in self.inbounds.values():
+            client = inbound['clients'].get(identifier)
+            if client is not None:
+                return inbound, client
+        for inbound in self.inbounds.values():
+            for client in inbound['clients'].values():
+                if client['id'] == identifier:
+                    return inbound, client
+        return None
+
+    def update_client(self, identifier: str, changes: Dict) -> Optional[str]:
+        found = self.find_client(identifier)
+        if found is None:
+            return f"Client {identifier} not found"
+        inbound, client = found
+        new_email = changes.get('email') or client['email']
+        if new_email != client['email']:
+            if self.email_exists(new_email):
+                return f"Duplicate email: {new_email}"
+            inbound['clients'][new_email] = inbound['clients'].pop(client['email'])
+            inbound['traffic'][new_email] = inbound['traffic'].pop(client['email'])
+        for key in ('id', 'enable', 'flow', 'limitIp', 'totalGB', 'expiryTime', 'tgId', 'subId', 'reset'):
+            if key in changes:
+                client[key] = changes[key]
+        client['email'] = new_email
+        return None
+
+    def delete_client(self, identifier: str) -> Optional[str]:
+        found = self.find_client(identifier)
+        if found is None:
+            return f"Client {identifier} not found"
+        inbound, client = found
+        inbound['clients'].pop(client['email'], None)
+        inbound['traffic'].pop(client['email'], None)
+        return None
+
+    def client_traffic(self, inbound: Dict, email: str) -> Dict:
+        client = inbound['clients'][email]
+        up, down, created_at = inbound['traffic'][email]
+        if self.traffic_bytes_per_sec and client['enable']:
+            # Трафик растёт линейно со временем жизни клиента: 1/4 на отдачу, 3/4 на приём
+            grown = int((time.time() - created_at) * self.traffic_bytes_per_sec)
+            up, down = up + grown // 4, down + grown - grown // 4
+        return {
+            'id': 0,
+            'inboundId': inbound['id'],
+            'enable': client['enable'],
+            'email': email,
+            'up': up,
+            'down': down,
+            'expiryTime': client['expiryTime'],
+            'total': client['totalGB'],
+            'reset': client['reset'],
+        }
+
+    def inbound_json(self, inbound: Dict) -> Dict:
+        """Inbound в формате ответа панели: settings/streamSettings/sniffing — JSON-строки."""
+        return {
+            'id': inbound['id'],
+            'up': 0,
+            'down': 0,
+            'total': 0,
+            'remark': inbound['remark'],
+            'enable': inbound['enable'],
+            'expiryTime': 0,
+            'listen': '',
+            'port': inbound['port'],
+            'protocol': inbound['protocol'],
+            'settings': json.dumps({
+                'clients': list(inbound['clients'].values()),
+                'decryption': 'none',
+                'fallbacks': [],
+            }),
+            'streamSettings': json.dumps(inbound['stream']),
+            'sniffing': json.dumps({'enabled': True, 'destOverride': ['http', 'tls', 'quic']}),
+            'tag': f"inbound-{inbound['port']}",
+            'clientStats': [self.client_traffic(inbound, email) for email in inbound['clients']],
+        }
+
+    def server_status(self) -> Dict:
+        total_clients = sum(len(i['clients']) for i in self.inbounds.values())
+        gb = 1024 ** 3
+        return {
+            'cpu': round(min(99.0, 3 + total_clients / 500 + self.random.uniform(0, 10)), 2),
+            'cpuCores': 4,
+            'logicalPro': 8,
+            'cpuSpeedMhz': 2400.0,
+            'mem': {'current': int(2 * gb + total_clients * 64 * 1024), 'total': 8 * gb},
+            'swap': {'current': 0, 'total': 2 * gb},
+            'disk': {'current': 12 * gb, 'total': 80 * gb},
+            'xray': {'state': 'running', 'errorMsg': '', 'version': '1.8.24'},
+            'uptime': int(time.time() - self.started_at),
+            'loads': [0.3, 0.25, 0.2],
+            'tcpCount': total_clients,
+            'udpCount': 0,
+            'netIO': {'up': 0, 'down': 0},
+            'netTraffic': {'sent': 0, 'recv': 0},
+            'publicIP': {'ipv4': '127.0.0.1', 'ipv6': '::1'},
+            'appStats': {'threads': 16, 'mem': 64 * 1024 * 1024, 'uptime': int(time.time() - self.started_at)},
+        }
+
+
+def _ok(obj=None, msg: str = '') -> web.Response:
+    return web.json_response({'success': True, 'msg': msg, 'obj': obj})
+
+
+def _fail(msg: str) -> web.Response:
+    return web.json_response({'success': False, 'msg': msg, 'obj': None})
+
+
+def _parse_settings_clients(payload: Dict) -> List[Dict]:
+    """Клиенты из классического тела {'id': inbound_id, 'settings': '{"clients": [...]}'}."""
+    settings = payload.get('settings') or '{}'
+    if isinstance(settings, str):
+        settings = json.loads(settings)
+    return settings.get('clients', [])
+
+
+async def _read_payload(request: web.Request) -> Dict:
+    if request.content_type == 'application/json':
+        return await request.json()
+    return dict(await request.post())
+
+
+def create_app(panel: FakeXUIPanel, secret_path: str = '') -> web.Application:
+    """Собирает aiohttp-приложение с маршрутами панели под необязательным секретным путём."""
+    prefix = f"/{secret_path.strip('/')}" if secret_path.strip('/') else ''
+
+    @web.middleware
+    async def behaviour_middleware(request: web.Request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        panel.request_counts[route] = panel.request_counts.get(route, 0) + 1
+        delay_ms = panel.latency_ms + (panel.random.uniform(0, panel.jitter_ms) if panel.jitter_ms else 0)
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+        if panel.error_rate and panel.random.random() < panel.error_rate:
+            raise web.HTTPInternalServerError(text='fake panel: injected error')
+        is_public = request.path in (f"{prefix}/csrf-token", f"{prefix}/login")
+        if not is_public and request.cookies.get(SESSION_COOKIE) not in panel.sessions:
+            raise web.HTTPUnauthorized(text='fake panel: not logged in')
+        return await handler(request)
+
+    async def csrf_token(request):
+        token = secrets.token_hex(16)
+        panel.csrf_tokens.add(token)
+        return _ok(token)
+
+    async def login(request):
+        payload = await _read_payload(request)
+        if request.headers.get('X-CSRF-Token') not in panel.csrf_tokens:
+            return _fail('Invalid CSRF token')
+        if payload.get('username') != panel.username or payload.get('password') != panel.password:
+            return _fail('Wrong username or password')
+        session = secrets.token_hex(16)
+        panel.sessions.add(session)
+        response = _ok(msg='Login successfully')
+        response.set_cookie(SESSION_COOKIE, session)
+        return response
+
+    async def inbounds_list(request):
+        return _ok([panel.inbound_json(i) for i in panel.inbounds.values()])
+
+    async def inbound_get(request):
+        inbound = panel.inbounds.get(int(request.match_info['inbound_id']))
+        if inbound is None:
+            return _fail('Inbound not found')
+        return _ok(panel.inbound_json(inbound))
+
+    async def inbound_update(request):
+        inbound = panel.inbounds.get(int(request.match_info['inbound_id']))
+        if inbound is None:
+            return _fail('Inbound not found')
+        payload = await _read_payload(request)
+        new_clients = _parse_settings_clients(payload)
+        old_traffic = inbound['traffic']
+        inbound['clients'], inbound['traffic'] = {}, {}
+        for client in new_clients:
+            error = panel.add_client(inbound['id'], client)
+            if error:
+                return _fail(error)
+            if client['email'] in old_traffic:
+                inbound['traffic'][client['email']] = old_traffic[client['email']]
+        for key in ('remark', 'enable', 'port'):
+            if key in payload:
+                inbound[key] = payload[key]
+        return _ok(panel.inbound_json(inbound), msg='Inbound updated')
+
+    async def classic_add_client(request):
+        payload = await _read_payload(request)
+        inbound_id = int(payload.get('id', 0))
+        clients = _parse_settings_clients(payload)
+        # Как и настоящая панель, сначала проверяем все email: пачка добавляется целиком или никак
+        emails = [client.get('email') for client in clients]
+        for email in emails:
+            if email and (emails.count(email) > 1 or panel.email_exists(email)):
+                return _fail(f"Duplicate email: {email}")
+        for client in clients:
+            error = panel.add_client(inbound_id, client)
+            if error:
+                return _fail(error)
+        return _ok(msg='Client(s) added')
+
+    async def classic_update_client(request):
+        payload = await _read_payload(request)
+        clients = _parse_settings_clients(payload)
+        if not clients:
+            return _fail('Empty client')
+        error = panel.update_client(request.match_info['client_id'], clients[0])
+        return _fail(error) if error else _ok(msg='Client updated')
+
+    async def classic_del_client(request):
+        error = panel.delete_client(request.match_info['client_id'])
+        return _fail(error) if error else _ok(msg='Client deleted')
+
+    async def classic_client_traffics(request):
+        found = panel.find_client(request.match_info['email'])
+        if found is None:
+            return _ok(None)
+        inbound, client = found
+        return _ok(panel.client_traffic(inbound, client['email']))
+
+    async def clients_get(request):
+        found = panel.find_client(request.match_info['email'])
+        if found is None:
+            return _ok(None)
+        inbound, client = found
+        traffic = panel.client_traffic(inbound, client['email'])
+        return _ok({'client': {**client, 'up': traffic['up'], 'down': traffic['down']}, 'inboundIds': [inbound['id']]})
+
+    async def clients_add(request):
+        payload = await _read_payload(request)
+        client = payload.get('client') or {}
+        for inbound_id in payload.get('inboundIds') or []:
+            error = panel.add_client(int(inbound_id), client)
+            if error:
+                return _fail(error)
+        return _ok(msg='Client added')
+
+    async def clients_update(request):
+        payload = await _read_payload(request)
+        error = panel.update_client(request.match_info['email'], payload)
+        return _fail(error) if error else _ok(msg='Client updated')
+
+    async def clients_del(request):
+        error = panel.delete_client(request.match_info['email'])
+        return _fail(error) if error else _ok(msg='Client deleted')
+
+    async def clients_list(request):
+        return _ok([
+            {**client, 'inboundId': inbound['id']}
+            for inbound in panel.inbounds.values() for client in inbound['clients'].values()
+        ])
+
+    async def server_status(request):
+        return _ok(panel.server_status())
+
+    app = web.Application(middlewares=[behaviour_middleware], client_max_size=64 * 1024 * 1024)
+    app.router.add_get(f"{prefix}/csrf-token", csrf_token)
+    app.router.add_post(f"{prefix}/login", login)
+    app.router.add_get(f"{prefix}/panel/api/inbounds/list", inbounds_list)
+    app.router.add_get(f"{prefix}/panel/api/inbounds/get/{{inbound_id}}", inbound_get)
+    app.router.add_post(f"{prefix}/panel/api/inbounds/update/{{inbound_id}}", inbound_update)
+    app.router.add_post(f"{prefix}/panel/api/inbounds/addClient", classic_add_client)
+    app.router.add_post(f"{prefix}/panel/api/inbounds/updateClient/{{client_id}}", classic_update_client)
+    app.router.add_post(f"{prefix}/panel/api/inbounds/{{inbound_id}}/delClient/{{client_id}}", classic_del_client)
+    app.router.add_get(f"{prefix}/panel/api/inbounds/getClientTraffics/{{email}}", classic_client_traffics)
+    app.router.add_get(f"{prefix}/panel/api/clients/get/{{email}}", clients_get)
+    app.router.add_post(f"{prefix}/panel/api/clients/add", clients_add)
+    app.router.add_post(f"{prefix}/panel/api/clients/update/{{email}}", clients_update)
+    app.router.add_post(f"{prefix}/panel/api/clients/del/{{email}}", clients_del)
+    app.router.add_get(f"{prefix}/panel/api/clients/list", clients_list)
+    app.router.add_get(f"{prefix}/panel/api/server/status", server_status)
+    return app
+
+
+class FakePanelThread:
+    """
+    Запускает фейковую панель в отдельном потоке со своим event loop.
+    Нужно потому, что py3xui делает блокирующие HTTP-запросы прямо из event loop бота.
+    """
+
+    def __init__(self, panel: FakeXUIPanel, host: str = '127.0.0.1', port: int = 0, secret_path: str = ''):
+        self.panel = panel
+        self.host = host
+        self.port = port
+        self.secret_path = secret_path
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+
+    def start(self) -> int:
+        """Стартует сервер и возвращает фактический порт (port=0 — выбрать свободный)."""
+        self._thread = threading.Thread(target=self._run, name='fake-xui-panel', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self.port
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._runner = web.AppRunner(create_app(self.panel, self.secret_path), access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, self.host, self.port)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def stop(self):
+        if self._loop and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def server_config(self, server_id: int, inbound_id: int = 1, name: str = '') -> Dict:
+        """Запись для настройки xui_servers, указывающая на эту панель."""
+        return {
+            'id': server_id,
+            'name': name or f"fake-{server_id}",
+            'url': f"http://{self.host}",
+            'port': self.port,
+            'secret_path': self.secret_path,
+            'username': self.panel.username,
+            'password': self.panel.password,
+            'inbound_id': inbound_id,
+            'public_host': self.host,
+            'public_port': self.port,
+            'sub_path_prefix': 'sub',
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Фейковая панель 3x-ui для тестов и бенчмарков')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2053)
+    parser.add_argument('--secret-path', default='')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--inbounds', type=int, default=1, help='Количество inbounds')
+    parser.add_argument('--clients', type=int, default=0, help='Предзаполненных клиентов на inbound')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Задержка каждого ответа')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Случайная добавка к задержке')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов HTTP 500 (0..1)')
+    parser.add_argument('--traffic-bps', type=int, default=0, help='Рост трафика клиента, байт/с')
+    args = parser.parse_args()
+
+    panel = FakeXUIPanel(
+        username=args.username, password=args.password, inbound_count=args.inbounds,
+        clients_per_inbound=args.clients, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate, traffic_bytes_per_sec=args.traffic_bps,
+    )
+    logger.info(f"Фейковая панель: {args.inbounds} inbound(s) по {args.clients} клиентов на http://{args.host}:{args.port}/{args.secret_path}")
+    web.run_app(create_app(panel, args.secret_path), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
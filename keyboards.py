@@ -2,6 +2,7 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from app_config import app_conf
+import message_templates
 import asyncio
 from db_helpers import get_active_tariffs
 
@@ -119,7 +120,8 @@ def get_renew_keyboard():
         builder = InlineKeyboardBuilder()
         builder.row(
             InlineKeyboardButton(
-                text=app_conf.get('btn_renew_sub', '🔄 Продлить подписку').format(
+                text=message_templates.render(
+                    'btn_renew_sub',
                     days=sub_days,
                     price=price_display,
                     currency=sub_currency
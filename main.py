@@ -4,10 +4,12 @@
 import asyncio
 import logging
 import os
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone 
 import uuid as py_uuid
 import json
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 import pytz
 
 # Импортируем необходимые модули aiogram для работы с Telegram Bot API
@@ -27,12 +29,24 @@ from yookassa import Configuration as YKConfig, Payment as YKPayment
 from yookassa.domain.request.payment_request_builder import PaymentRequestBuilder
 
 # Импортируем внутренние модули проекта
-from app_config import app_conf # Менеджер настроек
+from app_config import app_conf, run_settings_watcher # Менеджер настроек
 import keyboards # Клавиатуры для Telegram
+import message_templates # Шаблоны сообщений из настроек
 import db_helpers # Работа с базой данных
 from x_ui_manager import xui_manager_instance # Работа с X-UI
 import admin # Админские команды и обработчики
 from subscription_manager import grant_subscription, get_subscription_link, get_server_config
+import traffic_collector # Сбор статистики трафика
+import server_metrics # Мониторинг состояния серверов
+import xui_gc # Удаление давно истёкших клиентов из X-UI
+from server_load import server_load_table, run_server_load_refresher # Загрузка серверов для выбора сервера
+import bulk_grant # Массовые начисления дней подписки
+import rebalancer # Балансировка подписок между серверами
+import sub_server # Раздача подписок по постоянным ссылкам
+import secondary_servers # Резервные серверы подписок
+import client_pool # Пул заранее созданных клиентов
+from admission import admission_queue # Очередь выдачи пробных периодов
+import warm_state # Снимок кэшей для быстрого перезапуска
 
 from loguru import logger
 import aiosqlite
@@ -46,6 +60,29 @@ dp = Dispatcher(storage=storage, bot=bot)
 # Словарь для хранения активных задач проверки платежей
 active_payment_checkers = {}
 
+
+class StartupTimer:
+    """Длительность фаз запуска бота для отчёта в лог."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        phase_started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - phase_started))
+
+    def report(self):
+        phases = ', '.join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in self.phases)
+        logger.info(f"Запуск бота: {phases}; всего {(time.perf_counter() - self.started) * 1000:.0f} мс.")
+
+
+startup_timer = StartupTimer()
+
 # --- Состояния FSM для aiogram ---
 class PromoCodeActivation(StatesGroup):
     waiting_for_code = State()
@@ -58,18 +95,35 @@ class StepByStepGuide(StatesGroup):
     step5 = State()
 
 # --- Вспомогательные функции ---
-async def process_successful_payment(telegram_user_id: int, payment_id: str, payment_metadata: Optional[dict] = None):
+async def process_successful_payment(telegram_user_id: int, payment_id: str, payment_metadata: Optional[dict] = None,
+                                     reply_if_processed: bool = True):
+    """
+    Выдаёт подписку по оплаченному платежу ровно один раз. Переход pending/failed → processing
+    делается compare-and-set'ом: подписку выдаёт только победитель, а остальные вызовы
+    (автопроверка и кнопка «Проверить платеж» одновременно) дожидаются его итога
+    и отвечают пользователю по нему (если reply_if_processed). Отметка о применении платежа
+    записывается в одной транзакции с датой окончания подписки, поэтому платёж, прерванный
+    аварийной остановкой после выдачи, после перезапуска подписку второй раз не продлит.
+    """
     logger.info(f"Обработка успешного платежа {payment_id} для пользователя {telegram_user_id}")
-    db_payment_info = await db_helpers.get_payment(payment_id)
-    if db_payment_info and db_payment_info[4] == "succeeded":
+    # failed → processing: выдача по оплаченному платежу не удалась, пользователь повторяет проверку
+    if not await db_helpers.transition_payment_status(payment_id, ('pending', 'failed'), 'processing'):
+        outcome = await db_helpers.wait_for_payment_outcome(payment_id)
+        if outcome != "succeeded":
+            logger.warning(f"Платеж {payment_id} обрабатывается другим обработчиком или не найден (статус: {outcome}).")
+            if reply_if_processed and outcome == "processing":
+                await bot.send_message(telegram_user_id, app_conf.get('text_payment_pending'), reply_markup=keyboards.get_back_to_main_keyboard())
+            return False
         logger.info(f"Платеж {payment_id} уже был обработан как 'succeeded'.")
+        if not reply_if_processed:
+            return True
         # Повторно отправляем сообщение об успехе, если пользователь нажал кнопку проверки еще раз
         active_sub = await db_helpers.get_active_subscription(telegram_user_id)
         if active_sub:
             server_conf = await get_server_config(active_sub['current_server_id'])
             sub_link = "N/A"
             if server_conf and active_sub['xui_client_uuid']:
-                sub_link = get_subscription_link(server_conf, active_sub['xui_client_uuid'])
+                sub_link = get_subscription_link(server_conf, active_sub['xui_client_uuid'], active_sub.get('sub_token'))
             
             days_paid = app_conf.get('subscription_days', 30)
             if payment_metadata and 'subscription_days' in payment_metadata:
@@ -80,7 +134,7 @@ async def process_successful_payment(telegram_user_id: int, payment_id: str, pay
             local_expiry_date = expiry_date.astimezone(moscow) if expiry_date.tzinfo else expiry_date
             await bot.send_message(
                 telegram_user_id,
-                app_conf.get('text_payment_success').format(
+                message_templates.render('text_payment_success',
                     days=days_paid, expiry_date=local_expiry_date.strftime('%d.%m.%Y %H:%M %Z'),
                     sub_link=hcode(sub_link) if sub_link != "N/A" else sub_link
                 ),
@@ -88,8 +142,6 @@ async def process_successful_payment(telegram_user_id: int, payment_id: str, pay
             )
         return True
 
-    await db_helpers.update_payment_status(payment_id, "succeeded")
-    
     days_to_add = app_conf.get('subscription_days', 30)
     price_to_use = None
     limit_ip = 0
@@ -109,16 +161,25 @@ async def process_successful_payment(telegram_user_id: int, payment_id: str, pay
                     limit_ip = tariff.get('limit_ip', 0)
                     break
     
-    subscription_data = await grant_subscription(telegram_user_id, days_to_add, is_trial=False, limit_ip=limit_ip)
+    try:
+        subscription_data = await grant_subscription(
+            telegram_user_id, days_to_add, is_trial=False, limit_ip=limit_ip, request_key=f"payment:{payment_id}",
+            payment_id=payment_id
+        )
+    except Exception as e:
+        # Платёж не должен застрять в 'processing': переводим его в 'failed', повторная проверка выдаст подписку
+        logger.error(f"Ошибка выдачи подписки по платежу {payment_id}: {e}")
+        subscription_data = None
     
     if subscription_data:
+        await db_helpers.transition_payment_status(payment_id, ('processing',), 'succeeded')
         moscow = pytz.timezone('Europe/Moscow')
         local_expiry_date = subscription_data['expiry_date'].astimezone(moscow)
         
         # Отправляем основное сообщение об успешном платеже
         await bot.send_message(
             telegram_user_id,
-            app_conf.get('text_payment_success').format(
+            message_templates.render('text_payment_success',
                 days=days_to_add, expiry_date=local_expiry_date.strftime('%d.%m.%Y %H:%M %Z'),
                 sub_link=hcode(subscription_data['sub_link'])
             ),
@@ -128,6 +189,7 @@ async def process_successful_payment(telegram_user_id: int, payment_id: str, pay
         return True
     else:
         logger.error(f"Не удалось выдать подписку после успешного платежа {payment_id}")
+        await db_helpers.transition_payment_status(payment_id, ('processing',), 'failed')
         await bot.send_message(telegram_user_id, app_conf.get('text_error_creating_user'))
         return False
 
@@ -144,18 +206,18 @@ async def show_main_menu(message_or_query: Message | CallbackQuery, edit_message
 
     kbd = await keyboards.get_main_keyboard(not is_trial_used and not has_active_sub, has_active_sub)
 
-    text_to_send = app_conf.get('text_welcome_message').format(user_name=user_name, project_name=app_conf.get('project_name'))
+    text_to_send = message_templates.render('text_welcome_message', user_name=user_name)
     
     if active_sub:
         server_conf = await get_server_config(active_sub['current_server_id'])
         sub_link = "N/A"
         if server_conf and active_sub['xui_client_uuid']:
-            sub_link = get_subscription_link(server_conf, active_sub['xui_client_uuid'])
+            sub_link = get_subscription_link(server_conf, active_sub['xui_client_uuid'], active_sub.get('sub_token'))
 
         expiry_date = active_sub['subscription_end_date']
         moscow = pytz.timezone('Europe/Moscow')
         local_expiry_date = expiry_date.astimezone(moscow) if expiry_date.tzinfo else expiry_date
-        text_to_send += "\n\n" + app_conf.get('text_subscription_info').format(
+        text_to_send += "\n\n" + message_templates.render('text_subscription_info',
             status="Активна ✅", expiry_date=local_expiry_date.strftime('%d.%m.%Y %H:%M %Z'),
             sub_link=hcode(sub_link) if sub_link != "N/A" else sub_link
         )
@@ -163,6 +225,11 @@ async def show_main_menu(message_or_query: Message | CallbackQuery, edit_message
         # Лимит устройств теперь из БД
         limit_ip = active_sub.get('limit_ip', 0) if isinstance(active_sub, dict) else 0
         text_to_send += f"\n\n<b>Лимит устройств:</b> {limit_ip if limit_ip > 0 else 'Без лимита'}"
+
+        # Трафик берём из собранной статистики, без запроса к панели
+        usage = await traffic_collector.get_user_usage_summary(user_id)
+        if usage['month']['total']:
+            text_to_send += f"\n<b>Трафик за 30 дней:</b> {traffic_collector.format_bytes(usage['month']['total'])}"
     elif is_trial_used and not has_active_sub:
          # Показываем стандартный текст для пользователей без активной подписки
          text_to_send += "\n\n" + app_conf.get('text_subscription_expired_main')
@@ -198,14 +265,23 @@ async def handle_start(message: Message):
         logger.info(f"Попытка выдать триал для нового пользователя {message.from_user.id}")
         waiting_msg = await message.answer("⏳ Идет регистрация пробного периода, пожалуйста подождите...")
         trial_days = app_conf.get('trial_days', 3)
+
+        async def show_queue_position(position: int):
+            await waiting_msg.edit_text(message_templates.render('text_trial_queue_position', position=position))
+
+        # При наплыве регистраций выдача ждёт в очереди (admission.py), место показывается в waiting_msg.
         # limit_ip=1 для триала
-        subscription_data = await grant_subscription(message.from_user.id, trial_days, is_trial=True, limit_ip=1)
+        subscription_data = await admission_queue.run(
+            message.from_user.id,
+            lambda: grant_subscription(message.from_user.id, trial_days, is_trial=True, limit_ip=1, request_key="trial"),
+            on_position=show_queue_position
+        )
         
         if subscription_data:
             moscow = pytz.timezone('Europe/Moscow')
             local_expiry_date = subscription_data['expiry_date'].astimezone(moscow)
             await waiting_msg.edit_text(
-                app_conf.get('text_trial_success').format(
+                message_templates.render('text_trial_success',
                     days=trial_days, sub_link=hcode(subscription_data['sub_link']),
                     expiry_date=local_expiry_date.strftime('%d.%m.%Y %H:%M %Z')
                 ),
@@ -230,10 +306,10 @@ async def cq_android_guide(query: CallbackQuery):
     if active_sub:
         server_conf = await get_server_config(active_sub['current_server_id'])
         if server_conf and active_sub['xui_client_uuid']:
-            sub_link = get_subscription_link(server_conf, active_sub['xui_client_uuid'])
+            sub_link = get_subscription_link(server_conf, active_sub['xui_client_uuid'], active_sub.get('sub_token'))
     
     await query.message.edit_text(
-        app_conf.get('text_android_guide').format(sub_link=hcode(sub_link)),
+        message_templates.render('text_android_guide', sub_link=hcode(sub_link)),
         reply_markup=keyboards.get_guide_keyboard(sub_link, "android", add_step_guide_btn=True),
         disable_web_page_preview=True
     )
@@ -246,10 +322,10 @@ async def cq_ios_guide(query: CallbackQuery):
     if active_sub:
         server_conf = await get_server_config(active_sub['current_server_id'])
         if server_conf and active_sub['xui_client_uuid']:
-            sub_link = get_subscription_link(server_conf, active_sub['xui_client_uuid'])
+            sub_link = get_subscription_link(server_conf, active_sub['xui_client_uuid'], active_sub.get('sub_token'))
     
     await query.message.edit_text(
-        app_conf.get('text_ios_guide').format(sub_link=hcode(sub_link)),
+        message_templates.render('text_ios_guide', sub_link=hcode(sub_link)),
         reply_markup=keyboards.get_guide_keyboard(sub_link, "ios", add_step_guide_btn=True),
         disable_web_page_preview=True
     )
@@ -258,7 +334,7 @@ async def cq_ios_guide(query: CallbackQuery):
 @dp.callback_query(F.data == "about_service")
 async def cq_about_service(query: CallbackQuery):
     await query.message.edit_text(
-        app_conf.get('text_about_service').format(project_name=app_conf.get('project_name')),
+        message_templates.render('text_about_service'),
         reply_markup=keyboards.get_about_service_keyboard()
     )
     await query.answer()
@@ -290,12 +366,14 @@ async def auto_check_payment_status(payment_id: str, user_id: int, payment_metad
             
             if payment_info_yk.status == "succeeded":
                 logger.info(f"Автопроверка: Платеж {payment_id} УСПЕШЕН!")
-                await process_successful_payment(user_id, payment_id, payment_metadata)
+                # Если платёж параллельно обработала кнопка проверки, пользователь уже получил ответ
+                await process_successful_payment(user_id, payment_id, payment_metadata, reply_if_processed=False)
                 return 
             
             elif payment_info_yk.status == "canceled":
                 logger.info(f"Автопроверка: Платеж {payment_id} ОТМЕНЕН.")
-                await db_helpers.update_payment_status(payment_id, "canceled")
+                if not await db_helpers.transition_payment_status(payment_id, ('pending',), 'canceled'):
+                    return
                 try: 
                     await bot.send_message(user_id, app_conf.get('text_payment_canceled_or_failed'), reply_markup=keyboards.get_back_to_main_keyboard())
                 except Exception as send_err:
@@ -332,14 +410,16 @@ async def process_promo_code_activation(message: Message, state: FSMContext):
     # Получаем текущий лимит устройств пользователя
     user = await db_helpers.get_active_subscription(message.from_user.id)
     current_limit_ip = user.get('limit_ip', 0) if user else 0
-    subscription_data = await grant_subscription(message.from_user.id, days_to_add, is_trial=False, limit_ip=current_limit_ip)
+    subscription_data = await grant_subscription(
+        message.from_user.id, days_to_add, is_trial=False, limit_ip=current_limit_ip, request_key=f"promo:{code}"
+    )
 
     if subscription_data:
         await db_helpers.activate_promo_code(code, message.from_user.id)
         moscow = pytz.timezone('Europe/Moscow')
         local_expiry_date = subscription_data['expiry_date'].astimezone(moscow)
         await message.answer(
-            app_conf.get('text_promo_code_success').format(
+            message_templates.render('text_promo_code_success',
                 code=code, days=days_to_add, expiry_date=local_expiry_date.strftime('%d.%m.%Y %H:%M %Z')
             ),
             reply_markup=keyboards.get_back_to_main_keyboard()
@@ -356,6 +436,11 @@ async def cq_check_payment(query: CallbackQuery):
     payment_db_data = await db_helpers.get_payment(payment_id)
     payment_metadata_from_db = json.loads(payment_db_data[6]) if payment_db_data and payment_db_data[6] else None
 
+    # Платёж уже выдаётся или выдан: отвечаем по его итогу без повторного запроса в YooKassa
+    if payment_db_data and payment_db_data[4] in ("processing", "succeeded"):
+        await process_successful_payment(query.from_user.id, payment_id, payment_metadata_from_db)
+        return
+
     try:
         payment_info_yk = YKPayment.find_one(payment_id)
     except Exception as e:
@@ -370,7 +455,7 @@ async def cq_check_payment(query: CallbackQuery):
     elif payment_info_yk.status == "pending":
         await query.answer(app_conf.get('text_payment_pending'), show_alert=True) 
     elif payment_info_yk.status in ["canceled", "failed"]:
-        await db_helpers.update_payment_status(payment_id, "canceled")
+        await db_helpers.transition_payment_status(payment_id, ('pending',), 'canceled')
         await query.message.edit_text(app_conf.get('text_payment_canceled_or_failed'), reply_markup=keyboards.get_back_to_main_keyboard())
 
 @dp.callback_query(F.data.startswith("renew_sub"))
@@ -437,7 +522,7 @@ async def cq_renew_subscription(query: CallbackQuery):
             )
             price_str = int(price) if price == int(price) else f"{price:.2f}"
             await query.message.edit_text(
-                app_conf.get('text_payment_prompt').format(
+                message_templates.render('text_payment_prompt',
                     days=days, price=price_str, currency=currency,
                     payment_url=payment_response.confirmation.confirmation_url
                 ),
@@ -584,13 +669,13 @@ async def step_guide_2(call: CallbackQuery, state: FSMContext):
     if active_sub:
         server_conf = await get_server_config(active_sub['current_server_id'])
         if server_conf and active_sub['xui_client_uuid']:
-            sub_link = get_subscription_link(server_conf, active_sub['xui_client_uuid'])
+            sub_link = get_subscription_link(server_conf, active_sub['xui_client_uuid'], active_sub.get('sub_token'))
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=app_conf.get('step_guide_btn_next', '➡️ Далее'), callback_data="step_guide_3")],
         [InlineKeyboardButton(text=app_conf.get('step_guide_btn_back', '⬅️ На главную'), callback_data="back_to_main")]
     ])
     await call.message.edit_text(
-        app_conf.get('step_guide_2_text', '<b>2️⃣ Скопируйте вашу ссылку для подключения</b>\n\n🔗 <code>{sub_link}</code>\n\nСкопируйте ссылку в буфер обмена.').format(sub_link=sub_link),
+        message_templates.render('step_guide_2_text', sub_link=sub_link),
         reply_markup=kb
     )
     await state.set_state(StepByStepGuide.step2)
@@ -639,52 +724,69 @@ async def cq_show_tariffs(query: CallbackQuery):
     )
     await query.answer()
 
-# --- Событие запуска бота ---
-async def on_startup(dispatcher: Dispatcher):
-    """
-    Выполняется при запуске бота:
-    - Инициализация базы данных
-    - Загрузка настроек из базы
-    - Настройка YooKassa
-    - Проверка подключения к X-UI серверам
-    - Возобновление проверки ожидающих платежей
-    """
+def configure_bot_and_payments():
+    """Пересоздаёт bot, если токен изменился после загрузки настроек, и настраивает YooKassa."""
     global bot
-    await db_helpers.init_db()
-    await app_conf.load_settings()
-    # Пересоздаём bot, если токен изменился после загрузки настроек
     new_token = os.getenv("BOT_TOKEN", app_conf.get('bot_token', ''))
     if new_token and new_token != bot.token:
         bot_instance = Bot(token=new_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-        dispatcher.bot = bot_instance
+        dp["bot"] = bot_instance
         bot = bot_instance
     YKConfig.account_id = os.getenv("YOOKASSA_SHOP_ID", app_conf.get('yookassa_shop_id', ''))
     YKConfig.secret_key = os.getenv("YOOKASSA_SECRET_KEY", app_conf.get('yookassa_secret_key', ''))
-    bot_info = await bot.get_me()
+
+async def warm_up_xui_connections():
+    """Подключается ко всем X-UI серверам параллельно; запуск бота этого не ждёт."""
+    started = time.perf_counter()
+    servers = app_conf.get_servers()
+    clients = await asyncio.gather(*(xui_manager_instance.get_client(server_conf) for server_conf in servers),
+                                   return_exceptions=True)
+    connected = 0
+    for server_conf, client in zip(servers, clients):
+        if client and not isinstance(client, Exception):
+            connected += 1
+            logger.info(f"Успешное подключение к X-UI: {server_conf.get('name')}")
+        else:
+            logger.error(f"Не удалось подключиться к X-UI: {server_conf.get('name')}")
+    logger.info(f"Прогрев подключений к X-UI: {connected} из {len(servers)} за {(time.perf_counter() - started) * 1000:.0f} мс.")
+
+# --- Событие запуска бота ---
+async def on_startup(dispatcher: Dispatcher):
+    """
+    Выполняется при запуске бота (база и настройки к этому моменту уже загружены в main):
+    - Запуск фонового прогрева подключений к X-UI серверам
+    - Возврат прерванных платежей в 'pending' и возобновление проверки ожидающих платежей
+    - Отчёт о длительности фаз запуска
+    """
+    asyncio.create_task(warm_up_xui_connections())
+    with startup_timer.phase("платежи"):
+        # Платежи, чья выдача оборвалась остановкой бота, снова становятся 'pending'
+        await db_helpers.reset_interrupted_payments()
+        pending_payments = await db_helpers.get_pending_payments()
+        for p in pending_payments:
+            pid, uid, _, _, _, created_at_str, meta_str = p
+            meta = json.loads(meta_str) if meta_str else {}
+            created_at = datetime.fromisoformat(created_at_str).replace(tzinfo=timezone.utc)
+            if datetime.now(timezone.utc) - created_at < timedelta(minutes=15):
+                logger.info(f"Возобновление автопроверки для платежа {pid}")
+                task = asyncio.create_task(auto_check_payment_status(pid, uid, meta))
+                active_payment_checkers[pid] = task
+    with startup_timer.phase("getMe"):
+        bot_info = await bot.get_me()
     logger.success(f"Бот @{bot_info.username} запущен!")
-    xui_servers = app_conf.get('xui_servers', [])
-    for server_conf in xui_servers:
-        client = await xui_manager_instance.get_client(server_conf)
-        if client: logger.info(f"Успешное подключение к X-UI: {server_conf.get('name')}")
-        else: logger.error(f"Не удалось подключиться к X-UI: {server_conf.get('name')}")
-    pending_payments = await db_helpers.get_pending_payments()
-    for p in pending_payments:
-        pid, uid, _, _, _, created_at_str, meta_str = p
-        meta = json.loads(meta_str) if meta_str else {}
-        created_at = datetime.fromisoformat(created_at_str).replace(tzinfo=timezone.utc)
-        if datetime.now(timezone.utc) - created_at < timedelta(minutes=15):
-            logger.info(f"Возобновление автопроверки для платежа {pid}")
-            task = asyncio.create_task(auto_check_payment_status(pid, uid, meta))
-            active_payment_checkers[pid] = task
+    startup_timer.report()
 
 # --- Событие остановки бота ---
 async def on_shutdown(dispatcher: Dispatcher):
     """
     Выполняется при остановке бота:
+    - Запись снимка тёплого состояния
     - Отмена всех фоновых задач
     - Завершение работы
     """
     logger.info("Бот останавливается...")
+    if app_conf.get('warm_state_save_interval_sec', 300) > 0:
+        await warm_state.save()
     for task in active_payment_checkers.values():
         task.cancel()
     await asyncio.sleep(1)
@@ -696,19 +798,56 @@ async def main():
     Главная функция запуска бота:
     - Регистрирует события запуска и остановки
     - Регистрирует админские обработчики
-    - Загружает настройки из базы
+    - Инициализирует базу данных (настройки по умолчанию — только если они изменились)
+    - Загружает настройки из базы, настраивает bot и YooKassa
+    - Запускает применение изменений настроек (из веб-админки)
+    - Восстанавливает кэши из снимка тёплого состояния и запускает его периодическую запись
     - Запускает фоновую задачу напоминаний
-    - Запускает polling aiogram
+    - Запускает сбор статистики трафика и мониторинг серверов
+    - Запускает удаление давно истёкших клиентов из X-UI
+    - Загружает таблицу загрузки серверов и запускает её периодическую сверку с БД
+    - Запускает обработчик массовых начислений (продолжает прерванные задания)
+    - Запускает фоновую балансировку подписок между серверами
+    - Запускает синхронизацию резервных серверов подписок
+    - Запускает пополнение пула заранее созданных клиентов
+    - Запускает раздачу подписок по постоянным ссылкам (если задан sub_server_port)
+    - Запускает polling aiogram; подключение к X-UI прогревается в фоне (on_startup)
+    Длительность фаз запуска выводится в лог одним отчётом.
     """
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
     admin.register_admin_handlers(dp)
+    sub_runner = None
     try:
-        await app_conf.load_settings()  # Загружаем настройки из базы
+        with startup_timer.phase("база данных"):
+            await db_helpers.init_db()
+        with startup_timer.phase("настройки"):
+            await app_conf.load_settings()  # Загружаем настройки из базы
+            configure_bot_and_payments()
+        asyncio.create_task(run_settings_watcher()) # Запускаем применение изменённых настроек
+        if app_conf.get('warm_state_save_interval_sec', 300) > 0:
+            with startup_timer.phase("тёплое состояние"):
+                await warm_state.load()  # Сессии панелей, параметры inbounds, загрузка серверов
+        asyncio.create_task(warm_state.revalidate()) # Сверяем восстановленное с БД в фоне
+        asyncio.create_task(warm_state.run_warm_state_saver()) # Запускаем запись снимка тёплого состояния
         asyncio.create_task(notify_expiring_subscriptions())  # Запускаем напоминания о подписке
         asyncio.create_task(notify_expired_subscriptions()) # Запускаем уведомления об истекших подписках
+        asyncio.create_task(traffic_collector.run_traffic_collector()) # Запускаем сбор статистики трафика
+        asyncio.create_task(server_metrics.run_metrics_sampler()) # Запускаем мониторинг серверов
+        asyncio.create_task(xui_gc.run_expired_clients_gc()) # Запускаем удаление давно истёкших клиентов из X-UI
+        with startup_timer.phase("загрузка серверов"):
+            await server_load_table.ensure_loaded()  # Первая выдача не должна ждать агрегат по БД
+        asyncio.create_task(run_server_load_refresher()) # Запускаем сверку таблицы загрузки серверов с БД
+        asyncio.create_task(bulk_grant.run_bulk_grant_worker()) # Запускаем обработчик массовых начислений
+        asyncio.create_task(rebalancer.run_rebalancer(bot)) # Запускаем балансировку серверов
+        asyncio.create_task(secondary_servers.run_secondary_sync()) # Запускаем синхронизацию резервных серверов
+        asyncio.create_task(client_pool.run_client_pool_refill()) # Запускаем пополнение пула клиентов
+        with startup_timer.phase("раздача подписок"):
+            sub_runner = await sub_server.start_sub_server() # Запускаем раздачу подписок
         await dp.start_polling(bot)  # Запускаем polling aiogram
     finally:
+        if sub_runner:
+            await sub_runner.cleanup()
         if bot and bot.session:
             await bot.session.close()
 
@@ -0,0 +1,158 @@
+# message_templates.py
+"""
+Шаблоны сообщений из настроек (text_* и другие тексты с подстановками).
+
+Раньше каждое сообщение собиралось как app_conf.get('text_...').format(...): разбор большого
+HTML-шаблона на каждый ответ, а ошибка в {подстановке}, допущенная при правке текста
+в веб-админке, всплывала KeyError у пользователя. Теперь шаблон разбирается один раз
+на значение настройки (кэш сбрасывается обработчиком изменения настроек), подстановки
+из настроек (STATIC_FIELDS, например project_name) вписываются при разборе, а шаблоны
+без других подстановок (text_about_service) хранятся готовым текстом.
+Допустимые подстановки каждого текста перечислены в TEMPLATE_FIELDS — по ним веб-админка
+проверяет тексты при сохранении (validate_template).
+"""
+import string
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from loguru import logger
+
+from app_config import app_conf
+import db_helpers
+
+# Подстановки каждого шаблона; тексты, которых здесь нет, подстановок не содержат
+TEMPLATE_FIELDS: Dict[str, FrozenSet[str]] = {
+    'text_welcome_message': frozenset({'user_name', 'project_name'}),
+    'text_subscription_info': frozenset({'status', 'expiry_date', 'sub_link'}),
+    'text_payment_prompt': frozenset({'days', 'price', 'currency', 'payment_url'}),
+    'text_payment_success': frozenset({'days', 'expiry_date', 'sub_link'}),
+    'text_promo_code_success': frozenset({'code', 'days', 'expiry_date'}),
+    'text_trial_success': frozenset({'days', 'expiry_date', 'sub_link'}),
+    'text_trial_queue_position': frozenset({'position'}),
+    'text_android_guide': frozenset({'sub_link'}),
+    'text_ios_guide': frozenset({'sub_link'}),
+    'text_about_service': frozenset({'project_name'}),
+    'text_server_moved': frozenset({'sub_link'}),
+    'btn_renew_sub': frozenset({'days', 'price', 'currency'}),
+    'admin_text_promo_code_created': frozenset({'code'}),
+    'step_guide_2_text': frozenset({'sub_link'}),
+}
+
+# Подстановки, значения которых берутся из настроек и вписываются в шаблон при разборе
+STATIC_FIELDS = ('project_name',)
+
+_formatter = string.Formatter()
+
+
+class TemplateError(ValueError):
+    """Шаблон не разбирается или содержит недопустимые подстановки."""
+
+
+class CompiledTemplate:
+    """Разобранный шаблон: чередование готовых кусков текста и подстановок."""
+    __slots__ = ('key', 'literals', 'fields', 'static')
+
+    def __init__(self, key: str, literals: List[str], fields: List[Tuple[str, Optional[str], str]]):
+        self.key = key
+        # literals на один длиннее fields: текст до первой подстановки, между ними и после последней
+        self.literals = literals
+        self.fields = fields
+        self.static = ''.join(literals) if not fields else None
+
+    def render(self, values: Dict[str, Any]) -> str:
+        if self.static is not None:
+            return self.static
+        parts = [self.literals[0]]
+        for (name, conversion, format_spec), literal in zip(self.fields, self.literals[1:]):
+            try:
+                value = values[name]
+            except KeyError:
+                logger.error(f"Шаблон '{self.key}': не передано значение подстановки {{{name}}}.")
+                value = f"{{{name}}}"
+            else:
+                if conversion:
+                    value = _formatter.convert_field(value, conversion)
+                value = format(value, format_spec) if format_spec else str(value)
+            parts.append(value)
+            parts.append(literal)
+        return ''.join(parts)
+
+
+def compile_template(key: str, text: str, static_values: Optional[Dict[str, Any]] = None) -> CompiledTemplate:
+    """
+    Разбирает шаблон и проверяет подстановки по TEMPLATE_FIELDS; бросает TemplateError.
+    Подстановки из static_values сразу вписываются в текст.
+    """
+    allowed = TEMPLATE_FIELDS.get(key, frozenset())
+    literals = ['']
+    fields = []
+    try:
+        parsed = list(_formatter.parse(text))
+    except ValueError as e:
+        raise TemplateError(f"ошибка в фигурных скобках ({e}); чтобы вывести скобку, удвойте её: {{{{ или }}}}")
+    for literal, name, format_spec, conversion in parsed:
+        literals[-1] += literal
+        if name is None:
+            continue
+        if name not in allowed:
+            hint = ', '.join(f"{{{field}}}" for field in sorted(allowed)) or 'нет'
+            raise TemplateError(f"недопустимая подстановка {{{name}}}; допустимые: {hint}")
+        if '{' in (format_spec or ''):
+            raise TemplateError(f"вложенные подстановки в формате {{{name}}} не поддерживаются")
+        if static_values is not None and name in static_values:
+            value = static_values[name]
+            if conversion:
+                value = _formatter.convert_field(value, conversion)
+            try:
+                literals[-1] += format(value, format_spec) if format_spec else str(value)
+            except ValueError as e:
+                raise TemplateError(f"неверный формат подстановки {{{name}}}: {e}")
+            continue
+        fields.append((name, conversion, format_spec or ''))
+        literals.append('')
+    return CompiledTemplate(key, literals, fields)
+
+
+def validate_template(key: str, text: str) -> Optional[str]:
+    """Текст ошибки шаблона или None, если шаблон корректен; для проверки при сохранении."""
+    try:
+        compile_template(key, text)
+    except TemplateError as e:
+        return str(e)
+    return None
+
+
+# key -> разобранный шаблон для текущих настроек
+_compiled: Dict[str, CompiledTemplate] = {}
+
+
+def _get_compiled(key: str) -> CompiledTemplate:
+    compiled = _compiled.get(key)
+    if compiled is not None:
+        return compiled
+    static_values = {name: app_conf.get(name, '') for name in STATIC_FIELDS}
+    text = app_conf.get(key)
+    try:
+        compiled = compile_template(key, text if text is not None else '', static_values)
+    except TemplateError as e:
+        default = db_helpers._DEFAULT_SETTINGS.get(key)
+        logger.error(f"Шаблон '{key}' содержит ошибку: {e}. Используется текст по умолчанию.")
+        compiled = compile_template(key, default[0], static_values) if default else CompiledTemplate(key, [text], [])
+    _compiled[key] = compiled
+    return compiled
+
+
+def render(key: str, **values: Any) -> str:
+    """Текст настройки key с подстановками values."""
+    return _get_compiled(key).render(values)
+
+
+def _on_settings_reload(changed_keys: FrozenSet[str]):
+    """Сбрасывает разобранные шаблоны изменившихся текстов (все — если изменилась подстановка из настроек)."""
+    if any(name in changed_keys for name in STATIC_FIELDS):
+        _compiled.clear()
+        return
+    for key in changed_keys:
+        _compiled.pop(key, None)
+
+
+app_conf.add_reload_listener(_on_settings_reload)
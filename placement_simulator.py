@@ -0,0 +1,181 @@
+# placement_simulator.py
+"""
+Офлайн-симулятор стратегий размещения новых подписок (subscription_manager.PLACEMENT_STRATEGIES).
+
+Прогоняет одну и ту же последовательность регистраций через каждую стратегию и показывает,
+насколько ровно распределяется нагрузка: итоговые клиенты по серверам, средний и максимальный
+разброс загрузки (клиенты / ёмкость) между серверами и число размещений на перегруженный сервер.
+
+Регистрации берутся из БД (первый успешный платёж каждого пользователя)
+или генерируются (--synthetic). Серверы — из настройки xui_servers или из --weights.
+Ёмкость сервера = weight * --clients-per-weight; CPU в замерах моделируется как фоновая
+нагрузка узла плюс доля занятой ёмкости и обновляется раз в --sample-interval-min, как у сэмплера.
+
+Пример:
+    python placement_simulator.py --synthetic 5000 --weights 1,1,2 --days 30
+Рабочая БД только читается.
+"""
+import argparse
+import heapq
+import json
+import random
+import sqlite3
+import statistics
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import config
+from subscription_manager import (
+    PLACEMENT_STRATEGIES, PlacementStrategy, PowerOfTwoChoicesStrategy, LiveLoadStrategy, _server_weight
+)
+
+
+def load_recorded_signups(db_path: str, default_days: int) -> List[Tuple[float, int]]:
+    """
+    Первые успешные платежи пользователей: [(unix-время, дней подписки)]. Флаг is_renewal не смотрим:
+    бот ставит его каждому платежу, если у пользователя уже была подписка (в том числе пробная),
+    так что и первый платёж обычно помечен продлением.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT telegram_id, created_at, metadata_json FROM payments WHERE status = 'succeeded' ORDER BY created_at"
+        ).fetchall()
+    finally:
+        conn.close()
+    seen = set()
+    signups = []
+    for telegram_id, created_at, metadata_json in rows:
+        try:
+            metadata = json.loads(metadata_json) if metadata_json else {}
+            ts = datetime.fromisoformat(created_at).timestamp()
+        except (ValueError, TypeError):
+            continue
+        if telegram_id in seen:
+            continue
+        seen.add(telegram_id)
+        signups.append((ts, int(metadata.get('subscription_days') or default_days)))
+    return signups
+
+
+def synthetic_signups(count: int, per_day: float, days: int, seed: int) -> List[Tuple[float, int]]:
+    """Пуассоновский поток регистраций: per_day в среднем в сутки, срок подписки days."""
+    rng = random.Random(seed)
+    ts = 0.0
+    signups = []
+    for _ in range(count):
+        ts += rng.expovariate(per_day / 86400)
+        signups.append((ts, days))
+    return signups
+
+
+def load_servers(db_path: str) -> List[Dict]:
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute("SELECT value FROM settings WHERE key = 'xui_servers'").fetchone()
+    finally:
+        conn.close()
+    return json.loads(row[0]) if row and row[0] else []
+
+
+def make_strategy(name: str, args) -> PlacementStrategy:
+    """Экземпляр стратегии для симуляции: случайность и параметры не зависят от настроек бота."""
+    if name == 'p2c':
+        return PowerOfTwoChoicesStrategy(random.Random(args.seed))
+    if name == 'live_load':
+        return LiveLoadStrategy(load_factor=args.load_factor, max_load_percent=args.max_load_percent)
+    return PLACEMENT_STRATEGIES[name]
+
+
+def simulate(strategy: PlacementStrategy, servers: List[Dict], signups: List[Tuple[float, int]], args) -> Dict:
+    rng = random.Random(args.seed)
+    capacity = {s['id']: _server_weight(s) * args.clients_per_weight for s in servers}
+    base_load = {s['id']: rng.uniform(0, args.max_base_load) for s in servers}
+    counts = {s['id']: 0 for s in servers}
+    expiries: List[Tuple[float, int]] = []
+    samples: Dict[int, Dict] = {}
+    last_sample_ts = None
+    spreads = []
+    overloaded_placements = 0
+    rejected = 0
+
+    for ts, days in signups:
+        while expiries and expiries[0][0] <= ts:
+            counts[heapq.heappop(expiries)[1]] -= 1
+        if last_sample_ts is None or ts - last_sample_ts >= args.sample_interval_min * 60:
+            for server_id, count in counts.items():
+                cpu = min(100.0, base_load[server_id] + 100.0 * count / capacity[server_id] + rng.gauss(0, 2))
+                samples[server_id] = {'cpu': max(cpu, 0.0), 'mem': max(cpu * 0.8, 0.0)}
+            last_sample_ts = ts
+
+        candidates = [
+            {'config': s, 'count': counts[s['id']], 'sample': samples.get(s['id'])}
+            for s in servers
+            if not s.get('exclude_from_auto') and not (s.get('max_clients') and counts[s['id']] >= s['max_clients'])
+        ]
+        if not candidates:
+            rejected += 1
+            continue
+        chosen_id = strategy.choose(candidates)['config']['id']
+        if counts[chosen_id] >= capacity[chosen_id]:
+            overloaded_placements += 1
+        counts[chosen_id] += 1
+        heapq.heappush(expiries, (ts + days * 86400, chosen_id))
+
+        utilization = [counts[server_id] / capacity[server_id] for server_id in counts]
+        spreads.append(max(utilization) - min(utilization))
+
+    return {
+        'counts': counts,
+        'mean_spread': statistics.fmean(spreads) if spreads else 0.0,
+        'max_spread': max(spreads) if spreads else 0.0,
+        'peak_utilization': max((c / capacity[i] for i, c in counts.items()), default=0.0),
+        'overloaded': overloaded_placements,
+        'rejected': rejected,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение стратегий размещения подписок на записанных или сгенерированных регистрациях')
+    parser.add_argument('--db', default=config.DATABASE_NAME, help='БД бота (только чтение)')
+    parser.add_argument('--synthetic', type=int, default=0, help='Сгенерировать N регистраций вместо чтения из БД')
+    parser.add_argument('--per-day', type=float, default=100.0, help='Регистраций в сутки для --synthetic')
+    parser.add_argument('--days', type=int, default=30, help='Срок подписки по умолчанию')
+    parser.add_argument('--weights', default='', help='Серверы через запятую по весам, например 1,1,2 (вместо xui_servers из БД)')
+    parser.add_argument('--clients-per-weight', type=float, default=1000.0, help='Ёмкость сервера на единицу веса')
+    parser.add_argument('--max-base-load', type=float, default=30.0, help='Максимальная фоновая загрузка CPU узла, %%')
+    parser.add_argument('--sample-interval-min', type=float, default=1.0)
+    parser.add_argument('--load-factor', type=float, default=2.0)
+    parser.add_argument('--max-load-percent', type=float, default=90.0)
+    parser.add_argument('--strategies', default=','.join(PLACEMENT_STRATEGIES))
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.weights:
+        servers = [{'id': i, 'name': f"s{i}", 'weight': float(w)} for i, w in enumerate(args.weights.split(','), start=1)]
+    else:
+        servers = load_servers(args.db)
+    if args.synthetic:
+        signups = synthetic_signups(args.synthetic, args.per_day, args.days, args.seed)
+    else:
+        signups = load_recorded_signups(args.db, args.days)
+    if not servers:
+        print("Нет серверов для симуляции: в настройке xui_servers пусто, задайте их через --weights.")
+        return
+    if not signups:
+        print(f"В БД {args.db} нет успешных платежей, из которых можно взять регистрации; используйте --synthetic.")
+        return
+
+    print(f"Серверов: {len(servers)}, регистраций: {len(signups)}")
+    for name in args.strategies.split(','):
+        result = simulate(make_strategy(name.strip(), args), servers, signups, args)
+        counts = ' '.join(f"{server_id}:{count}" for server_id, count in result['counts'].items())
+        print(
+            f"{name:<10} разброс ср={result['mean_spread']:.3f} макс={result['max_spread']:.3f} "
+            f"пик={result['peak_utilization']:.2f} перегруз={result['overloaded']:<5} отказов={result['rejected']:<4} "
+            f"клиенты [{counts}]"
+        )
+
+
+if __name__ == '__main__':
+    main()
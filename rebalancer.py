@@ -0,0 +1,307 @@
+# rebalancer.py
+"""
+Фоновая балансировка подписок между серверами и вывод серверов (drain).
+
+Новые подписки распределяет choose_best_server, но уже выданные никуда не двигаются:
+после добавления сервера старые остаются перегруженными, а новый простаивает.
+Балансировщик раз в rebalance_interval_min считает целевую загрузку каждого сервера
+(все действующие подписки делятся пропорционально весам с учётом max_clients) и переносит
+с серверов, превысивших цель больше чем на rebalance_tolerance_percent, небольшую порцию
+пользователей на недогруженные — не больше rebalance_moves_per_hour в час.
+
+Первыми переносятся подписки, ближайшие к окончанию: этим пользователям всё равно скоро
+продлевать. Клиент переносится с тем же UUID, email и сроком: на новом сервере клиенты
+добавляются одним запросом на inbound, со старого снимаются по одному (remove_clients_one_by_one).
+Перед удалением со старого сервера inbound нового перечитывается и проверяется,
+что клиенты в нём действительно есть. Если на новом сервере уже есть копия клиента
+(резервный сервер, user_servers), основной становится она. Пользователь переключается на новый сервер
+в очереди его операций (run_user_operation) и только если подписка с момента выборки
+не менялась; иначе клиент снимается с нового сервера. Уведомления с новой ссылкой копятся в rebalance_moves
+и отправляются порциями; несколько переносов одного пользователя дают одно сообщение.
+
+Сервер с флагом drain в конфиге выводится: новые подписки на него не попадают
+(choose_best_server), а действующие переносятся на серверы, выбранные стратегией размещения,
+не больше drain_moves_per_hour в час. Ход вывода — get_drain_status.
+Очередь операций пользователя действует только внутри процесса, поэтому продление
+из веб-админки записывается в БД, только если пользователь всё ещё на прежнем сервере
+(update_user_subscription с expected_server_id), а иначе повторяется на новом.
+"""
+import asyncio
+import math
+import time
+from collections import defaultdict
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from loguru import logger
+
+from app_config import app_conf
+import db_helpers
+import message_templates
+from server_load import server_load_table, to_ts
+from subscription_manager import get_subscription_link, choose_best_server, run_user_operation, _server_weight
+from x_ui_manager import xui_manager_instance, get_inbound_ids
+
+# Сколько пользователей выводимого сервера переносить на один выбранный сервер-приёмник
+DRAIN_CHUNK_SIZE = 25
+
+
+def compute_targets(servers: Sequence[Mapping], counts: Dict[int, int]) -> Dict[int, float]:
+    """
+    Целевое число подписок на каждом сервере: все действующие подписки делятся пропорционально
+    весам; серверу, которому досталось бы больше max_clients, назначается его лимит,
+    а остаток делится между остальными.
+    """
+    left = sum(counts.get(server['id'], 0) for server in servers)
+    remaining = list(servers)
+    targets: Dict[int, float] = {}
+    while remaining:
+        weight_sum = sum(_server_weight(server) for server in remaining)
+        capped = [
+            server for server in remaining
+            if server.get('max_clients') and left * _server_weight(server) / weight_sum > server['max_clients']
+        ]
+        if not capped:
+            for server in remaining:
+                targets[server['id']] = left * _server_weight(server) / weight_sum
+            break
+        for server in capped:
+            targets[server['id']] = server['max_clients']
+            left = max(0, left - server['max_clients'])
+            remaining.remove(server)
+    return targets
+
+
+def plan_moves(targets: Dict[int, float], counts: Dict[int, int], tolerance_percent: float, budget: int) -> List[Tuple[int, int, int]]:
+    """
+    План переносов [(откуда, куда, сколько)] в пределах budget: с самых перегруженных
+    серверов на самые недогруженные. Сервер отдаёт пользователей, только если превысил
+    цель больше чем на tolerance_percent, и не опускается ниже цели.
+    """
+    excess = {}
+    deficit = {}
+    for server_id, target in targets.items():
+        count = counts.get(server_id, 0)
+        if count > target * (1 + tolerance_percent / 100) and count - target >= 1:
+            excess[server_id] = math.floor(count - target)
+        elif target - count >= 1:
+            deficit[server_id] = math.floor(target - count)
+
+    plan = []
+    while budget > 0 and excess and deficit:
+        from_id = max(excess, key=excess.get)
+        to_id = max(deficit, key=deficit.get)
+        count = min(excess[from_id], deficit[to_id], budget)
+        plan.append((from_id, to_id, count))
+        budget -= count
+        for table, server_id in ((excess, from_id), (deficit, to_id)):
+            table[server_id] -= count
+            if table[server_id] <= 0:
+                del table[server_id]
+    return plan
+
+
+async def move_users(from_conf: Mapping, to_conf: Mapping, limit: int, reason: str = 'rebalance') -> int:
+    """Переносит до limit подписок с одного сервера на другой. Возвращает число перенесённых."""
+    users = await db_helpers.get_rebalance_candidates(from_conf['id'], limit, to_server_id=to_conf['id'])
+    by_target_inbound: Dict[int, List[Dict]] = defaultdict(list)
+    for user in users:
+        # Если на сервере-приёмнике уже есть копия клиента (резервный сервер), основным становится она:
+        # добавить клиента с тем же email панель не даст
+        to_inbound = user['secondary_inbound_id'] or await xui_manager_instance.choose_inbound(to_conf)
+        by_target_inbound[to_inbound].append(user)
+
+    moved = 0
+    for to_inbound, group in by_target_inbound.items():
+        by_uuid = {user['xui_client_uuid']: user for user in group}
+        expiry_ms = {user['xui_client_uuid']: int(to_ts(user['subscription_end_date']) * 1000) for user in group}
+        to_restore = [user for user in group if not user['secondary_inbound_id']]
+        # Копии резервного сервера: срок в них мог отстать от БД, поэтому продлеваем их до даты подписки
+        reused = set()
+        to_extend = {user['xui_client_uuid']: expiry_ms[user['xui_client_uuid']] for user in group if user['secondary_inbound_id']}
+        if to_extend:
+            async def on_chunk(chunk: Dict[str, int], missing: set):
+                reused.update(client_uuid for client_uuid in chunk if client_uuid not in missing)
+                to_restore.extend(by_uuid[client_uuid] for client_uuid in missing)
+
+            await xui_manager_instance.set_clients_expiry_bulk(to_conf, to_inbound, [to_extend], on_chunk)
+        added = set(reused)
+        if to_restore:
+            added |= await xui_manager_instance.restore_clients_bulk(to_conf, to_inbound, [
+                {
+                    'uuid': user['xui_client_uuid'],
+                    'email': user['xui_client_email'],
+                    'expiry_timestamp_ms': expiry_ms[user['xui_client_uuid']],
+                    'telegram_id': user['telegram_id'],
+                    'limit_ip': user['limit_ip'],
+                }
+                for user in to_restore
+            ])
+        if not added:
+            logger.warning(f"Балансировка: не удалось добавить клиентов в inbound {to_inbound} сервера {to_conf['name']}.")
+            continue
+        # Удалять со старого сервера можно только тех, кто точно появился на новом
+        present = await xui_manager_instance.get_inbound_client_ids(to_conf, to_inbound)
+        if present is None:
+            logger.warning(f"Балансировка: не удалось проверить inbound {to_inbound} сервера {to_conf['name']}, перенос пачки отложен.")
+            continue
+        added &= present
+        # Переключение — в очереди операций пользователя: продление, начатое до переноса,
+        # иначе записало бы в БД старый сервер уже после переключения
+        applied = set()
+        for user in group:
+            if user['xui_client_uuid'] not in added:
+                continue
+            move = {
+                'telegram_id': user['telegram_id'], 'xui_client_uuid': user['xui_client_uuid'],
+                'subscription_end_date': user['subscription_end_date'],
+                'from_server_id': from_conf['id'], 'to_server_id': to_conf['id'], 'to_inbound_id': to_inbound,
+            }
+            applied.update(await run_user_operation(user['telegram_id'], db_helpers.apply_rebalance_moves, [move], reason=reason))
+
+        # Со старого сервера снимаем перенесённых, с нового — тех, чья подписка успела измениться
+        # (кроме копий резервного сервера: они там и остаются)
+        old_by_inbound: Dict[int, List[str]] = defaultdict(list)
+        stale = []
+        for user in group:
+            if user['telegram_id'] in applied:
+                old_by_inbound[user['current_inbound_id'] or get_inbound_ids(from_conf)[0]].append(user['xui_client_uuid'])
+                server_load_table.record_grant(to_conf['id'], user['subscription_end_date'],
+                                               old_server_id=from_conf['id'], old_expiry=user['subscription_end_date'])
+            elif user['xui_client_uuid'] in added and user['xui_client_uuid'] not in reused:
+                stale.append(user['xui_client_uuid'])
+        for inbound_id, client_uuids in old_by_inbound.items():
+            removed = await xui_manager_instance.remove_clients_one_by_one(from_conf, inbound_id, client_uuids)
+            if removed is None or not removed.issuperset(client_uuids):
+                logger.warning(f"Балансировка: не все перенесённые клиенты сняты с inbound {inbound_id} сервера {from_conf['name']}.")
+        if stale:
+            await xui_manager_instance.remove_clients_one_by_one(to_conf, to_inbound, stale)
+        moved += len(applied)
+
+    if moved:
+        logger.info(f"Балансировка: перенесено {moved} подписок с сервера {from_conf['name']} на {to_conf['name']}.")
+    return moved
+
+
+async def _pass_budget(per_hour: int, reason: str) -> int:
+    """
+    Сколько переносов можно сделать в этом проходе: остаток часового бюджета,
+    но не больше доли часа, приходящейся на один проход, — чтобы переносы шли равномерно.
+    """
+    if per_hour <= 0:
+        return 0
+    left_this_hour = per_hour - await db_helpers.count_rebalance_moves_since(int(time.time()) - 3600, reason=reason)
+    per_pass = math.ceil(per_hour * max(1, app_conf.get('rebalance_interval_min', 10)) / 60)
+    return max(0, min(left_this_hour, per_pass))
+
+
+async def rebalance_once() -> int:
+    """Один проход балансировки в пределах часового бюджета. Возвращает число перенесённых подписок."""
+    budget = await _pass_budget(app_conf.get('rebalance_moves_per_hour', 0), 'rebalance')
+    if budget <= 0:
+        return 0
+
+    await server_load_table.ensure_loaded()
+    servers = [
+        server for server in app_conf.get_servers()
+        if not server.get('exclude_from_auto') and not server.get('drain') and server_load_table.is_available(server['id'])
+    ]
+    if len(servers) < 2:
+        return 0
+    counts = server_load_table.get_counts()
+    targets = compute_targets(servers, counts)
+    plan = plan_moves(targets, counts, app_conf.get('rebalance_tolerance_percent', 10.0), budget)
+
+    moved = 0
+    for from_id, to_id, count in plan:
+        moved += await move_users(app_conf.get_server(from_id), app_conf.get_server(to_id), count)
+    return moved
+
+
+async def drain_once() -> int:
+    """Один проход вывода серверов с флагом drain. Возвращает число перенесённых подписок."""
+    draining = [server for server in app_conf.get_servers() if server.get('drain')]
+    if not draining:
+        return 0
+    budget = await _pass_budget(app_conf.get('drain_moves_per_hour', 300), 'drain')
+    moved = 0
+    for server in draining:
+        while budget > 0:
+            # Приёмник выбирается заново на каждую пачку: счётчики загрузки учитывают уже перенесённых
+            target = await choose_best_server()
+            if not target:
+                logger.warning(f"Вывод сервера {server['name']}: нет сервера, на который можно переносить пользователей.")
+                return moved
+            count = await move_users(server, target, min(DRAIN_CHUNK_SIZE, budget), reason='drain')
+            if count == 0:
+                break
+            budget -= count
+            moved += count
+    return moved
+
+
+async def get_drain_status(server_conf: Mapping) -> Optional[Dict]:
+    """
+    Ход вывода сервера для админки: осталось, перенесено с начала вывода и за час,
+    и ожидаемое время до конца (часы) при текущем drain_moves_per_hour. None — сервер не выводится.
+    """
+    if not server_conf.get('drain'):
+        return None
+    progress = await db_helpers.get_drain_progress(server_conf['id'], server_conf.get('drain_started_at'))
+    per_hour = app_conf.get('drain_moves_per_hour', 300)
+    progress['eta_hours'] = progress['remaining'] / per_hour if per_hour > 0 else None
+    done_and_left = progress['moved'] + progress['remaining']
+    progress['percent'] = 100.0 * progress['moved'] / done_and_left if done_and_left else 100.0
+    return progress
+
+
+def format_drain_status(status: Dict) -> str:
+    """Строка хода вывода сервера для админки."""
+    if status['remaining'] == 0:
+        return f"вывод завершён, перенесено {status['moved']}"
+    if status['eta_hours'] is None:
+        eta = "переносы выключены (drain_moves_per_hour = 0)"
+    elif status['eta_hours'] < 1:
+        eta = f"~{math.ceil(status['eta_hours'] * 60)} мин"
+    else:
+        eta = f"~{status['eta_hours']:.1f} ч"
+    return (f"осталось {status['remaining']}, перенесено {status['moved']} ({status['percent']:.0f}%), "
+            f"за час {status['moved_last_hour']}, до конца {eta}")
+
+
+async def send_move_notifications(bot: Bot) -> int:
+    """Отправляет очередную порцию уведомлений о новой ссылке. Возвращает число обработанных пользователей."""
+    batch = await db_helpers.get_pending_rebalance_notifications(app_conf.get('rebalance_notify_batch_size', 30))
+    stable_links = bool(app_conf.get('sub_public_url', '').strip())
+    notified = []
+    for user in batch:
+        server_conf = app_conf.get_server(user['current_server_id']) if user['current_server_id'] else None
+        # Подписку могли удалить после переноса — тогда и ссылку сообщать незачем.
+        # Постоянная ссылка через бота после переноса не меняется, сообщать тоже нечего.
+        if server_conf and user['xui_client_uuid'] and not (stable_links and user['sub_token']):
+            try:
+                await bot.send_message(user['telegram_id'], message_templates.render(
+                    'text_server_moved', sub_link=get_subscription_link(server_conf, user['xui_client_uuid'], user['sub_token'])))
+            except TelegramRetryAfter as e:
+                logger.warning(f"Балансировка: Telegram просит подождать {e.retry_after} с, остальные уведомления отправим в следующий раз.")
+                break
+            except TelegramAPIError as e:
+                logger.warning(f"Балансировка: не удалось уведомить пользователя {user['telegram_id']} о переносе: {e}")
+            await asyncio.sleep(0.05)
+        notified.append(user['telegram_id'])
+    if notified:
+        await db_helpers.mark_rebalance_notified(notified)
+    return len(notified)
+
+
+async def run_rebalancer(bot: Bot):
+    """Бесконечный цикл вывода серверов и балансировки; запускается из main.py как фоновая задача."""
+    while True:
+        await asyncio.sleep(max(1, app_conf.get('rebalance_interval_min', 10)) * 60)
+        try:
+            await drain_once()
+            await rebalance_once()
+            await send_move_notifications(bot)
+        except Exception as e:
+            logger.error(f"Ошибка в задаче балансировки серверов: {e}")
@@ -0,0 +1,187 @@
+# secondary_servers.py
+"""
+Резервные серверы подписок.
+
+Подписка живёт на основном сервере (users.current_server_id): если узел тормозит или лежит,
+пользователь ждёт, пока админ его перенесёт. При secondary_servers_count > 0 тот же клиент
+(UUID, email, срок) создаётся ещё на нескольких серверах (таблица user_servers), а подписка,
+которую раздаёт бот (sub_server.py), перечисляет все серверы в порядке их состояния
+и задержки по последним замерам сэмплера метрик (order_servers). Упавший узел уходит
+в конец списка при следующем обновлении подписки клиентом — без пересоздания клиентов.
+
+На пути выдачи панели резервных серверов не трогаются: раз в secondary_sync_interval_sec
+фоновая синхронизация назначает серверы новым подпискам, создаёт клиентов одним запросом
+на inbound, переносит продления запросами по отдельным клиентам и удаляет клиентов удалённых
+подписок и подписок, истёкших больше xui_gc_grace_days дней назад.
+"""
+import asyncio
+from collections import defaultdict
+from typing import Dict, List, Sequence
+
+from loguru import logger
+
+from app_config import app_conf
+import db_helpers
+from server_load import server_load_table, to_ts
+from subscription_manager import _server_weight
+from x_ui_manager import xui_manager_instance
+
+# Задержки в пределах одного интервала считаются равными, чтобы порядок не менялся от замера к замеру
+LATENCY_BUCKET_MS = 100
+
+
+def order_servers(server_ids: Sequence[int]) -> List[int]:
+    """
+    Серверы подписки в порядке предпочтения: сначала доступные по последнему замеру,
+    среди них — с меньшей задержкой API (с точностью до LATENCY_BUCKET_MS), серверы
+    без замеров — после измеренных. При равенстве сохраняется исходный порядок (основной первым).
+    """
+    def key(item):
+        position, server_id = item
+        if not server_load_table.is_available(server_id):
+            return (1, 0, position)
+        latency = (server_load_table.get_sample(server_id) or {}).get('latency_ms')
+        return (0, latency // LATENCY_BUCKET_MS if latency is not None else float('inf'), position)
+    return [server_id for _, server_id in sorted(enumerate(server_ids), key=key)]
+
+
+def pick_secondaries(primary_id: int, assigned: Sequence[int], needed: int, loads: Dict[int, int]) -> List[int]:
+    """
+    Резервные серверы для подписки: наименее загруженные относительно веса (основные
+    и резервные подписки вместе), кроме исключённых из автораспределения, выводимых и недоступных.
+    loads обновляется, чтобы подписки одного прохода не назначались на один и тот же сервер.
+    """
+    candidates = [
+        server_conf for server_conf in app_conf.get_servers()
+        if server_conf['id'] != primary_id and server_conf['id'] not in assigned
+        and not server_conf.get('exclude_from_auto') and not server_conf.get('drain')
+        and server_load_table.is_available(server_conf['id'])
+    ]
+    candidates.sort(key=lambda server_conf: loads.get(server_conf['id'], 0) / _server_weight(server_conf))
+    chosen = [server_conf['id'] for server_conf in candidates[:max(0, needed)]]
+    for server_id in chosen:
+        loads[server_id] = loads.get(server_id, 0) + 1
+    return chosen
+
+
+async def _remove_stale() -> int:
+    """Удаляет ненужных клиентов с резервных серверов. Возвращает число снятых назначений."""
+    stale = await db_helpers.get_stale_user_servers(app_conf.get('xui_gc_grace_days', 14))
+    by_inbound: Dict[tuple, List[Dict]] = defaultdict(list)
+    dropped = []
+    for row in stale:
+        if row['remove_client'] and row['inbound_id'] and app_conf.get_server(row['server_id']):
+            by_inbound[(row['server_id'], row['inbound_id'])].append(row)
+        else:
+            dropped.append((row['telegram_id'], row['server_id']))
+    for (server_id, inbound_id), rows in by_inbound.items():
+        removed = await xui_manager_instance.remove_clients_one_by_one(
+            app_conf.get_server(server_id), inbound_id, [row['client_uuid'] for row in rows]
+        )
+        if removed is None:
+            logger.warning(f"Резервные серверы: inbound {inbound_id} сервера {server_id} недоступен, удалим клиентов в следующий раз.")
+            continue
+        dropped.extend((row['telegram_id'], row['server_id']) for row in rows if row['client_uuid'] in removed)
+    if dropped:
+        await db_helpers.delete_user_servers(dropped)
+    return len(dropped)
+
+
+async def _assign_missing(count: int) -> int:
+    """Назначает резервные серверы подпискам, у которых их меньше count. Возвращает число назначений."""
+    missing = await db_helpers.get_users_missing_secondaries(count)
+    if not missing:
+        return 0
+    await server_load_table.ensure_loaded()
+    loads = server_load_table.get_counts()
+    for server_id, secondary_count in (await db_helpers.get_secondary_counts_by_server()).items():
+        loads[server_id] = loads.get(server_id, 0) + secondary_count
+    pairs = [
+        (user['telegram_id'], server_id)
+        for user in missing
+        for server_id in pick_secondaries(user['current_server_id'], user['server_ids'], count - len(user['server_ids']), loads)
+    ]
+    if pairs:
+        await db_helpers.add_user_servers(pairs)
+    return len(pairs)
+
+
+async def _sync_group(server_conf, inbound_id: int, rows: List[Dict]) -> List[Dict]:
+    """
+    Создаёт и продлевает клиентов одного inbound резервного сервера: продления — запросами
+    по отдельным клиентам, новые клиенты (и пропавшие из панели) — одним запросом.
+    Возвращает строки, чьё состояние теперь совпадает с БД.
+    """
+    by_uuid = {row['xui_client_uuid']: row for row in rows}
+    expiry_ms = {client_uuid: int(to_ts(row['subscription_end_date']) * 1000) for client_uuid, row in by_uuid.items()}
+    to_create = [row for row in rows if row['synced_end_date'] is None]
+    to_extend = {row['xui_client_uuid']: expiry_ms[row['xui_client_uuid']] for row in rows if row['synced_end_date'] is not None}
+    synced = []
+
+    if to_extend:
+        async def on_chunk(chunk: Dict[str, int], missing: set):
+            for client_uuid in chunk:
+                (to_create if client_uuid in missing else synced).append(by_uuid[client_uuid])
+
+        if not await xui_manager_instance.set_clients_expiry_bulk(server_conf, inbound_id, [to_extend], on_chunk):
+            # Inbound недоступен или часть продлений не применилась: фиксируем применённые, остальное — в следующий раз
+            return synced
+
+    if to_create:
+        added = await xui_manager_instance.restore_clients_bulk(server_conf, inbound_id, [
+            {'uuid': row['xui_client_uuid'], 'email': row['xui_client_email'], 'telegram_id': row['telegram_id'],
+             'expiry_timestamp_ms': expiry_ms[row['xui_client_uuid']], 'limit_ip': row['limit_ip']}
+            for row in to_create
+        ])
+        synced.extend(row for row in to_create if row['xui_client_uuid'] in added)
+    return synced
+
+
+async def sync_once() -> Dict[str, int]:
+    """Один проход синхронизации резервных серверов."""
+    stats = {'removed': await _remove_stale(), 'assigned': 0, 'synced': 0}
+    count = app_conf.get('secondary_servers_count', 0)
+    if count > 0:
+        stats['assigned'] = await _assign_missing(count)
+
+    groups: Dict[tuple, List[Dict]] = defaultdict(list)
+    unknown_servers = []
+    inbound_for_new: Dict[int, int] = {}
+    for row in await db_helpers.get_secondary_sync_work():
+        server_conf = app_conf.get_server(row['server_id'])
+        if server_conf is None:
+            unknown_servers.append((row['telegram_id'], row['server_id']))
+            continue
+        inbound_id = row['inbound_id']
+        if inbound_id is None:
+            if row['server_id'] not in inbound_for_new:
+                inbound_for_new[row['server_id']] = await xui_manager_instance.choose_inbound(server_conf)
+            inbound_id = inbound_for_new[row['server_id']]
+        groups[(row['server_id'], inbound_id)].append(row)
+    if unknown_servers:
+        await db_helpers.delete_user_servers(unknown_servers)
+
+    for (server_id, inbound_id), rows in groups.items():
+        synced = await _sync_group(app_conf.get_server(server_id), inbound_id, rows)
+        await db_helpers.mark_user_servers_synced([
+            (inbound_id, row['xui_client_uuid'], row['subscription_end_date'], row['telegram_id'], row['server_id'])
+            for row in synced
+        ])
+        stats['synced'] += len(synced)
+        if len(synced) < len(rows):
+            logger.warning(f"Резервные серверы: на сервере {server_id} (inbound {inbound_id}) не синхронизировано "
+                           f"{len(rows) - len(synced)} из {len(rows)} клиентов, повторим в следующий раз.")
+
+    if any(stats.values()):
+        logger.info(f"Резервные серверы: назначено {stats['assigned']}, синхронизировано {stats['synced']}, снято {stats['removed']}.")
+    return stats
+
+
+async def run_secondary_sync():
+    """Бесконечный цикл синхронизации резервных серверов; запускается из main.py как фоновая задача."""
+    while True:
+        try:
+            await sync_once()
+        except Exception as e:
+            logger.error(f"Глобальная ошибка в задаче синхронизации резервных серверов: {e}")
+        await asyncio.sleep(max(5, app_conf.get('secondary_sync_interval_sec', 60)))
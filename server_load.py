@@ -0,0 +1,192 @@
+# server_load.py
+"""
+Таблица загрузки серверов в памяти для выбора сервера новой подписки.
+
+Раньше choose_best_server на каждую выдачу ходил в панель каждого сервера (get_client)
+и делал по запросу COUNT в БД на сервер. Теперь число действующих подписок на сервере
+загружается один раз агрегатом GROUP BY current_server_id и дальше обновляется на лету:
+выдачи и продления добавляют подписку, удаления убирают, а истечения списываются
+по расписанию, которое хранится вместе со счётчиком (куча «когда и сколько истечёт»).
+Доступность серверов берётся из последних замеров сэмплера метрик (server_metrics.py).
+
+Веб-админка работает в отдельном процессе и её изменения сюда не попадают, поэтому таблица
+раз в server_load_refresh_sec пересобирается из БД фоновой задачей — не на пути выдачи.
+"""
+import asyncio
+import heapq
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from app_config import app_conf
+import db_helpers
+
+# Точность расписания истечений: подписки группируются по часу окончания (и в БД, и в памяти)
+EXPIRY_BUCKET_SEC = 3600
+
+
+def _bucket_end(ts: float) -> int:
+    """Конец часовой корзины, в которой истекает подписка, — так же, как в агрегате из БД."""
+    return (int(ts) // EXPIRY_BUCKET_SEC + 1) * EXPIRY_BUCKET_SEC
+
+
+def to_ts(value) -> Optional[float]:
+    """Дата окончания подписки (datetime или ISO-строка из БД) в unix-секундах."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        value = value.astimezone()
+    return value.timestamp()
+
+
+class ServerLoadTable:
+    def __init__(self):
+        # server_id -> число действующих подписок
+        self._active: Dict[int, int] = {}
+        # server_id -> куча (момент истечения, сколько подписок истекает)
+        self._expiries: Dict[int, List[tuple]] = {}
+        # server_id -> последний замер сэмплера (None — сервер не ответил)
+        self._samples: Dict[int, Optional[Dict]] = {}
+        self._loaded = False
+        # Журналы изменений идущих пересборок: (server_id, момент истечения, +1/-1)
+        self._journals: List[List[tuple]] = []
+
+    async def refresh(self):
+        """
+        Пересобирает таблицу одним агрегирующим запросом к БД. Выдачи и удаления, учтённые,
+        пока шёл запрос, записываются в журнал и применяются к новой таблице — иначе они бы потерялись.
+        Изменение, попавшее и в агрегат, и в журнал, посчитается дважды до следующей пересборки.
+        """
+        journal: List[tuple] = []
+        self._journals.append(journal)
+        try:
+            rows = await db_helpers.get_active_subscriptions_by_server(EXPIRY_BUCKET_SEC)
+        finally:
+            self._journals.remove(journal)
+        active: Dict[int, int] = {}
+        expiries: Dict[int, List[tuple]] = {}
+        for server_id, bucket_end, count in rows:
+            active[server_id] = active.get(server_id, 0) + count
+            expiries.setdefault(server_id, []).append((bucket_end, count))
+        for heap in expiries.values():
+            heapq.heapify(heap)
+        self._active, self._expiries, self._loaded = active, expiries, True
+        for server_id, expiry_ts, delta in journal:
+            self._apply_change(server_id, expiry_ts, delta)
+        logger.debug(f"Таблица загрузки серверов пересобрана: {active}, изменений за время запроса: {len(journal)}")
+
+    async def ensure_loaded(self):
+        """
+        Загружает таблицу при первом обращении; дальше обращения не делают I/O.
+        Одновременная первая загрузка из нескольких корутин безвредна — побеждает последняя.
+        """
+        if not self._loaded:
+            await self.refresh()
+
+    def _expire(self, server_id: int, now: float):
+        heap = self._expiries.get(server_id)
+        while heap and heap[0][0] <= now:
+            _, count = heapq.heappop(heap)
+            self._active[server_id] = max(0, self._active.get(server_id, 0) - count)
+
+    def get_counts(self, now: Optional[float] = None) -> Dict[int, int]:
+        """Число действующих подписок по серверам на момент now (по умолчанию — сейчас)."""
+        now = now or time.time()
+        for server_id in list(self._expiries):
+            self._expire(server_id, now)
+        return dict(self._active)
+
+    def get_count(self, server_id: int) -> int:
+        self._expire(server_id, time.time())
+        return self._active.get(server_id, 0)
+
+    def _apply_change(self, server_id: int, expiry_ts: float, delta: int):
+        """delta=+1 — подписка добавлена, -1 — снята (вместе с запланированным истечением)."""
+        self._expire(server_id, time.time())
+        self._active[server_id] = max(0, self._active.get(server_id, 0) + delta)
+        heapq.heappush(self._expiries.setdefault(server_id, []), (_bucket_end(expiry_ts), delta))
+
+    def _record_change(self, server_id: int, expiry_ts: float, delta: int):
+        if self._loaded:
+            self._apply_change(server_id, expiry_ts, delta)
+        for journal in self._journals:
+            journal.append((server_id, expiry_ts, delta))
+
+    def record_grant(self, server_id: int, new_expiry, old_server_id: Optional[int] = None, old_expiry=None):
+        """
+        Учитывает выдачу или продление подписки: прежняя подписка (если ещё действовала)
+        снимается со старого сервера, новая добавляется с новой датой окончания.
+        """
+        if not self._loaded and not self._journals:
+            return
+        now = time.time()
+        old_ts = to_ts(old_expiry)
+        if old_server_id is not None and old_ts and old_ts > now:
+            self._record_change(old_server_id, old_ts, -1)
+        new_ts = to_ts(new_expiry)
+        if new_ts and new_ts > now:
+            self._record_change(server_id, new_ts, 1)
+
+    def record_removal(self, server_id: Optional[int], expiry):
+        """Учитывает удаление действующей подписки."""
+        expiry_ts = to_ts(expiry)
+        if (not self._loaded and not self._journals) or server_id is None or not expiry_ts or expiry_ts <= time.time():
+            return
+        self._record_change(server_id, expiry_ts, -1)
+
+    def record_sample(self, server_id: int, sample: Optional[Dict]):
+        """Последний замер сэмплера метрик (cpu/mem/...); None — сервер не ответил."""
+        self._samples[server_id] = sample
+
+    def get_sample(self, server_id: int) -> Optional[Dict]:
+        return self._samples.get(server_id)
+
+    def is_available(self, server_id: int) -> bool:
+        """Сервер без замеров (сэмплер ещё не успел его опросить) считается доступным."""
+        return server_id not in self._samples or self._samples[server_id] is not None
+
+    def export_warm_state(self) -> Dict:
+        """Счётчики, расписание истечений и последние замеры для снимка тёплого состояния (warm_state.py)."""
+        return {
+            'loaded': self._loaded,
+            'active': [[server_id, count] for server_id, count in self._active.items()],
+            'expiries': [[server_id, list(heap)] for server_id, heap in self._expiries.items()],
+            'samples': [[server_id, sample] for server_id, sample in self._samples.items()],
+        }
+
+    def restore_warm_state(self, state: Dict) -> bool:
+        """
+        Восстанавливает таблицу из снимка, если она ещё не загружена. Подписки, истёкшие после
+        записи снимка, списываются по расписанию; изменения в БД за это время подтянет refresh().
+        """
+        if self._loaded or not state.get('loaded'):
+            return False
+        for server_id, sample in state.get('samples', []):
+            self._samples.setdefault(server_id, sample)
+        expiries = {server_id: [tuple(item) for item in heap] for server_id, heap in state.get('expiries', [])}
+        for heap in expiries.values():
+            heapq.heapify(heap)
+        self._active = {server_id: count for server_id, count in state.get('active', [])}
+        self._expiries = expiries
+        self._loaded = True
+        return True
+
+
+server_load_table = ServerLoadTable()
+
+
+async def run_server_load_refresher():
+    """Периодическая сверка таблицы загрузки с БД; запускается из main.py как фоновая задача."""
+    while True:
+        await asyncio.sleep(max(30, app_conf.get('server_load_refresh_sec', 300)))
+        try:
+            await server_load_table.refresh()
+        except Exception as e:
+            logger.error(f"Ошибка при пересборке таблицы загрузки серверов: {e}")
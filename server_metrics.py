@@ -0,0 +1,137 @@
+# server_metrics.py
+"""
+Фоновый сэмплер состояния X-UI серверов.
+
+Раз в server_metrics_interval_sec снимает с каждого сервера CPU, RAM, диск,
+число активных клиентов и задержку API и пишет замер в таблицу server_metrics
+(кольцевой буфер на сервер). Админка и веб-админка читают последний замер и
+историю из БД, поэтому число запросов к панелям зависит только от интервала
+сэмплирования, а не от того, как часто админы открывают страницу.
+
+Серверы опрашиваются параллельно, у каждого свой дедлайн (server_metrics_deadline_sec):
+один медленный узел помечается как таймаут и не задерживает остальных.
+"""
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from app_config import app_conf
+import db_helpers
+from server_load import server_load_table
+from x_ui_manager import xui_manager_instance
+
+SPARKLINE_BLOCKS = "▁▂▃▄▅▆▇█"
+
+
+async def sample_server(server_conf: Dict) -> Optional[Dict]:
+    """
+    Снимает и сохраняет один замер сервера с учётом дедлайна.
+    Возвращает замер или None, если сервер недоступен или не уложился в дедлайн.
+    """
+    deadline = app_conf.get('server_metrics_deadline_sec', 8)
+    error = None
+    try:
+        sample = await asyncio.wait_for(xui_manager_instance.get_server_metrics(server_conf), timeout=deadline)
+    except asyncio.TimeoutError:
+        logger.warning(f"Метрики: сервер {server_conf.get('name')} не ответил за {deadline} с.")
+        sample, error = None, 'timeout'
+    except Exception as e:
+        logger.error(f"Метрики: ошибка опроса сервера {server_conf.get('name')}: {e}")
+        sample = None
+    # Выбор сервера для новых подписок смотрит на доступность и нагрузку в памяти, а не опрашивает панели сам
+    server_load_table.record_sample(server_conf['id'], sample)
+    await db_helpers.add_server_metrics_sample(
+        server_conf['id'], int(time.time()), sample,
+        history_size=app_conf.get('server_metrics_history_size', 1440), error=error
+    )
+    return sample
+
+
+async def sample_all_servers(server_confs: Optional[List[Dict]] = None):
+    """
+    Один проход сэмплера: все серверы опрашиваются параллельно,
+    поэтому проход длится не дольше самого медленного сервера (но не дольше дедлайна).
+    """
+    server_confs = app_conf.get_servers() if server_confs is None else server_confs
+    await asyncio.gather(*(sample_server(server_conf) for server_conf in server_confs))
+
+
+async def refresh_stale_samples(max_age_sec: Optional[int] = None):
+    """
+    Переопрашивает только серверы, чей последний замер старше max_age_sec
+    (по умолчанию — интервал сэмплирования). Используется админкой перед показом статуса.
+    """
+    max_age_sec = max_age_sec or app_conf.get('server_metrics_interval_sec', 60)
+    latest = await db_helpers.get_latest_server_metrics()
+    now_ts = int(time.time())
+    stale = [
+        server_conf for server_conf in app_conf.get_servers()
+        if server_conf['id'] not in latest or now_ts - latest[server_conf['id']]['ts'] > max_age_sec
+    ]
+    if stale:
+        await sample_all_servers(stale)
+
+
+def get_sample_state(sample: Optional[Dict], now_ts: Optional[int] = None) -> str:
+    """
+    Состояние замера для отображения: 'none' — замеров нет, 'timeout' — сервер не уложился в дедлайн,
+    'offline' — недоступен, 'stale' — данные устарели (сэмплер давно не обновлял), 'ok'.
+    """
+    if not sample:
+        return 'none'
+    if not sample['ok']:
+        return 'timeout' if sample.get('error') == 'timeout' else 'offline'
+    now_ts = now_ts or int(time.time())
+    if now_ts - sample['ts'] > 3 * max(10, app_conf.get('server_metrics_interval_sec', 60)):
+        return 'stale'
+    return 'ok'
+
+
+async def run_metrics_sampler():
+    """Бесконечный цикл сэмплирования; запускается из main.py как фоновая задача."""
+    while True:
+        try:
+            await sample_all_servers()
+        except Exception as e:
+            logger.error(f"Глобальная ошибка в задаче сэмплирования серверов: {e}")
+        await asyncio.sleep(max(10, app_conf.get('server_metrics_interval_sec', 60)))
+
+
+def render_sparkline(values: List[Optional[float]], max_value: float = 100.0) -> str:
+    """Строит текстовый спарклайн из значений 0..max_value; пропуски рисуются пробелом."""
+    line = ""
+    for value in values:
+        if value is None:
+            line += " "
+            continue
+        ratio = min(max(value / max_value, 0.0), 1.0) if max_value else 0.0
+        line += SPARKLINE_BLOCKS[round(ratio * (len(SPARKLINE_BLOCKS) - 1))]
+    return line
+
+
+async def get_servers_overview(history_points: int = 24) -> List[Dict]:
+    """
+    Сводка по всем серверам для админки: конфиг, последний замер, его состояние и спарклайн CPU.
+    Не обращается к панелям — только к БД.
+    """
+    latest = await db_helpers.get_latest_server_metrics()
+    now_ts = int(time.time())
+    overview = []
+    for server_conf in app_conf.get_servers():
+        history = await db_helpers.get_server_metrics_history(server_conf['id'], limit=history_points)
+        sample = latest.get(server_conf['id'])
+        overview.append({
+            'config': server_conf,
+            'sample': sample,
+            'state': get_sample_state(sample, now_ts),
+            'age_sec': now_ts - sample['ts'] if sample else None,
+            'cpu_sparkline': render_sparkline([h['cpu'] if h['ok'] else None for h in history]),
+        })
+    return overview
+
+
+def format_metric(value: Optional[float]) -> str:
+    """Форматирует процентную метрику замера так же, как раньше это делал get_server_stats."""
+    return f"{value:.1f}" if value is not None else "N/A"
@@ -0,0 +1,261 @@
+# sub_server.py
+"""
+Раздача подписок самим ботом по постоянной ссылке {sub_public_url}/sub/{sub_token}.
+
+Раньше ссылка вела прямо на sub_path_prefix панели сервера: каждое обновление подписки
+в клиенте — запрос к панели, а перенос пользователя на другой сервер менял ссылку,
+и её приходилось заново рассылать. Теперь у пользователя один токен (users.sub_token),
+а тело подписки собирается из БД (сервер, inbound и UUID клиента) и параметров inbound
+из кэша XUIManager — панель опрашивается не чаще, чем раз в INBOUND_PARAMS_TTL_SEC на inbound.
+
+В подписку попадают основной сервер и резервные (secondary_servers.py) в порядке состояния
+и задержки по замерам сэмплера. Готовые тела хранятся в памяти вместе с отпечатком исходных
+данных и пересобираются, только когда отпечаток меняется (перенос, смена inbound, порядок
+серверов, обновлённые параметры inbound).
+ETag считается от тела: клиент с актуальной копией (If-None-Match) получает 304 без тела.
+
+Ссылки собираются самим ботом только для inbounds vless и vmess. Для остальных протоколов
+(trojan, shadowsocks и др.) ключи клиента в БД не хранятся, поэтому строки подписки
+для такого сервера берутся из подписки его панели (get_subscription_link без токена) —
+запрос к панели делается только при пересборке тела, а не на каждое обновление.
+
+Раздача включается настройкой sub_server_port; ссылки переключаются на неё настройкой
+sub_public_url (за ней обычно стоит обратный прокси с TLS).
+"""
+import asyncio
+import base64
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Dict, List, Mapping, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+import aiohttp
+from aiohttp import web
+from loguru import logger
+
+from app_config import app_conf
+import db_helpers
+from secondary_servers import order_servers
+from subscription_manager import get_subscription_link
+from server_load import server_load_table, to_ts
+from x_ui_manager import xui_manager_instance, get_inbound_ids
+
+# Сколько собранных тел подписок держать в памяти (вытесняются самые давно запрошенные)
+BODY_CACHE_SIZE = 20000
+# Таймаут запроса подписки у панели для протоколов, ссылки которых бот не собирает
+PANEL_SUB_TIMEOUT_SEC = 10
+
+# sub_token -> (отпечаток исходных данных, тело, ETag)
+_bodies: "OrderedDict[str, Tuple[tuple, bytes, str]]" = OrderedDict()
+
+
+def build_vless_link(server_conf: Mapping, params: Dict, client_uuid: str, remark: str) -> Optional[str]:
+    """Ссылка vless:// для клиента inbound по его streamSettings (reality, tls; tcp, ws, grpc)."""
+    if params.get('protocol') not in (None, 'vless'):
+        return None
+    stream = params.get('stream_settings') or {}
+    network = stream.get('network') or 'tcp'
+    security = stream.get('security') or 'none'
+    query = {'type': network, 'encryption': 'none', 'security': security}
+    if security == 'reality':
+        reality = stream.get('realitySettings') or {}
+        settings = reality.get('settings') or {}
+        query['pbk'] = settings.get('publicKey', '')
+        query['fp'] = settings.get('fingerprint') or 'chrome'
+        query['sni'] = (reality.get('serverNames') or [''])[0]
+        query['sid'] = (reality.get('shortIds') or [''])[0]
+        if settings.get('spiderX'):
+            query['spx'] = settings['spiderX']
+    elif security == 'tls':
+        tls = stream.get('tlsSettings') or {}
+        query['sni'] = tls.get('serverName', '')
+        if (tls.get('settings') or {}).get('fingerprint'):
+            query['fp'] = tls['settings']['fingerprint']
+        if tls.get('alpn'):
+            query['alpn'] = ','.join(tls['alpn'])
+    if network == 'ws':
+        ws = stream.get('wsSettings') or {}
+        query['path'] = ws.get('path', '/')
+        host = ws.get('host') or (ws.get('headers') or {}).get('Host')
+        if host:
+            query['host'] = host
+    elif network == 'grpc':
+        query['serviceName'] = (stream.get('grpcSettings') or {}).get('serviceName', '')
+    elif network == 'tcp':
+        header_type = ((stream.get('tcpSettings') or {}).get('header') or {}).get('type')
+        if header_type and header_type != 'none':
+            query['headerType'] = header_type
+    if params.get('flow'):
+        query['flow'] = params['flow']
+    return (f"vless://{client_uuid}@{server_conf['public_host']}:{params['port']}"
+            f"?{urlencode(query, quote_via=quote)}#{quote(remark)}")
+
+
+def build_vmess_link(server_conf: Mapping, params: Dict, client_uuid: str, remark: str) -> Optional[str]:
+    """Ссылка vmess:// (base64 JSON) для клиента inbound по его streamSettings (tls; tcp, ws, grpc)."""
+    if params.get('protocol') != 'vmess':
+        return None
+    stream = params.get('stream_settings') or {}
+    network = stream.get('network') or 'tcp'
+    security = stream.get('security') or 'none'
+    config = {
+        'v': '2', 'ps': remark, 'add': server_conf['public_host'], 'port': str(params['port']),
+        'id': client_uuid, 'aid': '0', 'scy': 'auto', 'net': network, 'type': 'none',
+        'host': '', 'path': '', 'tls': 'tls' if security == 'tls' else '',
+    }
+    if security == 'tls':
+        tls = stream.get('tlsSettings') or {}
+        config['sni'] = tls.get('serverName', '')
+        if (tls.get('settings') or {}).get('fingerprint'):
+            config['fp'] = tls['settings']['fingerprint']
+        if tls.get('alpn'):
+            config['alpn'] = ','.join(tls['alpn'])
+    if network == 'ws':
+        ws = stream.get('wsSettings') or {}
+        config['path'] = ws.get('path', '/')
+        config['host'] = ws.get('host') or (ws.get('headers') or {}).get('Host', '')
+    elif network == 'grpc':
+        config['path'] = (stream.get('grpcSettings') or {}).get('serviceName', '')
+    elif network == 'tcp':
+        config['type'] = ((stream.get('tcpSettings') or {}).get('header') or {}).get('type') or 'none'
+    return 'vmess://' + base64.b64encode(json.dumps(config, ensure_ascii=False).encode()).decode()
+
+
+def build_link(server_conf: Mapping, params: Dict, client_uuid: str, remark: str) -> Optional[str]:
+    """Ссылка клиента для inbound vless или vmess; None — протокол ботом не собирается."""
+    if params.get('protocol') == 'vmess':
+        return build_vmess_link(server_conf, params, client_uuid, remark)
+    return build_vless_link(server_conf, params, client_uuid, remark)
+
+
+async def _fetch_panel_links(server_conf: Mapping, client_uuid: str) -> Optional[List[str]]:
+    """Строки подписки клиента из подписки панели сервера; None — панель не ответила."""
+    url = get_subscription_link(server_conf, client_uuid)
+    try:
+        timeout = aiohttp.ClientTimeout(total=PANEL_SUB_TIMEOUT_SEC)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get(url, ssl=False) as response:
+                response.raise_for_status()
+                content = (await response.read()).strip()
+        try:
+            content = base64.b64decode(content + b'=' * (-len(content) % 4), validate=True)
+        except ValueError:
+            pass  # Панель отдала подписку без base64
+        return [line.strip() for line in content.decode().splitlines() if line.strip()]
+    except Exception as e:
+        logger.warning(f"Раздача подписок: не удалось получить подписку панели сервера {server_conf['name']}: {e}")
+        return None
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+async def _get_body(sub_token: str, client_uuid: str, servers: List[Tuple[Mapping, int]]) -> Optional[Tuple[bytes, str]]:
+    """
+    Тело подписки и ETag для серверов [(конфиг, inbound)] в заданном порядке;
+    пересобирается, только если изменились исходные данные.
+    """
+    # Параметры недоступного по замерам сервера не перезапрашиваем — берём последние известные
+    all_params = await asyncio.gather(*(
+        xui_manager_instance.get_inbound_params(server_conf, inbound_id, refresh=server_load_table.is_available(server_conf['id']))
+        for server_conf, inbound_id in servers
+    ))
+    entries = [(server_conf, inbound_id, params) for (server_conf, inbound_id), params in zip(servers, all_params) if params]
+    if not entries:
+        return None
+    # Записи реестра серверов неизменяемы, поэтому их можно держать в отпечатке как есть
+    fingerprint = (client_uuid,) + tuple((server_conf, inbound_id, params['fetched_at']) for server_conf, inbound_id, params in entries)
+    cached = _bodies.get(sub_token)
+    if cached and cached[0] == fingerprint:
+        _bodies.move_to_end(sub_token)
+        return cached[1], cached[2]
+
+    links = []
+    # Тело без строк недоступной панели не кэшируем, чтобы следующий запрос попробовал снова
+    complete = True
+    for server_conf, inbound_id, params in entries:
+        link = build_link(server_conf, params, client_uuid, f"{app_conf.get('project_name', 'VPN')} {server_conf['name']}")
+        if link is None:
+            logger.debug(f"Раздача подписок: протокол {params.get('protocol')} inbound {inbound_id} "
+                         f"сервера {server_conf['name']} — строки берём из подписки панели.")
+            panel_links = await _fetch_panel_links(server_conf, client_uuid)
+            if panel_links is None:
+                complete = False
+            else:
+                links.extend(panel_links)
+            continue
+        links.append(link)
+    if not links:
+        return None
+    body = base64.b64encode('\n'.join(links).encode())
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    if not complete:
+        return body, etag
+    _bodies[sub_token] = (fingerprint, body, etag)
+    _bodies.move_to_end(sub_token)
+    while len(_bodies) > BODY_CACHE_SIZE:
+        _bodies.popitem(last=False)
+    return body, etag
+
+
+async def handle_subscription(request: web.Request) -> web.Response:
+    sub_token = request.match_info['token']
+    user = await db_helpers.get_subscription_by_token(sub_token)
+    if not user or not user['xui_client_uuid'] or not user['current_server_id']:
+        raise web.HTTPNotFound()
+    # Основной сервер и резервные (secondary_servers.py) в порядке состояния и задержки
+    inbounds = {user['current_server_id']: user['current_inbound_id']}
+    for server_id, inbound_id in await db_helpers.get_user_secondary_servers(user['telegram_id']):
+        inbounds.setdefault(server_id, inbound_id)
+    servers = []
+    for server_id in order_servers(list(inbounds)):
+        server_conf = app_conf.get_server(server_id)
+        if server_conf is not None:
+            servers.append((server_conf, inbounds[server_id] or get_inbound_ids(server_conf)[0]))
+    if not servers:
+        raise web.HTTPNotFound()
+    result = await _get_body(sub_token, user['xui_client_uuid'], servers)
+    if result is None:
+        raise web.HTTPServiceUnavailable()
+    body, etag = result
+
+    traffic = await db_helpers.get_user_traffic_usage(user['telegram_id'], 0)
+    expire = int(to_ts(user['subscription_end_date']) or 0)
+    title = base64.b64encode(str(app_conf.get('project_name', 'VPN')).encode()).decode()
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+        'profile-title': f"base64:{title}",
+        'profile-update-interval': str(max(1, app_conf.get('sub_update_interval_hours', 12))),
+        'subscription-userinfo': f"upload={traffic['up']}; download={traffic['down']}; total=0; expire={expire}",
+    }
+    if _etag_matches(request.headers.get('If-None-Match'), etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, headers=headers, content_type='text/plain', charset='utf-8')
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get('/sub/{token}', handle_subscription)
+    return app
+
+
+async def start_sub_server() -> Optional[web.AppRunner]:
+    """Запускает раздачу подписок, если задан sub_server_port; запускается из main.py."""
+    port = app_conf.get('sub_server_port', 0)
+    if port <= 0:
+        return None
+    runner = web.AppRunner(create_app(), access_log=None)
+    await runner.setup()
+    host = app_conf.get('sub_server_host', '0.0.0.0')
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Раздача подписок запущена на {host}:{port}.")
+    return runner
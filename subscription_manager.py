@@ -4,70 +4,193 @@
 Он вынесен в отдельный файл, чтобы избежать циклических импортов
 между main.py, admin.py и web_admin/run.py.
 """
+import asyncio
+import random
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Any, Awaitable, Callable, Mapping
 
 from loguru import logger
 
+from admission import server_rate_limiter
 from app_config import app_conf
+import client_pool
 import db_helpers
-from x_ui_manager import xui_manager_instance
+from server_load import server_load_table
+from x_ui_manager import xui_manager_instance, get_inbound_ids
 
 
-async def choose_best_server() -> Optional[Dict]:
+# --- Стратегии размещения новых подписок ---
+# Кандидат — словарь {'config': конфиг сервера, 'count': действующих подписок, 'sample': последний замер или None}.
+# Все кандидаты уже прошли фильтры choose_best_server (exclude_from_auto, доступность, max_clients).
+
+def _server_weight(server_conf: Dict) -> float:
+    """Вес сервера из конфига ('weight', по умолчанию 1) — условная ёмкость узла относительно остальных."""
+    try:
+        return max(float(server_conf.get('weight', 1) or 1), 0.01)
+    except (TypeError, ValueError):
+        return 1.0
+
+
+class PlacementStrategy:
+    """Базовый класс стратегии: choose() возвращает одного кандидата из непустого списка."""
+    name = ''
+
+    def choose(self, candidates: List[Dict]) -> Dict:
+        raise NotImplementedError
+
+
+class PriorityStrategy(PlacementStrategy):
+    """Прежнее поведение: строго по приоритету (меньше — выше), внутри приоритета — меньше клиентов."""
+    name = 'priority'
+
+    def choose(self, candidates: List[Dict]) -> Dict:
+        return min(candidates, key=lambda c: (c['config'].get('priority', 0), c['count']))
+
+
+class WeightedLeastConnectionsStrategy(PlacementStrategy):
+    """Наименьшее число клиентов на единицу веса; приоритет только разрешает ничьи."""
+    name = 'weighted'
+
+    def choose(self, candidates: List[Dict]) -> Dict:
+        return min(candidates, key=lambda c: (c['count'] / _server_weight(c['config']), c['config'].get('priority', 0)))
+
+
+class PowerOfTwoChoicesStrategy(PlacementStrategy):
+    """
+    Два случайных кандидата (с вероятностью пропорционально весу), из них — менее загруженный на единицу веса.
+    Не даёт одновременным выдачам по устаревшим счётчикам всем попасть на один сервер.
+    """
+    name = 'p2c'
+
+    def __init__(self, rng: Optional[random.Random] = None):
+        self.rng = rng or random.Random()
+
+    def choose(self, candidates: List[Dict]) -> Dict:
+        if len(candidates) <= 2:
+            pair = candidates
+        else:
+            weights = [_server_weight(c['config']) for c in candidates]
+            first = self.rng.choices(range(len(candidates)), weights=weights)[0]
+            rest = [i for i in range(len(candidates)) if i != first]
+            second = self.rng.choices(rest, weights=[weights[i] for i in rest])[0]
+            pair = [candidates[first], candidates[second]]
+        return min(pair, key=lambda c: c['count'] / _server_weight(c['config']))
+
+
+class LiveLoadStrategy(PlacementStrategy):
+    """
+    Клиенты на единицу веса, умноженные на штраф за нагрузку по последнему замеру:
+    1 + placement_live_load_factor * max(cpu, mem) / 100. Серверы с нагрузкой выше
+    placement_max_load_percent получают новых клиентов, только если остальные тоже перегружены.
+    Без замера сервер оценивается только по клиентам.
+    """
+    name = 'live_load'
+
+    def __init__(self, load_factor: Optional[float] = None, max_load_percent: Optional[float] = None):
+        self.load_factor = load_factor
+        self.max_load_percent = max_load_percent
+
+    @staticmethod
+    def _pressure(candidate: Dict) -> float:
+        sample = candidate.get('sample') or {}
+        values = [v for v in (sample.get('cpu'), sample.get('mem')) if v is not None]
+        return max(values) if values else 0.0
+
+    def choose(self, candidates: List[Dict]) -> Dict:
+        load_factor = self.load_factor if self.load_factor is not None else app_conf.get('placement_live_load_factor', 2.0)
+        max_load = self.max_load_percent if self.max_load_percent is not None else app_conf.get('placement_max_load_percent', 90.0)
+        not_overloaded = [c for c in candidates if self._pressure(c) < max_load]
+        pool = not_overloaded or candidates
+
+        def score(c: Dict) -> float:
+            return (c['count'] + 1) / _server_weight(c['config']) * (1 + load_factor * self._pressure(c) / 100)
+
+        return min(pool, key=lambda c: (score(c), c['config'].get('priority', 0)))
+
+
+PLACEMENT_STRATEGIES: Dict[str, PlacementStrategy] = {}
+
+
+def register_placement_strategy(strategy: PlacementStrategy):
+    """Регистрирует стратегию под её name; её можно выбрать настройкой placement_strategy."""
+    PLACEMENT_STRATEGIES[strategy.name] = strategy
+
+
+for _strategy in (PriorityStrategy(), WeightedLeastConnectionsStrategy(), PowerOfTwoChoicesStrategy(), LiveLoadStrategy()):
+    register_placement_strategy(_strategy)
+
+
+def get_placement_strategy(name: Optional[str] = None) -> PlacementStrategy:
+    """Стратегия по имени (по умолчанию — из настройки placement_strategy); неизвестное имя — 'priority'."""
+    name = name or app_conf.get('placement_strategy', 'priority')
+    strategy = PLACEMENT_STRATEGIES.get(name)
+    if strategy is None:
+        logger.warning(f"Неизвестная стратегия размещения '{name}', используется 'priority'.")
+        strategy = PLACEMENT_STRATEGIES['priority']
+    return strategy
+
+
+async def choose_best_server() -> Optional[Mapping]:
     """
     Выбирает лучший сервер для новой подписки с учётом:
     - exclude_from_auto: сервер исключён из автораспределения
+    - drain: сервер выводится, его пользователи переносятся на другие (rebalancer.py)
     - max_clients: если лимит достигнут — сервер не участвует
-    - priority: сортировка по приоритету (меньше — выше)
-    - среди серверов с одинаковым приоритетом — по наименьшему количеству активных клиентов
+    - доступность по последнему замеру сэмплера метрик
+    Среди оставшихся сервер выбирает стратегия из настройки placement_strategy
+    (по умолчанию 'priority': по приоритету, затем по наименьшему количеству активных клиентов).
+    Счётчики и доступность серверов берутся из таблицы загрузки в памяти (server_load.py):
+    после первой загрузки выбор не обращается ни к панелям, ни к БД.
     """
-    xui_servers = app_conf.get('xui_servers', [])
+    xui_servers = app_conf.get_servers()
     if not xui_servers:
         logger.error("Список XUI_SERVERS в конфигурации пуст. Невозможно выбрать сервер.")
         return None
 
+    await server_load_table.ensure_loaded()
+    active_counts = server_load_table.get_counts()
+
     available_servers_with_counts = []
     for server_conf in xui_servers:
-        # Пропускаем серверы, исключённые из автораспределения
-        if server_conf.get('exclude_from_auto'):
+        # Пропускаем серверы, исключённые из автораспределения или выводимые
+        if server_conf.get('exclude_from_auto') or server_conf.get('drain'):
+            continue
+        # Доступность — по последнему замеру сэмплера метрик, без запроса к панели
+        if not server_load_table.is_available(server_conf['id']):
+            logger.warning(f"Сервер {server_conf['name']} недоступен по последнему замеру. Пропускаем.")
             continue
-        try:
-            api_client = await xui_manager_instance.get_client(server_conf)
-            if not api_client:
-                logger.warning(f"Сервер {server_conf['name']} недоступен. Пропускаем.")
-                continue
 
-            # Получаем количество активных клиентов из БД (только с действующей подпиской)
-            active_clients_count = await db_helpers.get_active_clients_count_for_server(server_conf['id'])
-            
-            # Пропускаем сервер, если достигнут лимит клиентов
-            max_clients = server_conf.get('max_clients', 0)
-            if max_clients and active_clients_count is not None and active_clients_count >= max_clients:
-                logger.info(f"Сервер {server_conf['name']} достиг лимита активных клиентов ({max_clients}). Пропускаем.")
-                continue
-            if active_clients_count is not None:
-                logger.info(f"Сервер {server_conf['name']}: {active_clients_count} активных клиентов.")
-                available_servers_with_counts.append({'config': server_conf, 'count': active_clients_count})
-            else:
-                logger.warning(f"Не удалось получить количество активных клиентов для сервера {server_conf['name']}. Пропускаем.")
-        except Exception as e:
-            logger.error(f"Ошибка при проверке сервера {server_conf['name']}: {e}. Пропускаем.")
+        active_clients_count = active_counts.get(server_conf['id'], 0)
+        # Пропускаем сервер, если достигнут лимит клиентов
+        max_clients = server_conf.get('max_clients', 0)
+        if max_clients and active_clients_count >= max_clients:
+            logger.info(f"Сервер {server_conf['name']} достиг лимита активных клиентов ({max_clients}). Пропускаем.")
             continue
+        logger.debug(f"Сервер {server_conf['name']}: {active_clients_count} активных клиентов.")
+        available_servers_with_counts.append({
+            'config': server_conf, 'count': active_clients_count,
+            'sample': server_load_table.get_sample(server_conf['id'])
+        })
 
     if not available_servers_with_counts:
         logger.error("Нет доступных серверов для выбора.")
         return None
 
-    # Сортировка: сначала по приоритету (меньше — выше), потом по количеству активных клиентов
-    available_servers_with_counts.sort(key=lambda x: (x['config'].get('priority', 0), x['count']))
-    best_server_data = available_servers_with_counts[0]
-    logger.info(f"Выбран сервер: {best_server_data['config']['name']} с {best_server_data['count']} активными клиентами.")
+    strategy = get_placement_strategy()
+    best_server_data = strategy.choose(available_servers_with_counts)
+    logger.info(f"Выбран сервер ({strategy.name}): {best_server_data['config']['name']} с {best_server_data['count']} активными клиентами.")
     return best_server_data['config']
 
 
-def get_subscription_link(server_config: dict, client_uuid: str) -> str:
-    """Генерирует публичную ссылку на подписку."""
+def get_subscription_link(server_config: dict, client_uuid: str, sub_token: Optional[str] = None) -> str:
+    """
+    Генерирует публичную ссылку на подписку. Если задан sub_public_url и у пользователя есть
+    токен, ссылка ведёт на раздачу подписок ботом (sub_server.py) и не меняется при переносе
+    пользователя между серверами; иначе — прямо на панель сервера.
+    """
+    sub_public_url = app_conf.get('sub_public_url', '').strip().rstrip('/')
+    if sub_public_url and sub_token:
+        return f"{sub_public_url}/sub/{sub_token}"
     protocol = server_config.get('public_protocol', "https")
     public_port = server_config.get('public_port')
     port_str = ""
@@ -79,22 +202,154 @@ def get_subscription_link(server_config: dict, client_uuid: str) -> str:
     return f"{protocol}://{server_config['public_host']}{port_str}/{server_config['sub_path_prefix'].strip('/')}/{client_uuid}"
 
 
-async def get_server_config(server_id: int) -> Optional[dict]:
-    """Находит конфигурацию сервера по его ID."""
-    xui_servers = app_conf.get('xui_servers', [])
-    for s_conf in xui_servers:
-        if s_conf.get('id') == server_id:
-            return s_conf
-    logger.warning(f"Конфигурация для server_id {server_id} не найдена.")
-    return None
+async def get_server_config(server_id: int) -> Optional[Mapping]:
+    """Находит конфигурацию сервера по его ID (неизменяемая запись реестра серверов)."""
+    server_conf = app_conf.get_server(server_id)
+    if server_conf is None:
+        logger.warning(f"Конфигурация для server_id {server_id} не найдена.")
+    return server_conf
+
+
+# --- Последовательное выполнение операций с подпиской одного пользователя ---
+# (user_id, event loop) -> [блокировка, число корутин, которые её держат или ждут]
+_user_locks: Dict[tuple, list] = {}
+# (user_id, request_key, event loop) -> future выполняющейся операции
+_inflight_operations: Dict[tuple, asyncio.Future] = {}
+
+
+async def run_user_operation(user_id: int, operation: Callable[..., Awaitable[Any]], *args,
+                             request_key: Optional[str] = None, **kwargs) -> Any:
+    """
+    Выполняет операцию, меняющую подписку пользователя (выдача, продление, удаление, смена сервера),
+    строго по одной на пользователя: остальные ждут своей очереди.
+    Если передан request_key (например, 'payment:<id>' или 'trial') и такая же операция
+    уже выполняется, повторный вызов не делает работу заново, а получает её результат.
+    Блокировки привязаны к event loop: веб-админка запускает корутины через asyncio.run.
+    """
+    loop = asyncio.get_running_loop()
+    inflight_key = (user_id, request_key, loop)
+    if request_key is not None:
+        inflight = _inflight_operations.get(inflight_key)
+        if inflight is not None:
+            logger.info(f"Пользователь {user_id}: операция '{request_key}' уже выполняется, ждём её результата.")
+            return await asyncio.shield(inflight)
+        inflight = _inflight_operations[inflight_key] = loop.create_future()
+    else:
+        inflight = None
+
+    lock_key = (user_id, loop)
+    lock_entry = _user_locks.setdefault(lock_key, [asyncio.Lock(), 0])
+    lock_entry[1] += 1
+    try:
+        async with lock_entry[0]:
+            result = await operation(*args, **kwargs)
+        if inflight is not None:
+            inflight.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        if inflight is not None and not inflight.done():
+            inflight.cancel()
+        raise
+    except Exception as e:
+        if inflight is not None and not inflight.done():
+            inflight.set_exception(e)
+            # Исключение получает сам вызывающий; ожидающих может не быть
+            inflight.exception()
+        raise
+    finally:
+        lock_entry[1] -= 1
+        if lock_entry[1] == 0:
+            _user_locks.pop(lock_key, None)
+        if inflight is not None:
+            _inflight_operations.pop(inflight_key, None)
+
+
+async def run_users_operation(user_ids: List[int], operation: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+    """
+    Выполняет операцию сразу над несколькими пользователями (пачка массового начисления),
+    заняв очередь каждого из них: их выдачи и продления ждут окончания операции.
+    Блокировки берутся по возрастанию user_id, а остальные операции держат не больше одной,
+    поэтому взаимной блокировки не возникает.
+    """
+    loop = asyncio.get_running_loop()
+    held = []
+    try:
+        for user_id in sorted(set(user_ids)):
+            lock_key = (user_id, loop)
+            lock_entry = _user_locks.setdefault(lock_key, [asyncio.Lock(), 0])
+            lock_entry[1] += 1
+            held.append([lock_key, lock_entry, False])
+            await lock_entry[0].acquire()
+            held[-1][2] = True
+        return await operation(*args, **kwargs)
+    finally:
+        for lock_key, lock_entry, acquired in reversed(held):
+            if acquired:
+                lock_entry[0].release()
+            lock_entry[1] -= 1
+            if lock_entry[1] == 0:
+                _user_locks.pop(lock_key, None)
 
 
-async def grant_subscription(user_id: int, days_to_add: int, is_trial: bool = False, limit_ip: int = 0) -> Optional[Dict]:
+async def grant_subscription(user_id: int, days_to_add: int, is_trial: bool = False, limit_ip: int = 0,
+                             request_key: Optional[str] = None, payment_id: Optional[str] = None) -> Optional[Dict]:
     """
     Универсальная функция для создания или продления подписки пользователя.
     Возвращает словарь с датой окончания и ссылкой или None в случае ошибки.
+    Выдачи одному пользователю выполняются по очереди; повторный вызов с тем же request_key,
+    пока первый ещё выполняется, получает его результат (см. run_user_operation).
+    Выдача по платежу (payment_id) записывается вместе с отметкой о платеже и выполняется
+    один раз: если платёж уже применён, возвращается действующая подписка.
+    """
+    return await run_user_operation(
+        user_id, _grant_subscription, user_id, days_to_add, is_trial, limit_ip, payment_id=payment_id, request_key=request_key
+    )
+
+
+async def _remove_moved_client(user_id: int, server_config: Dict, client_uuid: str, inbound_id: Optional[int]):
+    """
+    Снимает клиента со старого сервера пользователя, которого перенесли во время продления.
+    Клиента не трогаем, если пользователь на этом сервере (не перенесён) или сервер у него резервный.
     """
     user_data = await db_helpers.get_last_subscription(user_id)
+    if not user_data or user_data.get('current_server_id') == server_config['id']:
+        return
+    if any(server_id == server_config['id'] for server_id, _ in await db_helpers.get_user_secondary_servers(user_id)):
+        return
+    inbound_id = inbound_id or get_inbound_ids(server_config)[0]
+    removed = await xui_manager_instance.remove_clients_one_by_one(server_config, inbound_id, [client_uuid])
+    if removed is None or client_uuid not in removed:
+        logger.warning(f"Не удалось снять клиента {client_uuid} пользователя {user_id} со старого сервера {server_config['name']} после переноса.")
+
+
+async def _grant_subscription(user_id: int, days_to_add: int, is_trial: bool, limit_ip: int,
+                              retry_on_move: bool = True, payment_id: Optional[str] = None) -> Optional[Dict]:
+    user_data = await db_helpers.get_last_subscription(user_id)
+
+    # Подписка по платежу уже записана (например, до перезапуска бота), второй раз не продлеваем
+    if payment_id and await db_helpers.is_payment_applied(payment_id):
+        server_config = await get_server_config(user_data['current_server_id']) if user_data else None
+        if not server_config or not user_data.get('subscription_end_date'):
+            logger.error(f"Платёж {payment_id} уже применён, но подписка пользователя {user_id} не найдена.")
+            return None
+        logger.info(f"Платёж {payment_id} уже применён, возвращаем действующую подписку {user_id}.")
+        expiry_date = user_data['subscription_end_date']
+        if expiry_date.tzinfo is None:
+            expiry_date = expiry_date.astimezone()
+        return {"expiry_date": expiry_date,
+                "sub_link": get_subscription_link(server_config, user_data['xui_client_uuid'], user_data.get('sub_token'))}
+
+    # Пробный период мог быть выдан, пока этот запрос ждал очереди (двойное нажатие /start)
+    if is_trial and user_data and user_data.get('is_trial_used') and \
+            user_data.get('subscription_end_date') and user_data['subscription_end_date'] > datetime.now(user_data['subscription_end_date'].tzinfo):
+        server_config = await get_server_config(user_data['current_server_id'])
+        if server_config:
+            logger.info(f"Пробный период для {user_id} уже выдан, возвращаем действующую подписку.")
+            expiry_date = user_data['subscription_end_date']
+            if expiry_date.tzinfo is None:
+                expiry_date = expiry_date.astimezone()
+            return {"expiry_date": expiry_date,
+                    "sub_link": get_subscription_link(server_config, user_data['xui_client_uuid'], user_data.get('sub_token'))}
 
     # Продление существующей подписки
     if user_data and user_data.get('xui_client_uuid') and user_data.get('current_server_id'):
@@ -104,7 +359,6 @@ async def grant_subscription(user_id: int, days_to_add: int, is_trial: bool = Fa
             logger.error(f"Не найдена конфигурация сервера {server_id} для продления подписки {user_id}.")
             return None
 
-        server_config['telegram_id'] = user_id
         current_expiry = user_data.get('subscription_end_date')
         
         # Убедимся, что дата aware перед использованием
@@ -113,20 +367,33 @@ async def grant_subscription(user_id: int, days_to_add: int, is_trial: bool = Fa
             
         current_expiry_ms = int(current_expiry.timestamp() * 1000) if current_expiry else None
 
-        # Прокидываем лимит устройств
-        server_config['limit_ip'] = limit_ip
-
         xui_user_data = await xui_manager_instance.update_xui_user_subscription(
-            server_settings=server_config, client_uuid=client_uuid, new_days_valid=days_to_add, current_expiry_ms=current_expiry_ms, total_gb=0, limit_ip=limit_ip
+            server_settings=server_config, client_uuid=client_uuid, new_days_valid=days_to_add, current_expiry_ms=current_expiry_ms, total_gb=0, limit_ip=limit_ip,
+            inbound_id=user_data.get('current_inbound_id'), telegram_id=user_id
         )
 
         if xui_user_data and xui_user_data.get("uuid"):
             new_expiry_date = datetime.fromtimestamp(xui_user_data["expiry_timestamp_ms"] / 1000, tz=timezone.utc)
-            await db_helpers.update_user_subscription(
+            sub_token = await db_helpers.update_user_subscription(
                 telegram_id=user_id, xui_client_uuid=xui_user_data["uuid"], xui_client_email=user_data["xui_client_email"],
-                subscription_end_date=new_expiry_date, server_id=server_id, is_trial=is_trial, limit_ip=limit_ip
+                subscription_end_date=new_expiry_date, server_id=server_id, is_trial=is_trial, limit_ip=limit_ip,
+                inbound_id=xui_user_data.get("inbound_id"), expected_server_id=server_id, payment_id=payment_id
             )
-            return {"expiry_date": new_expiry_date, "sub_link": get_subscription_link(server_config, client_uuid)}
+            if sub_token is None:
+                # Пользователя перенесли (балансировка, вывод сервера — возможно, из другого процесса),
+                # пока шло продление: продлеваем на новом сервере. Перенос мог успеть снять клиента
+                # со старого сервера до продления, и тогда update_xui_user_subscription создал его заново —
+                # такого продлённого клиента снимаем сами. Если же платёж уже применён,
+                # повторный вызов просто вернёт действующую подписку
+                await _remove_moved_client(user_id, server_config, client_uuid,
+                                           xui_user_data.get("inbound_id") or user_data.get('current_inbound_id'))
+                if retry_on_move:
+                    return await _grant_subscription(user_id, days_to_add, is_trial, limit_ip, retry_on_move=False,
+                                                     payment_id=payment_id)
+                logger.error(f"Продление подписки {user_id} не записано: сервер пользователя снова сменился.")
+                return None
+            server_load_table.record_grant(server_id, new_expiry_date, old_server_id=server_id, old_expiry=current_expiry)
+            return {"expiry_date": new_expiry_date, "sub_link": get_subscription_link(server_config, client_uuid, sub_token)}
         else:
             logger.error(f"Ошибка продления подписки в X-UI для {user_id}")
             return None
@@ -137,21 +404,28 @@ async def grant_subscription(user_id: int, days_to_add: int, is_trial: bool = Fa
         if not server_config_to_use:
             logger.error(f"Не удалось выбрать сервер для новой подписки для {user_id}.")
             return None
-        
-        # Прокидываем лимит устройств
-        server_config_to_use['limit_ip'] = limit_ip
 
-        xui_user_data = await xui_manager_instance.create_xui_user(
-            server_settings=server_config_to_use, telegram_id=user_id, days_valid=days_to_add, total_gb=0, limit_ip=limit_ip
-        )
+        # Не больше admission_server_rate_per_min новых подписок в минуту на сервер (admission.py)
+        await server_rate_limiter.acquire(server_config_to_use['id'], app_conf.get('admission_server_rate_per_min', 0))
+        # Клиент из пула заранее созданных (client_pool.py) — без ожидания addClient в панели
+        xui_user_data = await client_pool.claim_client(server_config_to_use, user_id, days_to_add, limit_ip)
+        if not xui_user_data:
+            xui_user_data = await xui_manager_instance.create_xui_user(
+                server_settings=server_config_to_use, telegram_id=user_id, days_valid=days_to_add, total_gb=0, limit_ip=limit_ip
+            )
         
         if xui_user_data and xui_user_data.get("uuid"):
             expiry_date_dt = datetime.fromtimestamp(xui_user_data["expiry_timestamp_ms"] / 1000, tz=timezone.utc)
-            await db_helpers.update_user_subscription(
+            sub_token = await db_helpers.update_user_subscription(
                 telegram_id=user_id, xui_client_uuid=xui_user_data["uuid"], xui_client_email=xui_user_data["email"],
-                subscription_end_date=expiry_date_dt, server_id=server_config_to_use['id'], is_trial=is_trial, limit_ip=limit_ip
+                subscription_end_date=expiry_date_dt, server_id=server_config_to_use['id'], is_trial=is_trial, limit_ip=limit_ip,
+                inbound_id=xui_user_data.get("inbound_id"), payment_id=payment_id
             )
-            sub_link = get_subscription_link(server_config_to_use, xui_user_data["uuid"])
+            if payment_id and sub_token is None:
+                logger.error(f"Подписка {user_id} по платежу {payment_id} не записана: платёж уже применён.")
+                return None
+            server_load_table.record_grant(server_config_to_use['id'], expiry_date_dt)
+            sub_link = get_subscription_link(server_config_to_use, xui_user_data["uuid"], sub_token)
             return {"expiry_date": expiry_date_dt, "sub_link": sub_link}
         else:
             logger.error(f"Ошибка создания новой подписки в X-UI для {user_id}")
@@ -0,0 +1,81 @@
+# traffic_collector.py
+"""
+Фоновый сбор статистики трафика клиентов X-UI.
+
+Раз в traffic_collect_interval_sec опрашивает каждый inbound каждого сервера
+(один запрос на inbound, а не на пользователя), пишет дельты в таблицу traffic_usage
+и периодически сворачивает старые отсчёты: raw -> hour -> day.
+Админка и меню пользователя читают статистику из БД, не обращаясь к панели.
+"""
+import asyncio
+import time
+from typing import Dict
+
+from loguru import logger
+
+from app_config import app_conf
+import db_helpers
+from x_ui_manager import xui_manager_instance
+
+# Свёртку делаем не чаще раза в час — сырые отсчёты всё равно хранятся 48 часов
+DOWNSAMPLE_INTERVAL_SEC = 3600
+
+
+async def collect_traffic_once() -> int:
+    """Один проход сбора по всем серверам. Возвращает число записанных строк с дельтами."""
+    now_ts = int(time.time())
+    written = 0
+    for server_conf in app_conf.get_servers():
+        try:
+            counters = await xui_manager_instance.get_inbound_clients_traffic(server_conf)
+            if counters is None:
+                logger.warning(f"Сбор трафика: сервер {server_conf.get('name')} недоступен. Пропускаем.")
+                continue
+            written += await db_helpers.record_traffic_counters(server_conf['id'], counters, now_ts)
+        except Exception as e:
+            logger.error(f"Сбор трафика: ошибка на сервере {server_conf.get('name')}: {e}")
+    logger.debug(f"Сбор трафика завершён, записано {written} дельт.")
+    return written
+
+
+async def downsample_traffic():
+    """Сворачивает старые отсчёты и применяет сроки хранения из настроек."""
+    await db_helpers.downsample_traffic_usage(
+        raw_keep_sec=app_conf.get('traffic_raw_retention_hours', 48) * 3600,
+        hourly_keep_sec=app_conf.get('traffic_hourly_retention_days', 30) * 86400,
+        daily_keep_sec=app_conf.get('traffic_daily_retention_days', 365) * 86400,
+        now_ts=int(time.time())
+    )
+
+
+async def run_traffic_collector():
+    """Бесконечный цикл сбора трафика; запускается из main.py как фоновая задача."""
+    last_downsample = 0.0
+    while True:
+        try:
+            await collect_traffic_once()
+            if time.monotonic() - last_downsample >= DOWNSAMPLE_INTERVAL_SEC:
+                await downsample_traffic()
+                last_downsample = time.monotonic()
+        except Exception as e:
+            logger.error(f"Глобальная ошибка в задаче сбора трафика: {e}")
+        await asyncio.sleep(max(30, app_conf.get('traffic_collect_interval_sec', 300)))
+
+
+async def get_user_usage_summary(telegram_id: int) -> Dict[str, Dict[str, int]]:
+    """Трафик пользователя за последние сутки и 30 дней."""
+    now_ts = int(time.time())
+    return {
+        'day': await db_helpers.get_user_traffic_usage(telegram_id, now_ts - 86400),
+        'month': await db_helpers.get_user_traffic_usage(telegram_id, now_ts - 30 * 86400),
+    }
+
+
+def format_bytes(value: int) -> str:
+    """Человекочитаемый размер: 1.5 ГБ, 320.0 МБ и т.п."""
+    size = float(value or 0)
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != 'Б' else f"{int(size)} {unit}"
+        size /= 1024
+    return f"{size:.1f} ТБ"
@@ -0,0 +1,121 @@
+# warm_state.py
+"""
+Снимок тёплого состояния бота для быстрого перезапуска.
+
+После перезапуска все кэши были холодными: вход в каждую панель X-UI, параметры inbounds
+(первые ссылки подписок и выдачи ждали панель), таблица загрузки серверов (агрегат по всем
+пользователям до первой выдачи) и замеры серверов (пока сэмплер не опросит панели, все
+серверы считаются доступными). Теперь это состояние раз в warm_state_save_interval_sec
+и при остановке записывается в файл рядом с БД (JSON, сжатый zlib), а при запуске
+восстанавливается до начала обработки обновлений.
+
+Снимок не подменяет источники истины, а только даёт начальное состояние:
+- сессии панелей и параметры inbounds помечены отпечатком (sha256) адреса и учётных данных
+  сервера — сам пароль в файл не пишется — и отбрасываются, если конфигурация сервера в xui_servers с тех пор изменилась; сессии
+  проверяются фоновым прогревом подключений (запрос статуса), параметры inbounds
+  перечитываются по обычному сроку INBOUND_PARAMS_TTL_SEC;
+- таблица загрузки серверов (вместе с ней сохраняются последние замеры серверов)
+  пересобирается из БД в фоне сразу после запуска (revalidate);
+- снимки старше WARM_STATE_MAX_AGE_SEC или другого формата не используются.
+Файл содержит сессии панелей, поэтому создаётся с правами 0600.
+"""
+import asyncio
+import json
+import os
+import time
+import zlib
+from typing import Dict, Optional
+
+from loguru import logger
+
+from app_config import app_conf
+import db_helpers
+from server_load import server_load_table
+from x_ui_manager import xui_manager_instance
+
+# Формат 2: вместо учётных данных серверов хранится их отпечаток
+WARM_STATE_FORMAT = 2
+# Снимки старше суток не используем: сессии панелей и замеры к этому времени заведомо устарели
+WARM_STATE_MAX_AGE_SEC = 24 * 3600
+
+# Восстановлена ли таблица загрузки из снимка (тогда её нужно сверить с БД)
+_server_load_restored = False
+
+
+def warm_state_path() -> str:
+    return f"{db_helpers.DATABASE_NAME}.warm"
+
+
+def _write_file(path: str, data: bytes):
+    tmp_path = f"{path}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _read_file(path: str) -> Optional[Dict]:
+    try:
+        with open(path, 'rb') as f:
+            return json.loads(zlib.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+
+
+async def save() -> bool:
+    """Записывает снимок тёплого состояния."""
+    try:
+        state = {
+            'format': WARM_STATE_FORMAT,
+            'saved_at': time.time(),
+            'xui': xui_manager_instance.export_warm_state(),
+            'server_load': server_load_table.export_warm_state(),
+        }
+        data = zlib.compress(json.dumps(state, separators=(',', ':'), default=str).encode())
+        await asyncio.to_thread(_write_file, warm_state_path(), data)
+    except Exception as e:
+        logger.error(f"Не удалось записать снимок тёплого состояния: {e}")
+        return False
+    logger.debug(f"Снимок тёплого состояния записан ({len(data)} байт).")
+    return True
+
+
+async def load() -> bool:
+    """Восстанавливает кэши из снимка; вызывается при запуске после загрузки настроек."""
+    global _server_load_restored
+    try:
+        state = await asyncio.to_thread(_read_file, warm_state_path())
+    except Exception as e:
+        logger.warning(f"Снимок тёплого состояния не прочитан: {e}")
+        return False
+    if state is None:
+        return False
+    age = time.time() - state.get('saved_at', 0)
+    if state.get('format') != WARM_STATE_FORMAT or not 0 <= age <= WARM_STATE_MAX_AGE_SEC:
+        logger.info("Снимок тёплого состояния устарел или другого формата, запуск с холодными кэшами.")
+        return False
+    restored = xui_manager_instance.restore_warm_state(state.get('xui', {}))
+    _server_load_restored = server_load_table.restore_warm_state(state.get('server_load', {}))
+    logger.info(f"Восстановлено тёплое состояние {age:.0f} с давности: сессий панелей {restored['sessions']}, "
+                f"параметров inbounds {restored['inbound_params']}, "
+                f"таблица загрузки серверов {'восстановлена' if _server_load_restored else 'не восстановлена'}.")
+    return True
+
+
+async def revalidate():
+    """Сверяет восстановленную из снимка таблицу загрузки с БД; запускается в фоне после старта."""
+    if not _server_load_restored:
+        return
+    try:
+        await server_load_table.refresh()
+    except Exception as e:
+        logger.error(f"Ошибка при сверке восстановленной таблицы загрузки серверов с БД: {e}")
+
+
+async def run_warm_state_saver():
+    """Бесконечный цикл записи снимка; запускается из main.py как фоновая задача."""
+    while True:
+        interval = app_conf.get('warm_state_save_interval_sec', 300)
+        await asyncio.sleep(max(30, interval))
+        if interval > 0:
+            await save()
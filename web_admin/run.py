@@ -21,8 +21,10 @@ from keyboards import get_back_to_main_keyboard
 
 from x_ui_manager import XUIManager
 import db_helpers
-from subscription_manager import grant_subscription, get_subscription_link
+from subscription_manager import grant_subscription, get_subscription_link, run_user_operation
+import bulk_grant
 from app_config import app_conf
+from message_templates import validate_template
 
 xui_manager_instance = XUIManager()
 
@@ -65,6 +67,17 @@ def execute_db(query, args=()):
     db.execute(query, args)
     db.commit()
 
+@app.before_request
+def sync_settings():
+    """Применяет изменения настроек (в том числе сделанные ботом), если версия настроек в БД сменилась."""
+    try:
+        row = query_db("SELECT version FROM settings_version WHERE id = 1", one=True)
+    except sqlite3.OperationalError:
+        # База ещё не обновлена ботом до версии с отслеживанием изменений настроек
+        return
+    if row and row['version'] != app_conf.version:
+        asyncio.run(app_conf.reload_if_changed())
+
 
 # --- Модель пользователя для Flask-Login ---
 class AdminUser(UserMixin):
@@ -221,6 +234,8 @@ def change_user_server(telegram_id):
     from tg_sender import send_telegram_message
     try:
         async def do_change():
+            # Настройки нужны для ссылки на подписку (sub_public_url)
+            await app_conf.load_settings()
             # 1. Создать нового клиента на новом сервере с тем же сроком
             expiry_dt = datetime.fromisoformat(user['subscription_end_date'])
             now = datetime.now(expiry_dt.tzinfo)
@@ -232,21 +247,22 @@ def change_user_server(telegram_id):
                 return False, 'Ошибка создания клиента на новом сервере.'
             # 2. Удалить старого клиента, если сервер найден
             if old_server:
-                await xui_manager_instance.delete_xui_user(old_server, user['xui_client_uuid'])
+                await xui_manager_instance.delete_xui_user(old_server, user['xui_client_uuid'], inbound_id=user['current_inbound_id'])
                 old_server_name = old_server['name']
             else:
                 old_server_name = f"ID {user['current_server_id']} (удалён)"
             # 3. Обновить БД
-            await db_helpers.update_user_subscription(
+            sub_token = await db_helpers.update_user_subscription(
                 telegram_id=telegram_id,
                 xui_client_uuid=xui_user['uuid'],
                 xui_client_email=xui_user['email'],
                 subscription_end_date=expiry_dt,
                 server_id=new_server_id,
-                is_trial=bool(user['is_trial_used'])
+                is_trial=bool(user['is_trial_used']),
+                inbound_id=xui_user.get('inbound_id')
             )
             # 4. Сгенерировать новую ссылку
-            sub_link = get_subscription_link(new_server, xui_user['uuid'])
+            sub_link = get_subscription_link(new_server, xui_user['uuid'], sub_token)
             # 5. Уведомить пользователя
             text = (
                 'Вам был назначен новый сервер для VPN.\n'
@@ -259,7 +275,7 @@ def change_user_server(telegram_id):
             import logging
             logging.info(f"[ADMIN] Пользователь {telegram_id} перенесен с сервера {old_server_name} на {new_server['name']} до {expiry_dt}")
             return True, None
-        ok, err = asyncio.run(do_change())
+        ok, err = asyncio.run(run_user_operation(telegram_id, do_change, request_key='change_server'))
         if ok:
             flash('Сервер успешно изменён, пользователь уведомлён.', 'success')
         else:
@@ -294,7 +310,20 @@ def settings_general():
         'bot_token', 'project_name', 'admin_ids', 'support_link',
         'yookassa_shop_id', 'yookassa_secret_key',
         'admin_web_password',
-        'email_domain', 'trial_days'
+        'email_domain', 'trial_days',
+        'traffic_collect_interval_sec', 'traffic_raw_retention_hours',
+        'traffic_hourly_retention_days', 'traffic_daily_retention_days',
+        'server_metrics_interval_sec', 'server_metrics_history_size', 'server_metrics_deadline_sec',
+        'server_load_refresh_sec', 'placement_strategy', 'placement_live_load_factor', 'placement_max_load_percent',
+        'xui_add_batch_window_ms', 'xui_add_batch_max_size', 'xui_gc_grace_days', 'xui_gc_interval_hours',
+        'bulk_grant_chunk_size', 'bulk_grant_poll_sec',
+        'rebalance_moves_per_hour', 'rebalance_interval_min', 'rebalance_tolerance_percent', 'rebalance_notify_batch_size',
+        'drain_moves_per_hour',
+        'sub_public_url', 'sub_server_host', 'sub_server_port', 'sub_update_interval_hours',
+        'secondary_servers_count', 'secondary_sync_interval_sec',
+        'client_pool_size', 'client_pool_refill_sec', 'client_pool_refill_batch',
+        'admission_rate_per_min', 'admission_server_rate_per_min', 'admission_max_concurrent', 'admission_position_update_sec',
+        'settings_watch_interval_sec', 'warm_state_save_interval_sec'
     )
     general_settings = [s for s in settings if s['key'] in general_keys]
     return render_template('settings_general.html', settings=general_settings)
@@ -303,9 +332,18 @@ def settings_general():
 @login_required
 def settings_texts():
     if request.method == 'POST':
+        # Тексты с ошибкой в {подстановках} не сохраняем: иначе ошибка всплывёт у пользователя бота
+        errors = []
         for key, value in request.form.items():
+            error = validate_template(key, value)
+            if error:
+                errors.append(f"{key}: {error}")
+                continue
             execute_db("UPDATE settings SET value = ? WHERE key = ?", (value, key))
-        flash('Тексты успешно обновлены!', 'success')
+        if errors:
+            flash('Не сохранены тексты с ошибками: ' + '; '.join(errors), 'danger')
+        else:
+            flash('Тексты успешно обновлены!', 'success')
         return redirect(url_for('settings_texts'))
     settings = query_db("SELECT key, value, description FROM settings ORDER BY key")
     # Группируем тексты по категориям
@@ -331,7 +369,8 @@ def settings_texts():
         elif setting['key'].startswith('text_promo'):
             grouped_settings["Тексты: Промокоды"].append(setting)
         elif (setting['key'].startswith('text_android') or setting['key'].startswith('text_ios') 
-              or setting['key'].startswith('text_about') or setting['key'].startswith('text_trial_success')):
+              or setting['key'].startswith('text_about') or setting['key'].startswith('text_trial_success')
+              or setting['key'] in ('text_server_moved', 'text_trial_queue_position')):
             grouped_settings["Тексты: Инструкции и прочее"].append(setting)
         elif setting['key'].startswith('btn_'):
             grouped_settings["Тексты: Кнопки"].append(setting)
@@ -354,48 +393,144 @@ async def check_server_status_async(server_config):
         app.logger.error(f"Ошибка при проверке статуса сервера {server_config.get('name')}: {e}")
         return False
 
+def attach_server_metrics(servers_list, history_points=24):
+    """
+    Добавляет к серверам последний замер сэмплера и историю CPU из таблицы server_metrics.
+    Живых запросов к панелям не делает: замеры пишет бот раз в server_metrics_interval_sec.
+    """
+    latest_rows = query_db(
+        """SELECT m.* FROM server_metrics m
+           JOIN (SELECT server_id, MAX(ts) AS ts FROM server_metrics GROUP BY server_id) latest
+             ON latest.server_id = m.server_id AND latest.ts = m.ts"""
+    )
+    latest = {row['server_id']: row for row in latest_rows}
+    interval_row = query_db("SELECT value FROM settings WHERE key = 'server_metrics_interval_sec'", one=True)
+    stale_after = 3 * max(10, int(interval_row['value'])) if interval_row and interval_row['value'].isdigit() else 180
+    now_ts = int(datetime.now().timestamp())
+    for server in servers_list:
+        sample = latest.get(server.get('id'))
+        history = query_db(
+            "SELECT cpu, ok FROM server_metrics WHERE server_id = ? ORDER BY ts DESC LIMIT ?",
+            (server.get('id'), history_points)
+        )
+        if not sample:
+            server['status'] = None
+            server['state'] = 'none'
+            server['stats'] = None
+            continue
+        server['status'] = bool(sample['ok'])
+        # Те же состояния, что и в боте: ok, stale (сэмплер давно не обновлял), timeout, offline
+        if not sample['ok']:
+            server['state'] = 'timeout' if sample['error'] == 'timeout' else 'offline'
+        else:
+            server['state'] = 'stale' if now_ts - sample['ts'] > stale_after else 'ok'
+        server['stats'] = {
+            'cpu_usage': f"{sample['cpu']:.1f}" if sample['cpu'] is not None else 'N/A',
+            'memory_usage': f"{sample['mem']:.1f}" if sample['mem'] is not None else 'N/A',
+            'disk_usage': f"{sample['disk']:.1f}" if sample['disk'] is not None else 'N/A',
+            'active_users': str(sample['active_clients']) if sample['active_clients'] is not None else 'N/A',
+            'latency_ms': sample['latency_ms'],
+            'sampled_at': datetime.fromtimestamp(sample['ts']).strftime('%d.%m.%Y %H:%M:%S'),
+            'cpu_history': [row['cpu'] if row['ok'] else None for row in reversed(history)],
+        } if sample['ok'] else None
+    return servers_list
+
 @app.route('/settings/servers', methods=['GET', 'POST'])
 @login_required
 def settings_servers():
     servers_row = query_db("SELECT value FROM settings WHERE key = 'xui_servers'", one=True)
     servers_list = json.loads(servers_row['value']) if servers_row else []
 
-    async def get_all_statuses():
-        await app_conf.load_settings()
-        results = []
-        for s in servers_list:
-            status = False
-            stats = None
-            try:
-                client = await xui_manager_instance.get_client(s)
-                if client:
-                    status = True
-                    # Попробуем получить статистику, если реализовано
-                    try:
-                        stats = await xui_manager_instance.get_server_stats(s)
-                    except Exception:
-                        stats = None
-            except Exception:
-                status = False
-                stats = None
-            results.append((status, stats))
-        return results
-
-    # Запускаем асинхронную проверку статусов
     try:
-        statuses_stats = asyncio.run(get_all_statuses())
-        for server, (status, stats) in zip(servers_list, statuses_stats):
-            server['status'] = status
-            server['stats'] = stats
+        attach_server_metrics(servers_list)
     except Exception as e:
-        app.logger.error(f"Ошибка при запуске проверки статусов серверов: {e}")
-        flash("Не удалось проверить статусы серверов.", "warning")
+        app.logger.error(f"Ошибка при чтении метрик серверов: {e}")
+        flash("Не удалось получить статусы серверов.", "warning")
         for s in servers_list:
             s['status'] = None
+            s['state'] = 'none'
             s['stats'] = None
 
+    attach_drain_status(servers_list)
     return render_template('settings_servers.html', servers=servers_list)
 
+def attach_drain_status(servers_list):
+    """
+    Ход вывода для серверов с флагом drain (те же цифры, что rebalancer.get_drain_status в боте):
+    осталось действующих подписок, перенесено с начала вывода и за час, ETA при drain_moves_per_hour.
+    """
+    rate_row = query_db("SELECT value FROM settings WHERE key = 'drain_moves_per_hour'", one=True)
+    per_hour = int(rate_row['value']) if rate_row and str(rate_row['value']).isdigit() else 300
+    hour_ago = int(datetime.now(timezone.utc).timestamp()) - 3600
+    for server in servers_list:
+        if not server.get('drain'):
+            server['drain_status'] = None
+            continue
+        remaining = query_db(
+            """SELECT COUNT(*) FROM users
+               WHERE current_server_id = ? AND strftime('%s', subscription_end_date) > strftime('%s', 'now')""",
+            (server['id'],), one=True
+        )[0]
+        moved, moved_last_hour = query_db(
+            """SELECT COUNT(*), COALESCE(SUM(moved_at >= ?), 0) FROM rebalance_moves
+               WHERE from_server_id = ? AND reason = 'drain' AND moved_at >= ?""",
+            (hour_ago, server['id'], server.get('drain_started_at') or 0), one=True
+        )
+        server['drain_status'] = {
+            'remaining': remaining,
+            'moved': moved,
+            'moved_last_hour': moved_last_hour,
+            'percent': 100.0 * moved / (moved + remaining) if moved + remaining else 100.0,
+            'eta_hours': remaining / per_hour if per_hour > 0 else None,
+        }
+    return servers_list
+
+def apply_inbound_ids(server, raw_inbound_ids):
+    """
+    Дополнительные inbounds сервера из поля формы ("2, 3"). Основной inbound_id всегда первый;
+    если дополнительных нет, ключ inbound_ids удаляется и конфиг остаётся в старом формате.
+    """
+    inbound_ids = [server['inbound_id']]
+    for part in raw_inbound_ids.replace(';', ',').split(','):
+        part = part.strip()
+        if part.isdigit() and int(part) not in inbound_ids:
+            inbound_ids.append(int(part))
+    if len(inbound_ids) > 1:
+        server['inbound_ids'] = inbound_ids
+    else:
+        server.pop('inbound_ids', None)
+
+
+def set_server_drain(server, drain):
+    """Включает или выключает вывод сервера; момент включения нужен для хода вывода в админке."""
+    if drain and not server.get('drain'):
+        server['drain'] = True
+        server['drain_started_at'] = int(datetime.now(timezone.utc).timestamp())
+    elif not drain:
+        server.pop('drain', None)
+        server.pop('drain_started_at', None)
+
+
+@app.route('/settings/servers/<int:server_id>/drain', methods=['POST'])
+@login_required
+def toggle_server_drain(server_id):
+    """Начать (action=start) или остановить (action=stop) вывод сервера."""
+    servers_row = query_db("SELECT value FROM settings WHERE key = 'xui_servers'", one=True)
+    servers_list = json.loads(servers_row['value']) if servers_row else []
+    server = next((s for s in servers_list if s['id'] == server_id), None)
+    if not server:
+        flash(f'Сервер с ID {server_id} не найден.', 'danger')
+        return redirect(url_for('settings_servers'))
+    start = request.form.get('action', 'start') == 'start'
+    set_server_drain(server, start)
+    execute_db("UPDATE settings SET value = ? WHERE key = 'xui_servers'", (json.dumps(servers_list, indent=4),))
+    if start:
+        flash(f"Сервер '{server['name']}' выводится: новые подписки на него не выдаются, пользователи переносятся постепенно. <b>Не забудьте перезагрузить настройки в боте</b>.", 'success')
+    else:
+        flash(f"Вывод сервера '{server['name']}' остановлен. <b>Не забудьте перезагрузить настройки в боте</b>.", 'success')
+    return redirect(url_for('settings_servers'))
+
+
 @app.route('/settings/servers/edit/<int:server_id>', methods=['GET', 'POST'])
 @login_required
 def edit_server(server_id):
@@ -416,6 +551,9 @@ def edit_server(server_id):
         server_to_edit['username'] = request.form['username']
         server_to_edit['password'] = request.form['password']
         server_to_edit['inbound_id'] = int(request.form['inbound_id'])
+        # Если в форме нет поля inbound_ids, сохраняем уже настроенные дополнительные inbounds
+        existing_inbound_ids = ', '.join(str(i) for i in server_to_edit.get('inbound_ids', []))
+        apply_inbound_ids(server_to_edit, request.form.get('inbound_ids', existing_inbound_ids))
         server_to_edit['public_host'] = request.form['public_host']
         server_to_edit['public_port'] = int(request.form['public_port'])
         server_to_edit['sub_path_prefix'] = request.form['sub_path_prefix']
@@ -423,6 +561,8 @@ def edit_server(server_id):
         server_to_edit['exclude_from_auto'] = bool(int(request.form.get('exclude_from_auto', 0)))
         server_to_edit['max_clients'] = int(request.form.get('max_clients', 0))
         server_to_edit['priority'] = int(request.form.get('priority', 0))
+        server_to_edit['weight'] = float(request.form.get('weight', server_to_edit.get('weight', 1)))
+        set_server_drain(server_to_edit, bool(int(request.form.get('drain', int(server_to_edit.get('drain', False))))))
         
         # Сохраняем обновленный список
         updated_servers_json = json.dumps(servers_list, indent=4)
@@ -458,8 +598,11 @@ def add_server():
             # Новые поля для распределения
             'exclude_from_auto': bool(int(request.form.get('exclude_from_auto', 0))),
             'max_clients': int(request.form.get('max_clients', 0)),
-            'priority': int(request.form.get('priority', 0))
+            'priority': int(request.form.get('priority', 0)),
+            'weight': float(request.form.get('weight', 1))
         }
+        apply_inbound_ids(new_server, request.form.get('inbound_ids', ''))
+        set_server_drain(new_server, bool(int(request.form.get('drain', 0))))
         servers_list.append(new_server)
         
         updated_servers_json = json.dumps(servers_list, indent=4)
@@ -852,32 +995,13 @@ def api_server_statuses():
     servers_row = query_db("SELECT value FROM settings WHERE key = 'xui_servers'", one=True)
     servers_list = json.loads(servers_row['value']) if servers_row else []
 
-    async def get_all_statuses():
-        await app_conf.load_settings()
-        results = []
-        for s in servers_list:
-            status = False
-            stats = None
-            try:
-                client = await xui_manager_instance.get_client(s)
-                if client:
-                    status = True
-                    try:
-                        stats = await xui_manager_instance.get_server_stats(s)
-                    except Exception:
-                        stats = None
-            except Exception:
-                status = False
-                stats = None
-            results.append({
-                'id': s.get('id'),
-                'status': status,
-                'stats': stats or {},
-            })
-        return results
-
     try:
-        statuses = asyncio.run(get_all_statuses())
+        attach_server_metrics(servers_list)
+        attach_drain_status(servers_list)
+        statuses = [
+            {'id': s.get('id'), 'status': s['status'], 'state': s['state'], 'stats': s['stats'] or {}, 'drain': s['drain_status']}
+            for s in servers_list
+        ]
         return jsonify({'servers': statuses})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -919,6 +1043,7 @@ def migration():
         from subscription_manager import get_subscription_link
         from tg_sender import send_telegram_message
         async def do_migration():
+            await app_conf.load_settings()
             migrated = []
             failed = []
             error_details = []
@@ -945,16 +1070,17 @@ def migration():
                         error_details.append(f"ID: {user['telegram_id']} | {user['username']} — {e}")
                         continue
                     if old_server:
-                        await xui_manager_instance.delete_xui_user(old_server, user['xui_client_uuid'])
-                    await db_helpers.update_user_subscription(
+                        await xui_manager_instance.delete_xui_user(old_server, user['xui_client_uuid'], inbound_id=user['current_inbound_id'])
+                    sub_token = await db_helpers.update_user_subscription(
                         telegram_id=user['telegram_id'],
                         xui_client_uuid=xui_user['uuid'],
                         xui_client_email=xui_user['email'],
                         subscription_end_date=expiry_dt,
                         server_id=selected_to,
-                        is_trial=bool(user['is_trial_used'])
+                        is_trial=bool(user['is_trial_used']),
+                        inbound_id=xui_user.get('inbound_id')
                     )
-                    sub_link = get_subscription_link(new_server, xui_user['uuid'])
+                    sub_link = get_subscription_link(new_server, xui_user['uuid'], sub_token)
                     text = (
                         'Ваш VPN перенесён на новый сервер.\n'
                         f'{admin_message}\n\n'
@@ -996,7 +1122,7 @@ def delete_user(telegram_id):
         if old_server and user['xui_client_uuid']:
             import asyncio
             from x_ui_manager import xui_manager_instance
-            asyncio.run(xui_manager_instance.delete_xui_user(old_server, user['xui_client_uuid']))
+            asyncio.run(xui_manager_instance.delete_xui_user(old_server, user['xui_client_uuid'], inbound_id=user['current_inbound_id']))
     except Exception as e:
         # Игнорируем ошибку удаления с XUI
         pass
@@ -1057,6 +1183,39 @@ def api_paid_user_ids():
     ids = query_db("SELECT DISTINCT telegram_id FROM payments WHERE status = 'succeeded'", ())
     return jsonify({"user_ids": [row[0] for row in ids]})
 
+@app.route('/api/bulk_grants', methods=['GET', 'POST'])
+@login_required
+def api_bulk_grants():
+    """Список заданий массового начисления или создание нового (days, filter, comment). Обрабатывает их бот."""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        try:
+            days = int(data.get('days', 0))
+            job_id, total = asyncio.run(bulk_grant.create_job(days, data.get('filter', ''), data.get('comment') or None))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'id': job_id, 'total': total}), 201
+    jobs = query_db("SELECT * FROM bulk_grant_jobs ORDER BY id DESC LIMIT ?", (request.args.get('limit', 20, type=int),))
+    return jsonify({'jobs': [dict(job) for job in jobs]})
+
+@app.route('/api/bulk_grants/<int:job_id>')
+@login_required
+def api_bulk_grant(job_id):
+    job = query_db("SELECT * FROM bulk_grant_jobs WHERE id = ?", (job_id,), one=True)
+    if not job:
+        return jsonify({'error': 'not found'}), 404
+    failed = query_db(
+        "SELECT telegram_id, error FROM bulk_grant_items WHERE job_id = ? AND status = 'failed' LIMIT 100", (job_id,)
+    )
+    return jsonify({'job': dict(job), 'failed_items': [dict(item) for item in failed]})
+
+@app.route('/api/bulk_grants/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def api_bulk_grant_cancel(job_id):
+    if not asyncio.run(bulk_grant.cancel_job(job_id)):
+        return jsonify({'error': 'not found or already finished'}), 409
+    return jsonify({'status': 'canceled'})
+
 @app.route('/dev_tools', methods=['GET', 'POST'])
 @login_required
 def dev_tools():
@@ -1067,7 +1226,7 @@ def dev_tools():
             # Удаляем всех пользователей из XUI и БД
             servers_row = query_db("SELECT value FROM settings WHERE key = 'xui_servers'", one=True)
             servers = json.loads(servers_row['value']) if servers_row else []
-            users = query_db("SELECT telegram_id, xui_client_uuid, current_server_id FROM users", ())
+            users = query_db("SELECT telegram_id, xui_client_uuid, current_server_id, current_inbound_id FROM users", ())
             import asyncio
             from x_ui_manager import xui_manager_instance
             deleted_xui = 0
@@ -1080,7 +1239,7 @@ def dev_tools():
                     server = next((s for s in servers if s['id'] == server_id), None)
                     if server:
                         try:
-                            asyncio.run(xui_manager_instance.delete_xui_user(server, uuid))
+                            asyncio.run(xui_manager_instance.delete_xui_user(server, uuid, inbound_id=user['current_inbound_id']))
                             deleted_xui += 1
                         except Exception as e:
                             failed_xui += 1
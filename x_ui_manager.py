@@ -3,58 +3,188 @@ from py3xui import Api
 from py3xui.client import Client as XUIClientObj, Client
 from py3xui.inbound import Inbound
 from loguru import logger
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Awaitable, Callable
 from datetime import datetime, timedelta
 import uuid
+import hashlib
+import json
 import random
 import asyncio
+import time
 import db_helpers
 from app_config import app_conf # Импортируем наш менеджер настроек
 
+# Сколько секунд держим в кэше параметры inbound (flow, streamSettings)
+INBOUND_PARAMS_TTL_SEC = 600
+# Как часто перечитывать из БД заполненность inbounds сервера (между перечитываниями считаем сами)
+INBOUND_FILL_TTL_SEC = 300
+# Сколько запросов по отдельным клиентам (продление, удаление) отправлять в панель одновременно
+CLIENT_REQUESTS_CONCURRENCY = 8
+
+
+def get_inbound_ids(server_settings: Dict) -> List[int]:
+    """
+    Inbounds сервера для размещения клиентов: 'inbound_ids' из конфига,
+    а для старых конфигов — единственный 'inbound_id'. Первый в списке — основной.
+    """
+    inbound_ids = []
+    for inbound_id in server_settings.get('inbound_ids') or [server_settings['inbound_id']]:
+        if int(inbound_id) not in inbound_ids:
+            inbound_ids.append(int(inbound_id))
+    return inbound_ids
+
+
 class XUIManager:
     def __init__(self):
         self.clients: Dict[int, Api] = {}
+        # (server_id, inbound_id) -> параметры inbound, нужные для создания клиентов
+        self._inbound_params: Dict[tuple, Dict[str, Any]] = {}
+        # (server_id, inbound_id, event loop) -> копящийся пакет добавлений клиентов
+        self._add_batches: Dict[tuple, Dict[str, Any]] = {}
+        # (server_id, inbound_id, event loop) -> блокировка операций, переписывающих список клиентов inbound
+        self._inbound_locks: Dict[tuple, asyncio.Lock] = {}
+        # server_id -> {'counts': {inbound_id: клиентов}, 'fetched_at'} для размещения по заполненности
+        self._inbound_fill: Dict[int, Dict[str, Any]] = {}
+        # server_id -> адрес и учётные данные, с которыми создан клиент API
+        self._client_credentials: Dict[int, tuple] = {}
+        app_conf.add_reload_listener(self._on_settings_reload)
+
+    @staticmethod
+    def _credentials(server_settings) -> tuple:
+        return tuple(server_settings.get(key) for key in ('url', 'port', 'secret_path', 'username', 'password'))
+
+    @staticmethod
+    def _credentials_hash(credentials: tuple) -> str:
+        """Отпечаток адреса и учётных данных для снимка: сам пароль на диск не попадает."""
+        return hashlib.sha256(json.dumps(list(credentials)).encode()).hexdigest()
+
+    def _on_settings_reload(self, changed_keys):
+        """
+        Сбрасывает клиентов API и кэши inbounds серверов, у которых в xui_servers сменились
+        адрес или учётные данные (или которые удалены): следующий запрос войдёт в панель заново.
+        """
+        if 'xui_servers' not in changed_keys:
+            return
+        for server_id in list(self.clients):
+            server_settings = app_conf.get_server(server_id)
+            if server_settings is not None and self._credentials(server_settings) == self._client_credentials.get(server_id):
+                continue
+            logger.info(f"Настройки подключения к серверу {server_id} изменились, клиент X-UI будет создан заново.")
+            self.clients.pop(server_id, None)
+            self._client_credentials.pop(server_id, None)
+            self._inbound_fill.pop(server_id, None)
+            for key in [key for key in self._inbound_params if key[0] == server_id]:
+                del self._inbound_params[key]
+
+    def export_warm_state(self) -> Dict[str, Any]:
+        """
+        Сессии панелей и параметры inbounds для снимка тёплого состояния (warm_state.py).
+        Записи помечены отпечатком адреса и учётных данных сервера, моменты получения — в unix-времени.
+        """
+        wall_offset = time.time() - time.monotonic()
+        sessions = []
+        for server_id, client in self.clients.items():
+            if client.session and server_id in self._client_credentials:
+                sessions.append({
+                    'server_id': server_id, 'credentials': self._credentials_hash(self._client_credentials[server_id]),
+                    'session': client.session, 'cookie_name': client.cookie_name, 'csrf_token': client.csrf_token,
+                })
+        inbound_params = []
+        for (server_id, inbound_id), params in self._inbound_params.items():
+            server_settings = app_conf.get_server(server_id)
+            if server_settings is None:
+                continue
+            inbound_params.append({
+                'server_id': server_id, 'inbound_id': inbound_id,
+                'credentials': self._credentials_hash(self._credentials(server_settings)),
+                'params': {**params, 'fetched_at': params['fetched_at'] + wall_offset},
+            })
+        return {'sessions': sessions, 'inbound_params': inbound_params}
+
+    def restore_warm_state(self, state: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Восстанавливает сессии панелей и параметры inbounds из снимка. Записи серверов, у которых
+        с тех пор сменились адрес или учётные данные, пропускаются. Сессии проверяются
+        первым же get_client (запрос статуса), параметры inbounds перечитываются по INBOUND_PARAMS_TTL_SEC.
+        """
+        def current_credentials(server_id):
+            server_settings = app_conf.get_server(server_id)
+            return (server_settings, self._credentials(server_settings) if server_settings is not None else None)
+
+        restored = {'sessions': 0, 'inbound_params': 0}
+        for entry in state.get('sessions', []):
+            server_settings, credentials = current_credentials(entry['server_id'])
+            if credentials is None or self._credentials_hash(credentials) != entry['credentials'] or entry['server_id'] in self.clients:
+                continue
+            client = self._build_api(server_settings)
+            client.session = entry['session']
+            client.cookie_name = entry['cookie_name']
+            client.csrf_token = entry['csrf_token']
+            self.clients[entry['server_id']] = client
+            self._client_credentials[entry['server_id']] = credentials
+            restored['sessions'] += 1
+
+        monotonic_offset = time.monotonic() - time.time()
+        for entry in state.get('inbound_params', []):
+            _, credentials = current_credentials(entry['server_id'])
+            key = (entry['server_id'], entry['inbound_id'])
+            if credentials is None or self._credentials_hash(credentials) != entry['credentials'] or key in self._inbound_params:
+                continue
+            self._inbound_params[key] = {**entry['params'], 'fetched_at': entry['params']['fetched_at'] + monotonic_offset}
+            restored['inbound_params'] += 1
+        return restored
+
+    async def _run_blocking(self, func, *args, **kwargs):
+        """
+        Выполняет блокирующий вызов py3xui в пуле потоков, чтобы медленная панель
+        не останавливала event loop и запросы к разным серверам шли параллельно.
+        """
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    @staticmethod
+    def _build_api(server_settings: Dict) -> Api:
+        """Клиент API панели сервера (без входа)."""
+        url = server_settings['url']
+        if not url.startswith('http'):
+            url = f"https://{url}" 
+        
+        api_url = f"{url}:{server_settings['port']}"
+        if server_settings.get('secret_path'):
+             api_url += f"/{server_settings['secret_path'].strip('/')}"
+        
+        logger.debug(f"API URL для {server_settings['name']}: {api_url}")
+        
+        return Api(
+            api_url,
+            server_settings['username'],
+            server_settings['password'],
+            use_tls_verify=False 
+        )
 
     async def get_client(self, server_settings: Dict) -> Optional[Api]:
         server_id = server_settings['id']
         if server_id in self.clients:
             try:
-                status_check = self.clients[server_id].server.get_status()
+                status_check = await self._run_blocking(self.clients[server_id].server.get_status)
                 if status_check:
                     logger.debug(f"Использование существующего клиента для сервера {server_id}")
                     return self.clients[server_id]
                 else:
                     logger.warning(f"Существующий клиент для сервера {server_id} вернул невалидный статус. Создаем новый.")
-                    del self.clients[server_id]
+                    self.clients.pop(server_id, None)
             except Exception as e:
                 logger.warning(f"Существующий клиент для сервера {server_id} невалиден: {e}. Создаем новый.")
-                del self.clients[server_id]
+                self.clients.pop(server_id, None)
         
         try:
             logger.info(f"Создание X-UI клиента для сервера {server_id} ({server_settings['name']})")
-            
-            url = server_settings['url']
-            if not url.startswith('http'):
-                url = f"https://{url}" 
-            
-            api_url = f"{url}:{server_settings['port']}"
-            if server_settings.get('secret_path'):
-                 api_url += f"/{server_settings['secret_path'].strip('/')}"
-            
-            logger.debug(f"API URL для {server_settings['name']}: {api_url}")
-            
-            client = Api(
-                api_url,
-                server_settings['username'],
-                server_settings['password'],
-                use_tls_verify=False 
-            )
-            
-            client.login() 
-            inbounds = client.inbound.get_list() 
+            client = self._build_api(server_settings)
+            await self._run_blocking(client.login)
+            inbounds = await self._run_blocking(client.inbound.get_list)
             logger.info(f"Подключение к {server_settings['name']} успешно. Найдено {len(inbounds) if inbounds else 0} inbounds.")
             
             self.clients[server_id] = client
+            self._client_credentials[server_id] = self._credentials(server_settings)
             return client
             
         except Exception as e:
@@ -74,44 +204,221 @@ class XUIManager:
             logger.error(f"Ошибка при получении inbound {inbound_id}: {e}")
             return None
 
-    def _find_client_by_email_or_uuid(self, xui_api_client: Api, inbound_id: int, identifier: str) -> Optional[XUIClientObj]:
+    def _get_inbound_raw(self, client_api: Api, inbound_id: int) -> Optional[Dict]:
+        """
+        Inbound в виде сырого JSON панели, без построения pydantic-моделей для каждого клиента.
+        settings/streamSettings остаются строками — разбираем только то, что нужно вызывающему.
+        """
         try:
-            if '@' in identifier:
-                client_obj = xui_api_client.client.get_by_email(identifier) 
-                if client_obj and client_obj.inbound_id == inbound_id:
-                    return client_obj
+            url = client_api.inbound._url(f"panel/api/inbounds/get/{inbound_id}")
+            response = client_api.inbound._get(url, {"Accept": "application/json"})
+            return response.json().get('obj')
+        except Exception as e:
+            logger.error(f"Ошибка при получении inbound {inbound_id}: {e}")
+            return None
 
+    @staticmethod
+    def _raw_json_field(inbound_raw: Dict, field: str) -> Dict:
+        """Панель отдаёт settings/streamSettings JSON-строкой; возвращает их как dict."""
+        value = inbound_raw.get(field) or {}
+        if isinstance(value, str):
             try:
-                inbound_data = self._find_inbound_by_id(xui_api_client, inbound_id)
-                if inbound_data and hasattr(inbound_data, 'settings') and inbound_data.settings and \
-                   hasattr(inbound_data.settings, 'clients') and inbound_data.settings.clients:
-                    for c in inbound_data.settings.clients:
-                        if c.id == identifier: 
-                            return c 
-            except Exception as e:
-                logger.debug(f"Поиск клиента по UUID {identifier} в inbound не удался: {e}")
-
-            inbound = self._find_inbound_by_id(xui_api_client, inbound_id)
-            if inbound and hasattr(inbound, 'settings') and inbound.settings and \
-               hasattr(inbound.settings, 'clients') and inbound.settings.clients:
-                for client_data in inbound.settings.clients: 
-                    if client_data.email == identifier or client_data.id == identifier:
-                        return client_data
+                value = json.loads(value)
+            except json.JSONDecodeError:
+                value = {}
+        return value
+
+    @staticmethod
+    def _flow_from_stream_settings(stream_settings: Dict) -> str:
+        xtls_settings = stream_settings.get('xtlsSettings') or {}
+        if xtls_settings.get('flow'):
+            return xtls_settings['flow']
+        if stream_settings.get('realitySettings'):
+            return "xtls-rprx-vision"
+        return ""
+
+    async def _get_inbound_params(self, server_settings: Dict, client_api: Api, inbound_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Параметры inbound, нужные для создания/обновления клиентов (flow, протокол, streamSettings).
+        Кэшируются на INBOUND_PARAMS_TTL_SEC, чтобы не скачивать inbound целиком на каждую выдачу.
+        """
+        key = (server_settings['id'], inbound_id)
+        cached = self._inbound_params.get(key)
+        if cached and time.monotonic() - cached['fetched_at'] < INBOUND_PARAMS_TTL_SEC:
+            return cached
+
+        inbound_raw = await self._run_blocking(self._get_inbound_raw, client_api, inbound_id)
+        if not inbound_raw:
+            return None
+        stream_settings = self._raw_json_field(inbound_raw, 'streamSettings')
+        params = {
+            'flow': self._flow_from_stream_settings(stream_settings),
+            'protocol': inbound_raw.get('protocol'),
+            'port': inbound_raw.get('port'),
+            'stream_settings': stream_settings,
+            'fetched_at': time.monotonic(),
+        }
+        self._inbound_params[key] = params
+        return params
+
+    def _find_client_by_email_or_uuid(self, xui_api_client: Api, inbound_id: int, identifier: str,
+                                      email_hint: Optional[str] = None) -> Optional[XUIClientObj]:
+        """
+        Точечный поиск одного клиента. Если известен email (identifier или email_hint из БД),
+        спрашиваем панель только про этого клиента (clients/get/{email}) — стоимость не зависит
+        от размера inbound. Если панель такого маршрута не знает или email неизвестен —
+        разбираем сырой JSON inbound и строим модель только для найденного клиента.
+        """
+        try:
+            is_email = '@' in identifier
+            email = identifier if is_email else email_hint
+            if email:
+                try:
+                    client_obj = xui_api_client.client.get_by_email(email)
+                    if client_obj is None:
+                        return None
+                    if client_obj.id and client_obj.inbound_id in (None, inbound_id) and \
+                       (is_email or str(client_obj.id) == identifier):
+                        return client_obj
+                except Exception as e:
+                    logger.debug(f"Точечный поиск клиента {email} не удался: {e}. Ищем в inbound {inbound_id}.")
+
+            inbound_raw = self._get_inbound_raw(xui_api_client, inbound_id)
+            if not inbound_raw:
+                return None
+            for client_data in self._raw_json_field(inbound_raw, 'settings').get('clients', []):
+                if client_data.get('email') == identifier or client_data.get('id') == identifier:
+                    return XUIClientObj.model_validate({**client_data, 'inboundId': inbound_id})
             return None
         except Exception as e:
             logger.error(f"Ошибка при поиске клиента '{identifier}' в inbound {inbound_id}: {e}")
             return None
 
-    async def check_client_exists(self, server_settings: Dict, client_uuid: str) -> bool:
+    async def _lookup_client(self, client_api: Api, inbound_id: int, identifier: str) -> Optional[XUIClientObj]:
+        """Асинхронная обёртка точечного поиска: для UUID подставляет email клиента из БД."""
+        email_hint = None
+        if '@' not in identifier:
+            email_hint = await db_helpers.get_xui_email_by_uuid(identifier)
+        return await self._run_blocking(self._find_client_by_email_or_uuid, client_api, inbound_id, identifier, email_hint)
+
+    def _add_clients_bulk(self, client_api: Api, inbound_id: int, clients: List[XUIClientObj]):
+        """
+        Добавляет пачку клиентов одним запросом (классический inbounds/addClient):
+        панель переписывает inbound и перезапускает конфиг Xray один раз на всю пачку.
+        py3xui.client.add отправляет отдельный POST на каждого клиента, поэтому тело собираем сами.
+        """
+        url = client_api.inbound._url("panel/api/inbounds/addClient")
+        settings = {'clients': [c.model_dump(by_alias=True, exclude_defaults=True) for c in clients]}
+        client_api.inbound._post(url, {"Accept": "application/json"}, {'id': inbound_id, 'settings': json.dumps(settings)})
+
+    def _inbound_lock(self, server_id: int, inbound_id: int) -> asyncio.Lock:
+        """
+        Блокировка на (сервер, inbound) в текущем event loop: пакетные добавления клиентов
+        (addClient на пачку) в один inbound отправляются по очереди.
+        """
+        key = (server_id, inbound_id, asyncio.get_running_loop())
+        lock = self._inbound_locks.get(key)
+        if lock is None:
+            lock = self._inbound_locks[key] = asyncio.Lock()
+        return lock
+
+    async def _flush_add_batch(self, key: tuple):
+        """Отправляет накопленный пакет и раздаёт результат ожидающим корутинам."""
+        batch = self._add_batches.pop(key, None)
+        if not batch:
+            return
+        server_id, inbound_id, _ = key
+        client_api, items = batch['client_api'], batch['items']
+        clients = [client for client, _ in items]
+        try:
+            async with self._inbound_lock(server_id, inbound_id):
+                await self._run_blocking(self._add_clients_bulk, client_api, inbound_id, clients)
+            logger.info(f"Пакетно добавлено {len(clients)} клиентов в inbound {inbound_id} на сервере {server_id}.")
+            for _, future in items:
+                if not future.done():
+                    future.set_result(True)
+            return
+        except Exception as e:
+            if len(items) == 1:
+                if not items[0][1].done():
+                    items[0][1].set_exception(e)
+                return
+            logger.warning(f"Пакетное добавление {len(clients)} клиентов в inbound {inbound_id} не удалось: {e}. Добавляем по одному.")
+
+        # Один проблемный клиент (например, дубль email) не должен ронять всю пачку
+        for client, future in items:
+            try:
+                await self._run_blocking(client_api.client.add, inbound_id=inbound_id, clients=[client])
+                if not future.done():
+                    future.set_result(True)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _add_client_batched(self, server_settings: Dict, client_api: Api, inbound_id: int, client_obj: XUIClientObj):
+        """
+        Добавляет клиента через короткое окно накопления (xui_add_batch_window_ms) на (сервер, inbound):
+        одновременные выдачи уходят в панель одним запросом. Исключение панели пробрасывается вызывающему.
+        """
+        window_ms = app_conf.get('xui_add_batch_window_ms', 200)
+        if window_ms <= 0:
+            await self._run_blocking(client_api.client.add, inbound_id=inbound_id, clients=[client_obj])
+            return
+
+        loop = asyncio.get_running_loop()
+        key = (server_settings['id'], inbound_id, loop)
+        batch = self._add_batches.get(key)
+        if batch is None:
+            batch = {'client_api': client_api, 'items': []}
+            self._add_batches[key] = batch
+            batch['timer'] = loop.call_later(window_ms / 1000, lambda: loop.create_task(self._flush_add_batch(key)))
+
+        future = loop.create_future()
+        batch['items'].append((client_obj, future))
+        if len(batch['items']) >= app_conf.get('xui_add_batch_max_size', 50):
+            batch['timer'].cancel()
+            loop.create_task(self._flush_add_batch(key))
+        await future
+
+    @staticmethod
+    def _resolve_inbound_id(server_settings: Dict, inbound_id: Optional[int]) -> int:
+        """Inbound клиента из БД, а если он не записан (старые записи) — основной inbound сервера."""
+        return int(inbound_id) if inbound_id else get_inbound_ids(server_settings)[0]
+
+    async def choose_inbound(self, server_settings: Dict) -> int:
+        """
+        Выбирает для нового клиента наименее заполненный inbound сервера (при равенстве — раньше в списке).
+        Заполненность берётся из БД раз в INBOUND_FILL_TTL_SEC и между перечитываниями
+        увеличивается при каждом размещении, чтобы одновременные выдачи не ложились в один inbound.
+        """
+        inbound_ids = get_inbound_ids(server_settings)
+        if len(inbound_ids) == 1:
+            return inbound_ids[0]
+
+        server_id = server_settings['id']
+        fill = self._inbound_fill.get(server_id)
+        if not fill or time.monotonic() - fill['fetched_at'] > INBOUND_FILL_TTL_SEC:
+            counts = await db_helpers.get_inbound_clients_counts(server_id, inbound_ids[0])
+            # Пока мы ждали БД, соседняя выдача могла уже перечитать заполненность и разместить клиентов
+            if self._inbound_fill.get(server_id) is fill:
+                self._inbound_fill[server_id] = {'counts': counts, 'fetched_at': time.monotonic()}
+            fill = self._inbound_fill[server_id]
+
+        counts = fill['counts']
+        inbound_id = min(inbound_ids, key=lambda i: counts.get(i, 0))
+        counts[inbound_id] = counts.get(inbound_id, 0) + 1
+        logger.debug(f"Сервер {server_id}: для нового клиента выбран inbound {inbound_id}, заполненность {counts}.")
+        return inbound_id
+
+    async def check_client_exists(self, server_settings: Dict, client_uuid: str, inbound_id: Optional[int] = None) -> bool:
         """Проверяет существование клиента в X-UI по UUID."""
         client_api = await self.get_client(server_settings)
         if not client_api:
             return False # Считаем, что не существует, если сервер недоступен
 
         try:
-            inbound_id = server_settings['inbound_id']
-            # Используем внутренний метод поиска
-            client_obj = self._find_client_by_email_or_uuid(client_api, inbound_id, client_uuid)
+            inbound_id = self._resolve_inbound_id(server_settings, inbound_id)
+            client_obj = await self._lookup_client(client_api, inbound_id, client_uuid)
             return client_obj is not None
         except Exception as e:
             logger.error(f"Ошибка при проверке существования клиента {client_uuid} на сервере {server_settings['name']}: {e}")
@@ -120,32 +427,25 @@ class XUIManager:
     async def recreate_xui_user(self, server_settings: Dict, user_data: Dict) -> bool:
         """
         Восстанавливает пользователя в X-UI с использованием существующих данных.
-        user_data должен содержать: uuid, email, expiry_timestamp_ms, telegram_id.
+        user_data должен содержать: uuid, email, expiry_timestamp_ms, telegram_id;
+        inbound_id — необязательно (по умолчанию основной inbound сервера).
         """
         client_api = await self.get_client(server_settings)
         if not client_api:
             return False
 
         try:
-            inbound_id = server_settings['inbound_id']
-            inbound = self._find_inbound_by_id(client_api, inbound_id)
-            if not inbound:
+            inbound_id = self._resolve_inbound_id(server_settings, user_data.get('inbound_id'))
+            inbound_params = await self._get_inbound_params(server_settings, client_api, inbound_id)
+            if not inbound_params:
                 logger.error(f"Inbound {inbound_id} не найден на сервере {server_settings['id']} для восстановления.")
                 return False
 
-            flow_value = ""
-            if hasattr(inbound, 'stream_settings') and inbound.stream_settings:
-                if hasattr(inbound.stream_settings, 'xtls_settings') and inbound.stream_settings.xtls_settings and \
-                   hasattr(inbound.stream_settings.xtls_settings, 'flow') and inbound.stream_settings.xtls_settings.flow:
-                    flow_value = inbound.stream_settings.xtls_settings.flow
-                elif hasattr(inbound.stream_settings, 'reality_settings') and inbound.stream_settings.reality_settings:
-                    flow_value = "xtls-rprx-vision"
-
             client_to_add = Client(
                 id=user_data['uuid'],
                 email=user_data['email'],
                 enable=True,
-                flow=flow_value,
+                flow=inbound_params['flow'],
                 tg_id=str(user_data['telegram_id']),
                 total_gb=0, # Восстанавливаем без лимита трафика, как и при создании
                 expiry_time=user_data['expiry_timestamp_ms'],
@@ -153,7 +453,7 @@ class XUIManager:
                 sub_id=user_data['uuid']
             )
 
-            client_api.client.add(inbound_id=inbound_id, clients=[client_to_add])
+            await self._run_blocking(client_api.client.add, inbound_id=inbound_id, clients=[client_to_add])
             logger.info(f"Отправлен запрос на восстановление клиента {user_data['email']} в inbound {inbound_id}.")
             return True
 
@@ -165,15 +465,166 @@ class XUIManager:
             logger.error(f"Ошибка при восстановлении пользователя {user_data['email']} в X-UI: {e}")
             return False
 
-    async def create_xui_user(self, server_settings: Dict, telegram_id: int, days_valid: int, total_gb: int = 0, limit_ip: int = 0) -> Optional[Dict[str, Any]]:
+    async def restore_clients_bulk(self, server_settings: Dict, inbound_id: int, users: List[Dict]) -> set:
+        """
+        Пакетная версия recreate_xui_user для переноса пользователей между серверами: клиенты с теми же
+        UUID, email и сроком добавляются одним запросом, а если пачка не прошла — по одному.
+        users — словари с uuid, email, expiry_timestamp_ms, telegram_id и limit_ip.
+        Возвращает UUID клиентов, которые теперь есть в inbound (включая уже существовавших:
+        если панель отклонила добавление, клиент ищется в inbound по UUID).
+        """
+        client_api = await self.get_client(server_settings)
+        if not client_api or not users:
+            return set()
+        inbound_params = await self._get_inbound_params(server_settings, client_api, inbound_id)
+        if not inbound_params:
+            logger.error(f"Inbound {inbound_id} не найден на сервере {server_settings['id']} для переноса клиентов.")
+            return set()
+
+        clients = [
+            Client(
+                id=user['uuid'],
+                email=user['email'],
+                enable=True,
+                flow=inbound_params['flow'],
+                tg_id=str(user['telegram_id']),
+                total_gb=0,
+                expiry_time=user['expiry_timestamp_ms'],
+                limit_ip=user.get('limit_ip') or server_settings.get('default_limit_ip', 0),
+                sub_id=user['uuid']
+            )
+            for user in users
+        ]
+        async with self._inbound_lock(server_settings['id'], inbound_id):
+            try:
+                await self._run_blocking(self._add_clients_bulk, client_api, inbound_id, clients)
+                return {client.id for client in clients}
+            except Exception as e:
+                logger.warning(f"Пакетный перенос {len(clients)} клиентов в inbound {inbound_id} не удался: {e}. Добавляем по одному.")
+
+            added = set()
+            failed = []
+            for client in clients:
+                try:
+                    await self._run_blocking(client_api.client.add, inbound_id=inbound_id, clients=[client])
+                    added.add(client.id)
+                except Exception as e:
+                    failed.append((client, e))
+            if failed:
+                # Клиент мог уже быть в inbound (повторный перенос, копия резервного сервера):
+                # это проверяется по UUID в самом inbound, а не по тексту ошибки панели
+                try:
+                    present = await self.get_inbound_client_ids(server_settings, inbound_id) or set()
+                except Exception as e:
+                    logger.error(f"Ошибка чтения inbound {inbound_id} на сервере {server_settings['name']} после переноса клиентов: {e}")
+                    present = set()
+                for client, error in failed:
+                    if client.id in present:
+                        added.add(client.id)
+                    else:
+                        logger.error(f"Не удалось перенести клиента {client.email} в inbound {inbound_id}: {error}")
+            return added
+
+    async def get_inbound_client_ids(self, server_settings: Dict, inbound_id: int) -> Optional[set]:
+        """UUID всех клиентов inbound одним чтением (проверка переноса перед удалением с исходного сервера)."""
+        client_api = await self.get_client(server_settings)
+        if not client_api:
+            return None
+        inbound_raw = await self._run_blocking(self._get_inbound_raw, client_api, inbound_id)
+        if not inbound_raw:
+            return None
+        return {client.get('id') for client in self._raw_json_field(inbound_raw, 'settings').get('clients', [])}
+
+    async def get_inbound_params(self, server_settings: Dict, inbound_id: int, refresh: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        Параметры inbound для сборки ссылок подписки (sub_server.py) из того же кэша, что и выдачи.
+        Если кэш устарел, а панель недоступна (или refresh=False), отдаём последние известные параметры.
+        """
+        key = (server_settings['id'], inbound_id)
+        cached = self._inbound_params.get(key)
+        if cached and (not refresh or time.monotonic() - cached['fetched_at'] < INBOUND_PARAMS_TTL_SEC):
+            return cached
+        client_api = await self.get_client(server_settings)
+        if client_api:
+            params = await self._get_inbound_params(server_settings, client_api, inbound_id)
+            if params:
+                return params
+        return cached
+
+    async def create_pool_clients(self, server_settings: Dict, inbound_id: int, clients: List[Dict]) -> bool:
+        """
+        Создаёт выключенных клиентов пула (client_pool.py) одним запросом addClient.
+        clients — словари с uuid и email. Срок и владелец задаются при выдаче (activate_pool_client).
+        """
+        client_api = await self.get_client(server_settings)
+        if not client_api or not clients:
+            return False
+        inbound_params = await self._get_inbound_params(server_settings, client_api, inbound_id)
+        if not inbound_params:
+            logger.error(f"Inbound {inbound_id} не найден на сервере {server_settings['id']} для пула клиентов.")
+            return False
+        client_objs = [
+            Client(
+                id=client['uuid'],
+                email=client['email'],
+                enable=False,
+                flow=inbound_params['flow'],
+                total_gb=0,
+                expiry_time=0,
+                limit_ip=server_settings.get('default_limit_ip', 0),
+                sub_id=client['uuid']
+            )
+            for client in clients
+        ]
+        try:
+            async with self._inbound_lock(server_settings['id'], inbound_id):
+                await self._run_blocking(self._add_clients_bulk, client_api, inbound_id, client_objs)
+            return True
+        except Exception as e:
+            logger.error(f"Не удалось создать {len(client_objs)} клиентов пула в inbound {inbound_id} на сервере {server_settings['name']}: {e}")
+            return False
+
+    async def activate_pool_client(self, server_settings: Dict, inbound_id: int, client_uuid: str, email: str,
+                                   telegram_id: int, expiry_timestamp_ms: int, limit_ip: int = 0) -> bool:
+        """Выдаёт клиента пула пользователю одним обновлением клиента: включение, срок, tgId и лимит устройств."""
+        client_api = await self.get_client(server_settings)
+        if not client_api:
+            return False
+        inbound_params = await self._get_inbound_params(server_settings, client_api, inbound_id)
+        client_obj = Client(
+            id=client_uuid,
+            email=email,
+            enable=True,
+            flow=inbound_params['flow'] if inbound_params else "",
+            tg_id=str(telegram_id),
+            total_gb=0,
+            expiry_time=expiry_timestamp_ms,
+            limit_ip=limit_ip if limit_ip else server_settings.get('default_limit_ip', 0),
+            sub_id=client_uuid,
+            inbound_id=inbound_id
+        )
+        try:
+            await self._run_blocking(client_api.client.update, client_uuid=client_uuid, client=client_obj)
+            return True
+        except Exception as e:
+            logger.error(f"Не удалось включить клиента пула {client_uuid} на сервере {server_settings['name']}: {e}")
+            return False
+
+    async def create_xui_user(self, server_settings: Dict, telegram_id: int, days_valid: int, total_gb: int = 0, limit_ip: int = 0,
+                              inbound_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        Создаёт клиента в inbound_id, а если он не указан — в наименее заполненном inbound сервера.
+        Inbound возвращается в результате, его нужно сохранить в БД вместе с UUID.
+        """
         client_api = await self.get_client(server_settings)
         if not client_api:
             return None
 
         try:
-            inbound_id = server_settings['inbound_id']
-            inbound = self._find_inbound_by_id(client_api, inbound_id)
-            if not inbound:
+            if not inbound_id:
+                inbound_id = await self.choose_inbound(server_settings)
+            inbound_params = await self._get_inbound_params(server_settings, client_api, inbound_id)
+            if not inbound_params:
                 logger.error(f"Inbound {inbound_id} не найден на сервере {server_settings['id']}")
                 return None
 
@@ -184,19 +635,11 @@ class XUIManager:
             expiry_time = datetime.now() + timedelta(days=days_valid)
             expiry_timestamp_ms = int(expiry_time.timestamp() * 1000)
 
-            flow_value = ""
-            if hasattr(inbound, 'stream_settings') and inbound.stream_settings:
-                if hasattr(inbound.stream_settings, 'xtls_settings') and inbound.stream_settings.xtls_settings and \
-                   hasattr(inbound.stream_settings.xtls_settings, 'flow') and inbound.stream_settings.xtls_settings.flow:
-                    flow_value = inbound.stream_settings.xtls_settings.flow
-                elif hasattr(inbound.stream_settings, 'reality_settings') and inbound.stream_settings.reality_settings:
-                    flow_value = "xtls-rprx-vision" 
-
             new_client_obj = Client( 
                 id=client_uuid,
                 email=email,
                 enable=True,
-                flow=flow_value,
+                flow=inbound_params['flow'],
                 tg_id=str(telegram_id),
                 total_gb=total_gb,
                 expiry_time=expiry_timestamp_ms,
@@ -209,7 +652,7 @@ class XUIManager:
             for i in range(retries):
                 try:
                     logger.debug(f"Попытка {i+1}/{retries} добавления клиента {email} в inbound {inbound_id}...")
-                    client_api.client.add(inbound_id=inbound_id, clients=[new_client_obj])
+                    await self._add_client_batched(server_settings, client_api, inbound_id, new_client_obj)
                     success = True
                     logger.info(f"Клиент {email} (UUID: {client_uuid}) успешно создан в X-UI на сервере {server_settings['id']}.")
                     break
@@ -229,7 +672,8 @@ class XUIManager:
                 "uuid": client_uuid,
                 "email": email,
                 "expiry_timestamp_ms": expiry_timestamp_ms,
-                "server_id": server_settings['id']
+                "server_id": server_settings['id'],
+                "inbound_id": inbound_id
             }
 
         except Exception as e:
@@ -237,17 +681,18 @@ class XUIManager:
             logger.exception("Полный стек ошибки:")
             return None
 
-    async def update_xui_user_subscription(self, server_settings: Dict, client_uuid: str, new_days_valid: int, current_expiry_ms: Optional[int] = None, total_gb: int = 0, limit_ip: int = 0) -> Optional[Dict[str, Any]]:
+    async def update_xui_user_subscription(self, server_settings: Dict, client_uuid: str, new_days_valid: int, current_expiry_ms: Optional[int] = None, total_gb: int = 0, limit_ip: int = 0,
+                                           inbound_id: Optional[int] = None, telegram_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
         client_api = await self.get_client(server_settings)
         if not client_api:
             return None
 
         try:
-            inbound_id = server_settings['inbound_id']
+            inbound_id = self._resolve_inbound_id(server_settings, inbound_id)
             
-            telegram_user_id_for_sub = server_settings.get('telegram_id')
+            telegram_user_id_for_sub = telegram_id
             if not telegram_user_id_for_sub:
-                 logger.error(f"telegram_id не передан в server_settings для обновления подписки UUID {client_uuid}")
+                 logger.error(f"telegram_id не передан для обновления подписки UUID {client_uuid}")
                  return None
 
             user_db_data = await db_helpers.get_user(telegram_user_id_for_sub)
@@ -256,17 +701,10 @@ class XUIManager:
                 return None
             client_email_from_db = user_db_data[3] 
 
-            inbound_obj = self._find_inbound_by_id(client_api, inbound_id)
-            if not inbound_obj or not hasattr(inbound_obj, 'settings') or not inbound_obj.settings or \
-               not hasattr(inbound_obj.settings, 'clients') or not inbound_obj.settings.clients:
-                logger.error(f"Inbound {inbound_id} не найден или не содержит клиентов на сервере {server_settings['name']}.")
-                return None
-
-            client_from_xui: Optional[XUIClientObj] = None
-            for c_xui in inbound_obj.settings.clients:
-                if c_xui.id == client_uuid:
-                    client_from_xui = c_xui
-                    break
+            # Точечный запрос одного клиента по email из БД вместо скачивания всего inbound
+            client_from_xui: Optional[XUIClientObj] = await self._run_blocking(
+                self._find_client_by_email_or_uuid, client_api, inbound_id, client_uuid, client_email_from_db
+            )
             
             if not client_from_xui:
                 logger.warning(f"Клиент UUID {client_uuid} не найден в X-UI inbound {inbound_id} на сервере {server_settings['name']}. Email из БД: {client_email_from_db}")
@@ -286,7 +724,8 @@ class XUIManager:
                     'uuid': client_uuid,
                     'email': client_email_from_db,
                     'expiry_timestamp_ms': new_expiry_timestamp_ms,
-                    'telegram_id': telegram_user_id_for_sub
+                    'telegram_id': telegram_user_id_for_sub,
+                    'inbound_id': inbound_id
                 }
                 
                 # Пытаемся восстановить клиента
@@ -294,13 +733,9 @@ class XUIManager:
                 if recreation_success:
                     logger.info(f"Клиент {client_uuid} успешно восстановлен в X-UI. Продолжаем обновление подписки...")
                     # Повторно получаем данные клиента из X-UI после восстановления
-                    inbound_obj = self._find_inbound_by_id(client_api, inbound_id)
-                    if inbound_obj and hasattr(inbound_obj, 'settings') and inbound_obj.settings and \
-                       hasattr(inbound_obj.settings, 'clients') and inbound_obj.settings.clients:
-                        for c_xui in inbound_obj.settings.clients:
-                            if c_xui.id == client_uuid:
-                                client_from_xui = c_xui
-                                break
+                    client_from_xui = await self._run_blocking(
+                        self._find_client_by_email_or_uuid, client_api, inbound_id, client_uuid, client_email_from_db
+                    )
                 
                 if not client_from_xui:
                     logger.error(f"Не удалось восстановить клиента {client_uuid} в X-UI. Создание новой подписки.")
@@ -316,11 +751,16 @@ class XUIManager:
             new_expiry_time = base_time + timedelta(days=new_days_valid)
             new_expiry_timestamp_ms = int(new_expiry_time.timestamp() * 1000)
 
+            flow_value = client_from_xui.flow
+            if not flow_value:
+                inbound_params = await self._get_inbound_params(server_settings, client_api, inbound_id)
+                flow_value = inbound_params['flow'] if inbound_params else ""
+
             updated_client_obj = Client(
                 id=actual_uuid_from_xui,
                 email=client_from_xui.email,
                 enable=True, 
-                flow=client_from_xui.flow if hasattr(client_from_xui, 'flow') else "",
+                flow=flow_value,
                 tg_id=client_from_xui.tg_id if hasattr(client_from_xui, 'tg_id') else str(telegram_user_id_for_sub),
                 total_gb=total_gb, 
                 expiry_time=new_expiry_timestamp_ms, 
@@ -335,14 +775,15 @@ class XUIManager:
             logger.debug(f"Детали обновляемого клиента: {updated_client_obj.model_dump_json(indent=2)}")
             
             try:
-                client_api.client.update(client_uuid=actual_uuid_from_xui, client=updated_client_obj)
+                await self._run_blocking(client_api.client.update, client_uuid=actual_uuid_from_xui, client=updated_client_obj)
                 
                 logger.info(f"Клиент UUID {actual_uuid_from_xui} (email {updated_client_obj.email}) успешно обновлен на сервере {server_settings['id']}.")
                 return {
                     "uuid": actual_uuid_from_xui,
                     "email": client_email_from_db,
                     "expiry_timestamp_ms": new_expiry_timestamp_ms,
-                    "server_id": server_settings['id']
+                    "server_id": server_settings['id'],
+                    "inbound_id": inbound_id
                 }
                     
             except Exception as e:
@@ -358,13 +799,13 @@ class XUIManager:
             logger.exception("Полный стек ошибки:")
             return None
 
-    async def delete_xui_user(self, server_settings: Dict, client_uuid_or_email: str) -> bool:
+    async def delete_xui_user(self, server_settings: Dict, client_uuid_or_email: str, inbound_id: Optional[int] = None) -> bool:
         client_api = await self.get_client(server_settings)
         if not client_api:
             return False
 
         try:
-            inbound_id = server_settings['inbound_id']
+            inbound_id = self._resolve_inbound_id(server_settings, inbound_id)
             logger.info(f"Попытка удаления клиента '{client_uuid_or_email}' из inbound {inbound_id} на сервере {server_settings['id']}")
             
             is_uuid = False
@@ -376,18 +817,20 @@ class XUIManager:
 
             success = False
             if is_uuid:
+                # Панель удаляет по email; берём его из БД, иначе py3xui скачает список всех клиентов
+                target = await db_helpers.get_xui_email_by_uuid(client_uuid_or_email) or client_uuid_or_email
                 try:
-                    client_api.client.delete(inbound_id=inbound_id, client_uuid=client_uuid_or_email)
+                    await self._run_blocking(client_api.client.delete, inbound_id=inbound_id, client_uuid=target)
                     success = True
                 except Exception as e:
                     logger.error(f"Ошибка при удалении клиента по UUID {client_uuid_or_email}: {e}")
                     return False
             else: 
-                found_client = self._find_client_by_email_or_uuid(client_api, inbound_id, client_uuid_or_email)
+                found_client = await self._lookup_client(client_api, inbound_id, client_uuid_or_email)
                 if found_client and found_client.id:
-                    logger.info(f"Найден UUID {found_client.id} для email {client_uuid_or_email}. Удаляем по UUID.")
+                    logger.info(f"Найден UUID {found_client.id} для email {client_uuid_or_email}. Удаляем клиента.")
                     try:
-                        client_api.client.delete(inbound_id=inbound_id, client_uuid=found_client.id)
+                        await self._run_blocking(client_api.client.delete, inbound_id=inbound_id, client_uuid=found_client.email)
                         success = True
                     except Exception as e:
                         logger.error(f"Ошибка при удалении клиента по UUID {found_client.id}: {e}")
@@ -407,25 +850,115 @@ class XUIManager:
             logger.error(f"Ошибка при удалении X-UI пользователя '{client_uuid_or_email}': {e}")
             return False
 
-    async def get_active_clients_count_for_inbound(self, server_settings: dict) -> Optional[int]:
+    async def remove_clients_one_by_one(self, server_settings: Dict, inbound_id: int, client_uuids: List[str],
+                                        concurrency: int = CLIENT_REQUESTS_CONCURRENCY) -> Optional[set]:
+        """
+        Удаление нескольких клиентов из inbound (сборка мусора, переносы, пул) — по одному, а не одним запросом.
+        Inbound читается один раз, чтобы узнать email клиентов и пропустить уже отсутствующих, а затем
+        на каждого клиента уходит свой запрос clients/del, не больше concurrency одновременно: панель меняет
+        только удаляемого клиента, поэтому записи в тот же inbound, идущие параллельно (выдачи, продления,
+        веб-админка), не затираются.
+        Возвращает UUID, которых в inbound больше нет, или None, если inbound не прочитан.
+        """
         client_api = await self.get_client(server_settings)
         if not client_api:
             return None
-        
         try:
-            inbound_id = server_settings['inbound_id']
-            inbound = self._find_inbound_by_id(client_api, inbound_id)
+            inbound_raw = await self._run_blocking(self._get_inbound_raw, client_api, inbound_id)
+        except Exception as e:
+            logger.error(f"Ошибка чтения inbound {inbound_id} на сервере {server_settings['name']} для удаления клиентов: {e}")
+            return None
+        if not inbound_raw:
+            return None
+        wanted = set(client_uuids)
+        emails = {
+            client.get('id'): client.get('email') or client.get('id')
+            for client in self._raw_json_field(inbound_raw, 'settings').get('clients', []) if client.get('id') in wanted
+        }
+        semaphore = asyncio.Semaphore(max(1, concurrency))
 
-            if not inbound:
-                logger.warning(f"Inbound {inbound_id} не найден на сервере {server_settings['name']} при подсчете клиентов.")
-                return None 
+        async def delete_client(email: str) -> bool:
+            async with semaphore:
+                try:
+                    await self._run_blocking(client_api.client.delete, inbound_id=inbound_id, client_uuid=email)
+                    return True
+                except Exception as e:
+                    logger.warning(f"Не удалось удалить клиента {email} из inbound {inbound_id} на сервере {server_settings['name']}: {e}")
+                    return False
 
+        to_delete = list(emails.items())
+        results = await asyncio.gather(*(delete_client(email) for _, email in to_delete))
+        deleted = {client_uuid for (client_uuid, _), ok in zip(to_delete, results) if ok}
+        logger.info(f"Из inbound {inbound_id} на сервере {server_settings['name']} удалено клиентов: {len(deleted)}.")
+        return (wanted - emails.keys()) | deleted
+
+    async def set_clients_expiry_bulk(self, server_settings: Dict, inbound_id: int, chunks: List[Dict[str, int]],
+                                      on_chunk: Callable[[Dict[str, int], set], Awaitable[None]],
+                                      concurrency: int = CLIENT_REQUESTS_CONCURRENCY) -> bool:
+        """
+        Массовое продление клиентов одного inbound. На каждую пачку {UUID: expiryTime в мс} inbound
+        читается один раз (текущие поля клиентов и кого в нём нет), а каждый клиент обновляется
+        отдельным запросом clients/update (клиент заодно включается), не больше concurrency одновременно.
+        Панель меняет только обновляемого клиента, поэтому записи в тот же inbound, идущие параллельно
+        (продления, выдачи из пула, веб-админка), не откатываются, как при переписывании inbound целиком.
+        После каждой пачки вызывается on_chunk(применённая часть пачки, UUID которых в inbound нет),
+        чтобы вызывающий зафиксировал прогресс; клиенты, обновление которых панель не приняла, в неё не входят.
+        Возвращает False, если inbound недоступен или часть обновлений не применилась.
+        """
+        client_api = await self.get_client(server_settings)
+        if not client_api:
+            return False
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        all_applied = True
+        try:
+            for chunk in chunks:
+                inbound_raw = await self._run_blocking(self._get_inbound_raw, client_api, inbound_id)
+                if not inbound_raw:
+                    return False
+                clients_by_uuid = {c.get('id'): c for c in self._raw_json_field(inbound_raw, 'settings').get('clients', [])}
+                missing = {client_uuid for client_uuid in chunk if client_uuid not in clients_by_uuid}
+
+                async def update_client(client_raw: Dict, expiry_ms: int) -> bool:
+                    client_obj = Client.model_validate({**client_raw, 'expiryTime': expiry_ms, 'enable': True, 'inboundId': inbound_id})
+                    async with semaphore:
+                        try:
+                            await self._run_blocking(client_api.client.update, client_uuid=client_obj.id, client=client_obj)
+                            return True
+                        except Exception as e:
+                            logger.warning(f"Не удалось продлить клиента {client_obj.email} в inbound {inbound_id} "
+                                           f"на сервере {server_settings['name']}: {e}")
+                            return False
+
+                to_update = [client_uuid for client_uuid in chunk if client_uuid not in missing]
+                results = await asyncio.gather(*(update_client(clients_by_uuid[u], chunk[u]) for u in to_update))
+                failed = {client_uuid for client_uuid, ok in zip(to_update, results) if not ok}
+                all_applied = all_applied and not failed
+                await on_chunk({client_uuid: expiry_ms for client_uuid, expiry_ms in chunk.items() if client_uuid not in failed}, missing)
+            return all_applied
+        except Exception as e:
+            logger.error(f"Ошибка массового продления клиентов в inbound {inbound_id} на сервере {server_settings['name']}: {e}")
+            return False
+
+    async def get_active_clients_count_for_inbound(self, server_settings: dict, inbound_id: Optional[int] = None) -> Optional[int]:
+        """Число включённых клиентов в inbound_id, а без него — суммарно во всех inbounds сервера."""
+        client_api = await self.get_client(server_settings)
+        if not client_api:
+            return None
+        
+        try:
             active_clients_count = 0
-            if hasattr(inbound, 'settings') and inbound.settings and \
-               hasattr(inbound.settings, 'clients') and inbound.settings.clients:
-                active_clients_count = sum(1 for c in inbound.settings.clients if c.enable)
+            for current_inbound_id in ([inbound_id] if inbound_id else get_inbound_ids(server_settings)):
+                inbound_raw = await self._run_blocking(self._get_inbound_raw, client_api, current_inbound_id)
+
+                if not inbound_raw:
+                    logger.warning(f"Inbound {current_inbound_id} не найден на сервере {server_settings['name']} при подсчете клиентов.")
+                    return None 
+
+                clients = self._raw_json_field(inbound_raw, 'settings').get('clients', [])
+                inbound_count = sum(1 for c in clients if c.get('enable'))
+                logger.debug(f"Сервер {server_settings['name']}, Inbound {current_inbound_id}: {inbound_count} активных клиентов.")
+                active_clients_count += inbound_count
             
-            logger.debug(f"Сервер {server_settings['name']}, Inbound {inbound_id}: {active_clients_count} активных клиентов.")
             return active_clients_count
         except Exception as e:
             logger.error(f"Ошибка при подсчете активных клиентов для сервера {server_settings['name']}: {e}")
@@ -442,7 +975,7 @@ class XUIManager:
             
             try:
                 logger.debug(f"Запрос статуса сервера {server_settings['name']}")
-                status = client_api.server.get_status()
+                status = await self._run_blocking(client_api.server.get_status)
                 if not status:
                     logger.warning(f"Пустой статус для сервера {server_settings['name']}")
                     return None
@@ -494,15 +1027,80 @@ class XUIManager:
             logger.error(f"Общая ошибка при получении статистики сервера {server_settings['name']}: {e}")
             return None
 
-    async def get_user_limit_ip(self, server_settings: Dict, identifier: str) -> Optional[int]:
+    async def get_server_metrics(self, server_settings: dict) -> Optional[dict]:
+        """
+        Числовой замер состояния сервера для сэмплера метрик:
+        cpu/mem/disk в процентах, active_clients и задержка запроса статуса в мс.
+        None — если сервер недоступен.
+        """
+        client_api = await self.get_client(server_settings)
+        if not client_api:
+            return None
+
+        try:
+            started = time.perf_counter()
+            status = await self._run_blocking(client_api.server.get_status)
+            latency_ms = int((time.perf_counter() - started) * 1000)
+        except Exception as e:
+            logger.warning(f"Не удалось получить статус сервера {server_settings['name']} для метрик: {e}")
+            self.clients.pop(server_settings['id'], None)
+            return None
+        if not status:
+            return None
+
+        def percent(part) -> Optional[float]:
+            try:
+                if part is not None and part.total:
+                    return round(part.current / part.total * 100, 1)
+            except (AttributeError, TypeError, ZeroDivisionError):
+                pass
+            return None
+
+        cpu = None
+        try:
+            cpu = round(float(status.cpu), 1) if getattr(status, 'cpu', None) is not None else None
+        except (ValueError, TypeError):
+            pass
+
+        return {
+            'cpu': cpu,
+            'mem': percent(getattr(status, 'mem', None)),
+            'disk': percent(getattr(status, 'disk', None)),
+            'active_clients': await self.get_active_clients_count_for_inbound(server_settings),
+            'latency_ms': latency_ms,
+        }
+
+    async def get_inbound_clients_traffic(self, server_settings: Dict) -> Optional[Dict[str, tuple]]:
+        """
+        Возвращает абсолютные счётчики трафика всех клиентов всех inbounds сервера,
+        по одному запросу к панели на inbound: {email: (up, down)}. None — если сервер или inbound недоступны.
+        """
+        client_api = await self.get_client(server_settings)
+        if not client_api:
+            return None
+
+        counters = {}
+        for inbound_id in get_inbound_ids(server_settings):
+            inbound_raw = await self._run_blocking(self._get_inbound_raw, client_api, inbound_id)
+            if not inbound_raw:
+                logger.warning(f"Inbound {inbound_id} не найден на сервере {server_settings['name']} при сборе трафика.")
+                return None
+
+            for stat in inbound_raw.get('clientStats') or []:
+                if stat.get('email'):
+                    counters[stat['email']] = (stat.get('up') or 0, stat.get('down') or 0)
+        logger.debug(f"Сервер {server_settings['name']}: получены счётчики трафика {len(counters)} клиентов.")
+        return counters
+
+    async def get_user_limit_ip(self, server_settings: Dict, identifier: str, inbound_id: Optional[int] = None) -> Optional[int]:
         """
         Получить лимит устройств (limit_ip) пользователя по UUID или email из X-UI.
         """
         client_api = await self.get_client(server_settings)
         if not client_api:
             return None
-        inbound_id = server_settings['inbound_id']
-        client_obj = self._find_client_by_email_or_uuid(client_api, inbound_id, identifier)
+        inbound_id = self._resolve_inbound_id(server_settings, inbound_id)
+        client_obj = await self._lookup_client(client_api, inbound_id, identifier)
         if client_obj and hasattr(client_obj, 'limit_ip'):
             return getattr(client_obj, 'limit_ip', None)
         return None
@@ -0,0 +1,164 @@
+# xui_benchmark.py
+"""
+Нагрузочный бенчмарк стека выдачи подписок на фейковой панели (fake_xui_panel.py).
+
+Поднимает N фейковых панелей в фоновых потоках, временную копию схемы БД
+и прогоняет через настоящие XUIManager / grant_subscription сценарии:
+новая подписка, продление, сбор трафика, удаление. Печатает p50/p95/p99/max
+и пропускную способность по каждой фазе и число запросов к панели.
+
+Пример:
+    python xui_benchmark.py --servers 2 --clients 10000 --users 200 --latency-ms 30
+Рабочая БД бота не трогается.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+from typing import Dict, List
+
+import aiosqlite
+from loguru import logger
+
+import config
+import db_helpers
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _report(phase: str, durations: List[float], failures: int, wall: float):
+    ms = [d * 1000 for d in durations]
+    print(
+        f"{phase:<14} n={len(ms):<5} ошибок={failures:<4} "
+        f"p50={_percentile(ms, 50):8.1f}мс p95={_percentile(ms, 95):8.1f}мс "
+        f"p99={_percentile(ms, 99):8.1f}мс max={max(ms) if ms else 0:8.1f}мс "
+        f"mean={statistics.fmean(ms) if ms else 0:8.1f}мс  {len(ms) / wall if wall else 0:7.1f} оп/с"
+    )
+
+
+async def _timed_phase(phase: str, items, op, concurrency: int):
+    """Выполняет op(item) для всех items с ограничением параллелизма и печатает отчёт."""
+    semaphore = asyncio.Semaphore(concurrency)
+    durations: List[float] = []
+    failures = 0
+
+    async def run_one(item):
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                ok = await op(item)
+            except Exception as e:
+                logger.debug(f"{phase}: {e}")
+                ok = False
+            durations.append(time.perf_counter() - started)
+            if not ok:
+                failures += 1
+
+    wall_started = time.perf_counter()
+    await asyncio.gather(*(run_one(item) for item in items))
+    _report(phase, durations, failures, time.perf_counter() - wall_started)
+
+
+async def _prepare_db(db_path: str, servers: List[Dict], user_ids: List[int]):
+    config.DATABASE_NAME = db_path
+    db_helpers.DATABASE_NAME = db_path
+    await db_helpers.init_db()
+    async with aiosqlite.connect(db_path) as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO settings (key, value, description) VALUES ('xui_servers', ?, 'Фейковые панели бенчмарка')",
+            (json.dumps(servers),)
+        )
+        await db.executemany(
+            "INSERT OR IGNORE INTO users (telegram_id, username) VALUES (?, ?)",
+            [(user_id, f"bench{user_id}") for user_id in user_ids]
+        )
+        await db.commit()
+
+
+async def run_benchmark(args):
+    # Модули бота читают db_helpers.DATABASE_NAME при каждом вызове, так что подмена пути в _prepare_db действует и на них
+    from fake_xui_panel import FakeXUIPanel, FakePanelThread
+    from app_config import app_conf
+    from subscription_manager import grant_subscription, get_server_config
+    from x_ui_manager import xui_manager_instance
+    import traffic_collector
+
+    panel_threads = []
+    servers = []
+    for server_id in range(1, args.servers + 1):
+        panel = FakeXUIPanel(
+            inbound_count=args.inbounds, clients_per_inbound=args.clients, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+            error_rate=args.error_rate, traffic_bytes_per_sec=1024, seed=server_id,
+        )
+        panel_thread = FakePanelThread(panel)
+        panel_thread.start()
+        panel_threads.append(panel_thread)
+        server_config = panel_thread.server_config(server_id)
+        if args.inbounds > 1:
+            server_config['inbound_ids'] = list(range(1, args.inbounds + 1))
+        servers.append(server_config)
+    print(f"Панелей: {args.servers}, inbounds на панели: {args.inbounds}, клиентов в inbound: {args.clients}, "
+          f"задержка: {args.latency_ms}±{args.jitter_ms}мс, ошибки: {args.error_rate:.1%}")
+
+    user_ids = [9_000_000_000 + i for i in range(args.users)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        await _prepare_db(os.path.join(tmp_dir, 'bench.db'), servers, user_ids)
+        await app_conf.load_settings()
+
+        async def grant(user_id):
+            return await grant_subscription(user_id, 30) is not None
+
+        async def delete(user_id):
+            user = await db_helpers.get_last_subscription(user_id)
+            if not user or not user.get('xui_client_uuid'):
+                return False
+            server_config = await get_server_config(user['current_server_id'])
+            return await xui_manager_instance.delete_xui_user(
+                server_config, user['xui_client_uuid'], inbound_id=user.get('current_inbound_id')
+            )
+
+        async def collect(_):
+            return await traffic_collector.collect_traffic_once() >= 0
+
+        await _timed_phase('grant:new', user_ids, grant, args.concurrency)
+        await _timed_phase('grant:renew', user_ids, grant, args.concurrency)
+        await _timed_phase('traffic', range(args.collect_rounds), collect, 1)
+        await _timed_phase('delete', user_ids, delete, args.concurrency)
+
+    for panel_thread in panel_threads:
+        counts = ', '.join(f"{route.split('/api/')[-1]}={n}" for route, n in sorted(panel_thread.panel.request_counts.items()))
+        print(f"Запросы к {panel_thread.server_config(0)['url']}:{panel_thread.port}: {counts}")
+        panel_thread.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк выдачи подписок на фейковой панели 3x-ui')
+    parser.add_argument('--servers', type=int, default=1)
+    parser.add_argument('--inbounds', type=int, default=1, help='Inbounds на сервер (клиенты раскладываются по заполненности)')
+    parser.add_argument('--clients', type=int, default=1000, help='Предзаполненных клиентов на inbound')
+    parser.add_argument('--users', type=int, default=100, help='Пользователей в сценарии')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--collect-rounds', type=int, default=3)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(lambda msg: print(msg, end=''), level=args.log_level)
+    asyncio.run(run_benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# xui_gc.py
+"""
+Сборка мусора в inbounds X-UI: удаление давно истёкших клиентов.
+
+Клиенты, чья подписка закончилась больше xui_gc_grace_days дней назад, удаляются
+из inbound, чтобы списки клиентов и конфиг Xray не росли бесконечно: inbound читается
+один раз, а клиенты удаляются по одному (remove_clients_one_by_one), так что inbound целиком
+не переписывается и параллельные выдачи и продления не теряются. В БД остаются UUID, email и дата окончания,
+а в users.xui_removed_at ставится отметка: при продлении update_xui_user_subscription
+не найдёт клиента в панели и пересоздаст его с тем же UUID, так что ссылка
+на подписку у пользователя не меняется.
+Клиенты одного inbound удаляются в очереди операций их пользователей (run_users_operation),
+а перед удалением подписки сверяются с БД: продлённых за время прохода не трогаем.
+"""
+import asyncio
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from app_config import app_conf
+import db_helpers
+from subscription_manager import run_users_operation
+from x_ui_manager import xui_manager_instance, get_inbound_ids
+
+
+async def _remove_group(server_conf: Dict, inbound_id: int, users: List[Dict]) -> Optional[int]:
+    """
+    Удаляет клиентов одного inbound; выполняется в очереди операций этих пользователей.
+    Подписки, которые после выборки продлили или перенесли, не трогаются.
+    Возвращает число удалённых или None, если inbound недоступен.
+    """
+    users = await db_helpers.get_unchanged_gc_candidates(users)
+    if not users:
+        return 0
+    removed_uuids = await xui_manager_instance.remove_clients_one_by_one(server_conf, inbound_id, [u['xui_client_uuid'] for u in users])
+    if removed_uuids is None:
+        return None
+    removed = [u for u in users if u['xui_client_uuid'] in removed_uuids]
+    await db_helpers.mark_xui_clients_removed(removed)
+    return len(removed)
+
+
+async def collect_expired_clients() -> int:
+    """Один проход сборщика. Возвращает число клиентов, отмеченных как удалённые из X-UI."""
+    grace_days = app_conf.get('xui_gc_grace_days', 14)
+    if grace_days <= 0:
+        return 0
+
+    candidates = await db_helpers.get_users_for_xui_gc(grace_days)
+    if not candidates:
+        return 0
+
+    by_inbound: Dict[tuple, List[Dict]] = defaultdict(list)
+    for user in candidates:
+        by_inbound[(user['current_server_id'], user['current_inbound_id'])].append(user)
+
+    removed_total = 0
+    for (server_id, inbound_id), users in by_inbound.items():
+        server_conf = await db_helpers.get_server_config(server_id)
+        if not server_conf:
+            logger.warning(f"Сборка мусора: сервер {server_id} не найден в конфигурации, пропускаем {len(users)} клиентов.")
+            continue
+        # Записи без inbound созданы до появления нескольких inbounds и лежат в основном
+        inbound_id = inbound_id or get_inbound_ids(server_conf)[0]
+        removed = await run_users_operation([u['telegram_id'] for u in users], _remove_group, server_conf, inbound_id, users)
+        if removed is None:
+            logger.warning(f"Сборка мусора: inbound {inbound_id} сервера {server_conf.get('name')} недоступен, повторим в следующий раз.")
+            continue
+        removed_total += removed
+
+    logger.info(f"Сборка мусора X-UI: удалено {removed_total} клиентов, истёкших больше {grace_days} дн. назад.")
+    return removed_total
+
+
+async def run_expired_clients_gc():
+    """Бесконечный цикл сборки мусора; запускается из main.py как фоновая задача."""
+    while True:
+        try:
+            await collect_expired_clients()
+        except Exception as e:
+            logger.error(f"Глобальная ошибка в задаче сборки мусора X-UI: {e}")
+        await asyncio.sleep(max(1, app_conf.get('xui_gc_interval_hours', 6)) * 3600)